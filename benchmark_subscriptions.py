@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""比較訂閱樹與線性掃描查找訂閱者的性能
+
+用法: python benchmark_subscriptions.py [訂閱數量] [發布次數]
+"""
+
+import random
+import sys
+import time
+
+from mqtt_broker import MQTTBroker, SubscriptionTrie
+
+
+def build_filters(count, rng):
+    """生成模擬設備場景的主題過濾器"""
+    filters = []
+    for i in range(count):
+        site = f"site{i % 100}"
+        device = f"dev{i}"
+        kind = rng.random()
+        if kind < 0.90:
+            filters.append(f"{site}/{device}/{rng.choice(['temp', 'humidity', 'status'])}")
+        elif kind < 0.97:
+            filters.append(f"{site}/+/{rng.choice(['temp', 'humidity'])}")
+        else:
+            filters.append(f"{site}/{device}/#")
+    return filters
+
+
+def build_topics(count, subscriptions, rng):
+    """生成發布主題"""
+    return [
+        f"site{rng.randrange(100)}/dev{rng.randrange(subscriptions)}/"
+        f"{rng.choice(['temp', 'humidity', 'status'])}"
+        for _ in range(count)
+    ]
+
+
+def main():
+    subscriptions = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    publishes = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    rng = random.Random(42)
+
+    filters = build_filters(subscriptions, rng)
+    topics = build_topics(publishes, subscriptions, rng)
+
+    broker = MQTTBroker()
+    trie = SubscriptionTrie()
+    for i, topic_filter in enumerate(filters):
+        trie.add(topic_filter, f"client{i}")
+
+    # 線性掃描：與原 broadcast_message 相同，逐個比較所有訂閱
+    start = time.perf_counter()
+    linear_results = []
+    for topic in topics:
+        linear_results.append({
+            f"client{i}" for i, topic_filter in enumerate(filters)
+            if broker.topic_matches(topic_filter, topic)})
+    linear_time = time.perf_counter() - start
+
+    # 訂閱樹
+    start = time.perf_counter()
+    trie_results = [set(trie.match(topic)) for topic in topics]
+    trie_time = time.perf_counter() - start
+
+    if linear_results != trie_results:
+        print("[錯誤] 兩種方式的匹配結果不一致")
+        sys.exit(1)
+
+    matched = sum(len(r) for r in trie_results)
+    print(f"訂閱數量: {subscriptions}, 發布次數: {publishes}, 平均匹配訂閱者: {matched / publishes:.1f}")
+    print(f"線性掃描: {linear_time / publishes * 1e6:12.1f} 微秒/次")
+    print(f"訂閱樹:   {trie_time / publishes * 1e6:12.1f} 微秒/次")
+    print(f"加速比:   {linear_time / trie_time:12.1f}x")
+
+
+if __name__ == "__main__":
+    main()
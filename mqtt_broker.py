@@ -2,20 +2,51 @@
 # -*- coding: utf-8 -*-
 
 import socket
+import selectors
+import select
 import threading
 import logging
+import logging.handlers
+import queue
+import atexit
 import json
+import copy
 import time
 import sys
 import os
-import netifaces
-from collections import defaultdict
+import re
+import mmap
+import shutil
+import signal
+import struct
+import tempfile
+import zlib
+import array
+import heapq
+import hmac
+import base64
+import hashlib
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 
 # 獲取所有網絡接口的 IP 地址
 
 
 def get_all_ip_addresses():
-    """獲取所有網絡接口的 IP 地址"""
+    """獲取所有網絡接口的 IP 地址
+
+    netifaces 在第一次調用時才導入，未安裝時退回到主機名解析出的地址。
+    """
+    try:
+        import netifaces
+    except ImportError:
+        logger.warning("[警告] 缺少 netifaces 庫，無法顯示網絡接口信息。請使用 pip install netifaces 安裝。")
+        try:
+            return [("local", socket.gethostbyname(socket.gethostname()))]
+        except OSError:
+            return []
+
     ip_list = []
     interfaces = netifaces.interfaces()
 
@@ -49,19 +80,62 @@ def load_config(config_file="config.json"):
 
 # 載入用戶
 
+USERS_FILE = "users.json"
+
+# 用戶文件檢查修改的間隔（秒）
+USERS_RELOAD_INTERVAL = 2.0
+
+# 最多記住的驗證失敗憑據數
+FAILED_CREDENTIALS_SIZE = 1024
+
+# 密碼以加鹽的 PBKDF2-SHA256 哈希保存，格式為 pbkdf2_sha256$迭代次數$鹽$哈希（base64）
+PASSWORD_SCHEME = 'pbkdf2_sha256'
+PASSWORD_ITERATIONS = 200000
+
+
+def hash_password(password, iterations=PASSWORD_ITERATIONS):
+    """生成加鹽的密碼哈希"""
+    salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+    return '$'.join((PASSWORD_SCHEME, str(iterations),
+                     base64.b64encode(salt).decode('ascii'),
+                     base64.b64encode(digest).decode('ascii')))
+
+
+def verify_password(password, stored):
+    """驗證密碼是否與保存的哈希一致，兼容尚未哈希的明文密碼"""
+    if password is None:
+        return False
+    if not stored.startswith(PASSWORD_SCHEME + '$'):
+        return hmac.compare_digest(password.encode('utf-8'), stored.encode('utf-8'))
+    try:
+        _, iterations, salt, digest = stored.split('$')
+        actual = hashlib.pbkdf2_hmac(
+            'sha256', password.encode('utf-8'), base64.b64decode(salt), int(iterations))
+        return hmac.compare_digest(actual, base64.b64decode(digest))
+    except ValueError:
+        return False
+
+
+def parse_users(data):
+    """將用戶文件內容轉換為 用戶名 -> 用戶信息 的字典"""
+    users = {}
+    for user in data["users"]:
+        users[user["username"]] = {
+            "password": user["password"],
+            "permissions": user["permissions"],
+            "acl": user.get("acl"),  # 主題訪問控制規則，未設置時不限制主題
+            "rate_limit": user.get("rate_limit"),  # 該用戶所有連接共用的流量限制
+            "bridge": bool(user.get("bridge", False))  # 是否為其他 Broker 的橋接用戶
+        }
+    return users
+
 
-def load_users(user_file="users.json"):
+def load_users(user_file=USERS_FILE):
     """載入用戶文件"""
     try:
         with open(user_file, 'r') as f:
-            data = json.load(f)
-            users = {}
-            for user in data["users"]:
-                users[user["username"]] = {
-                    "password": user["password"],
-                    "permissions": user["permissions"]
-                }
-            return users
+            return parse_users(json.load(f))
     except Exception as e:
         print(f"[錯誤] 無法載入用戶文件 {user_file}: {e}")
         return {
@@ -70,233 +144,3187 @@ def load_users(user_file="users.json"):
         }
 
 
-# 載入配置和用戶
-raw_config = load_config()
-USERS = load_users()
-# 使用默認值合併載入的配置
-default_conf = {
-    'broker': {'host': '0.0.0.0', 'port': 1883, 'max_connections': 5},
-    'logging': {'level': 'INFO', 'format': '%(asctime)s - [%(levelname)s] - %(message)s'},
-    'mqtt': {'allow_anonymous': False}
+# 命令行啟動時未配置 mqtt.session_dir 使用的會話目錄；嵌入的 Broker 默認使用各自的臨時目錄
+MAIN_SESSION_DIR = 'sessions'
+
+# 默認配置，config.json 中同名部分的各項會覆蓋這裡的值
+DEFAULT_CONFIG = {
+    'broker': {'host': '0.0.0.0', 'port': 1883, 'max_connections': 5, 'engine': 'thread', 'workers': 1,
+               'outbound_queue_size': 1000, 'overflow_policy': 'drop_oldest',
+               'write_delay_ms': 0, 'write_batch_bytes': 65536,
+               'max_half_open': 256, 'connect_timeout': 10, 'connects_per_second': 0,
+               'admission_policy': 'queue'},
+    'logging': {'level': 'INFO', 'format': '%(asctime)s - [%(levelname)s] - %(message)s',
+                'categories': {}, 'payloads': False, 'sample_per_second': 20, 'queue_size': 10000},
+    'mqtt': {'allow_anonymous': False, 'max_inflight': 20, 'retry_interval': 10,
+             'retained_max_bytes': 64 * 1024 * 1024, 'session_dir': None,
+             'session_segment_bytes': 1024 * 1024, 'queue_qos0_offline': False,
+             'sys_interval': 10, 'shared_subscription_strategy': 'round_robin',
+             'rate_limit': {}, 'auth_threads': 2}
 }
-CONFIG = {}
-for key, val in default_conf.items():
-    # 若原始配置有該部分且為 dict，則合併其子項，否則使用預設
-    if key in raw_config and isinstance(raw_config[key], dict):
-        cfg_section = default_conf[key].copy()
-        cfg_section.update(raw_config[key])
-        CONFIG[key] = cfg_section
-    else:
-        CONFIG[key] = val
+
+
+def build_config(raw_config=None):
+    """使用默認值合併配置，返回新的配置字典（原字典不會被修改）"""
+    # 深複製，嵌套的字典（例如 rate_limit、categories）不會在多個 Broker 之間共用
+    raw_config = copy.deepcopy(raw_config or {})
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    for key, cfg_section in config.items():
+        # 若原始配置有該部分且為 dict，則合併其子項，否則使用預設
+        if isinstance(raw_config.get(key), dict):
+            cfg_section.update(raw_config[key])
+    # 其他配置項（例如 bridges）原樣保留
+    for key, val in raw_config.items():
+        config.setdefault(key, val)
+    return config
 
 # 設置日誌
-log_cfg = CONFIG.get('logging', {})
-log_format = log_cfg.get(
-    'format', '%(asctime)s - [%(levelname)s] - %(message)s')
-log_level_name = log_cfg.get('level', 'INFO').upper()
-log_level = getattr(logging, log_level_name, logging.INFO)
-logging.basicConfig(level=log_level, format=log_format)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """只把日誌記錄放入隊列，格式化和輸出都在 QueueListener 的後台線程中進行
+
+    標準 QueueHandler 會在調用線程中先格式化消息，這裡直接傳遞原始記錄。
+    隊列已滿時丟棄記錄並計數，不阻塞調用方。
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class SampledLogger:
+    """限制逐條消息日誌每秒的輸出數量
+
+    每秒最多輸出 rate 條（0 表示不限制），超出的只計數，
+    並在下一秒第一條日誌前輸出一條摘要。計數不加鎖，多線程下為近似值。
+    """
+
+    def __init__(self, logger, rate):
+        self.logger = logger
+        self.rate = rate
+        self.window = 0
+        self.count = 0
+        self.suppressed = 0
+
+    def isEnabledFor(self, level):
+        return self.logger.isEnabledFor(level)
+
+    def log(self, level, msg, *args):
+        if not self.logger.isEnabledFor(level):
+            return
+        if self.rate:
+            window = int(time.monotonic())
+            if window != self.window:
+                if self.suppressed:
+                    self.logger.log(level, "[日誌] 上一秒略過了 %d 條同類日誌", self.suppressed)
+                self.window = window
+                self.count = 0
+                self.suppressed = 0
+            if self.count >= self.rate:
+                self.suppressed += 1
+                return
+            self.count += 1
+        self.logger.log(level, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(logging.INFO, msg, *args)
+
+    def debug(self, msg, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+
+log_listener = None
+log_config = None  # 最近一次 setup_logging 的配置，fork 後的子進程按它重新設置
+log_handlers = ()
+
+
+def setup_logging(log_cfg, handlers=()):
+    """設置異步日誌：日誌記錄經隊列交給後台線程格式化並寫出
+
+    handlers 為額外的日誌處理器（例如 EventChannel.log_handler()），同樣在後台線程中調用。
+    由程序入口調用；Broker 作為庫嵌入時不會修改進程的日誌配置。
+    """
+    global log_listener, log_config, log_handlers
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(log_cfg.get(
+        'format', '%(asctime)s - [%(levelname)s] - %(message)s')))
+    log_queue = queue.Queue(log_cfg.get('queue_size', 10000))
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(getattr(logging, log_cfg.get('level', 'INFO').upper(), logging.INFO))
+    log_listener = logging.handlers.QueueListener(log_queue, handler, *handlers)
+    log_listener.start()
+
+    # 按類別設置日誌級別，例如 {"publish": "WARNING"}；逐條消息的日誌按每秒條數採樣
+    for category, level in log_cfg.get('categories', {}).items():
+        logging.getLogger(f"{__name__}.{category}").setLevel(level.upper())
+    publish_logger.rate = broadcast_logger.rate = log_cfg.get('sample_per_second', 20)
+
+    if log_config is None:
+        atexit.register(stop_logging)
+        if hasattr(os, 'register_at_fork'):
+            # 後台線程不會被 fork 複製，子進程需要重新建立日誌隊列
+            os.register_at_fork(after_in_child=lambda: setup_logging(log_config, log_handlers))
+    log_config = log_cfg
+    log_handlers = tuple(handlers)
+
+
+def stop_logging():
+    """寫出隊列中剩餘的日誌並停止後台線程"""
+    if log_listener:
+        log_listener.stop()
+
+
 logger = logging.getLogger(__name__)
+publish_logger = SampledLogger(logging.getLogger(f"{__name__}.publish"), 20)
+broadcast_logger = SampledLogger(logging.getLogger(f"{__name__}.broadcast"), 20)
 
 # MQTT 常量
 CONNECT = 0x10
 CONNACK = 0x20
 PUBLISH = 0x30
 PUBACK = 0x40
+PUBREC = 0x50
+PUBREL = 0x60
+PUBCOMP = 0x70
 SUBSCRIBE = 0x80
 SUBACK = 0x90
+UNSUBSCRIBE = 0xA0
+UNSUBACK = 0xB0
+PINGREQ = 0xC0
+PINGRESP = 0xD0
 DISCONNECT = 0xE0
 
-# 從配置中獲取設置
-HOST = CONFIG['broker'].get('host', '0.0.0.0')
-PORT = CONFIG['broker'].get('port', 1883)
+# 橋接連接的客戶端 ID 前綴，只有 users.json 中標記為 bridge 的用戶可以使用
+BRIDGE_CLIENT_PREFIX = '$bridge/'
+
+# 維護任務執行間隔（秒）
+TICK_INTERVAL = 1.0
+
+# 超過 keepalive 的多少倍未收到任何報文時斷開連接（MQTT 3.1.1 規定為 1.5 倍）
+KEEPALIVE_GRACE = 1.5
+
+# 支持的最高 QoS 等級
+MAX_QOS = 1
+
+# 外發隊列溢出策略
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'disconnect')
+
+# 新連接超過准入限制時的處理方式：留在內核監聽隊列中等待，或立即關閉
+ADMISSION_POLICIES = ('queue', 'refuse')
+
+# 一次 sendmsg 最多寫出的緩衝區數
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')  # Windows 不支持
+
+
+# 消息內容的文本表示
+
+
+class PayloadText:
+    """延遲解碼的消息內容，只有在日誌真正輸出時才轉換為文本"""
+    __slots__ = ('payload',)
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __str__(self):
+        payload = self.payload
+        if isinstance(payload, str):
+            return payload
+        try:
+            return str(payload, 'utf-8')
+        except UnicodeDecodeError:
+            return f"<二進制數據 {len(payload)} 字節>"
+
+
+# 統計計數
+
+
+class ThreadCounters:
+    """按線程分開的計數器
+
+    每個線程只累加自己的字典，不需要加鎖，也不會因多線程同時 += 而丟失
+    計數；只有讀取統計時才合併所有線程的值。已退出線程的計數合併到
+    retired 中，不會隨連接線程的增加而無限增長。
+    """
+
+    def __init__(self, names=()):
+        self.names = list(names)  # 統計項的顯示順序，未出現過的項為 0
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.threads = []  # [(線程, 計數字典)]
+        self.retired = defaultdict(int)
+
+    def add(self, name, value=1):
+        counters = getattr(self.local, 'counters', None)
+        if counters is None:
+            counters = self.local.counters = defaultdict(int)
+            with self.lock:
+                self.threads.append((threading.current_thread(), counters))
+        counters[name] += value
+
+    def snapshot(self):
+        """合併所有線程的計數"""
+        with self.lock:
+            alive = []
+            for thread, counters in self.threads:
+                if thread.is_alive():
+                    alive.append((thread, counters))
+                else:
+                    for name, value in counters.items():
+                        self.retired[name] += value
+            self.threads = alive
+            result = dict.fromkeys(self.names, 0)
+            result.update(self.retired)
+            for _, counters in alive:
+                for name, value in list(counters.items()):
+                    result[name] = result.get(name, 0) + value
+        return result
+
+    def __getitem__(self, name):
+        return self.snapshot().get(name, 0)
+
+
+# 客戶端連接
+
+
+class ClientConnection:
+    """客戶端連接基類，封裝套接字、連接狀態與外發隊列
+
+    每個連接有一個有界的外發隊列，發布者只負責把報文放入隊列，
+    由各連接獨立寫出，慢速訂閱者不會阻塞發布者和其他訂閱者。
+    控制報文和已進入 QoS 1 發送窗口的報文放在另一條不受上限限制、
+    不會被丟棄的隊列中（數量受協議和發送窗口限制），寫出時優先發送。
+    """
+
+    def __init__(self, sock, address, broker):
+        self.sock = sock
+        self.address = address
+        self.broker = broker
+        self.client_id = None
+        self.session = None  # 持久會話，clean session = 1 時為 None
+        self.auth_pending = False  # 事件循環模式下正在線程池中驗證密碼
+        self.held_packets = ()  # 驗證密碼期間暫存的後續報文
+        self.is_bridge = False  # 是否為其他 Broker 的橋接連接
+        self.handoff = None  # 多進程模式下應接管該連接的工作進程編號
+        self.keepalive = 0  # 客戶端聲明的 keepalive（秒），0 表示不檢查
+        self.acl = None  # 認證成功後編譯的 TopicACL
+        self.rate_limits = ()  # 適用於該連接的 RateLimit（客戶端、用戶）
+        self.throttled = 0  # 因超過流量限制而暫停讀取的次數
+        self.last_activity = time.monotonic()  # 最後一次收到報文的時間
+        self.half_open = False  # 已接受但尚未完成 CONNECT，佔用一個准入名額
+        self.disconnected = False  # 收到 DISCONNECT 報文，屬於正常斷開
+        self.closing = False  # 不再接受新的外發消息
+        self.closed = False
+        self.lock = threading.Lock()
+        self.queue = deque()  # QoS 0 報文，受 queue_limit 限制
+        self.control = deque()  # 控制報文和 QoS 1 窗口內的報文，不受上限限制
+        # 累計放入和取出控制隊列的緩衝區數，用於判斷某個報文是否仍在隊列中等待寫出
+        self.control_pushed = 0
+        self.control_taken = 0
+        self.outbufs = []  # 已從隊列取出、尚未寫完的報文
+        self.queue_bytes = 0  # 兩條外發隊列中報文的總字節數
+        self.queued_at = 0.0  # 外發隊列由空變為非空的時間
+        self.urgent = False  # 隊列中有控制報文，應立即寫出
+        self.write_delay = broker.write_delay
+        self.write_batch_bytes = broker.write_batch_bytes
+        self.queue_limit = broker.outbound_queue_size
+        self.overflow_policy = broker.overflow_policy
+        self.dropped = 0
+        # QoS 1 發送窗口
+        self.max_inflight = broker.max_inflight
+        # packet_id -> [報文緩衝區列表, 發送時間, 會話日誌標記, 最近一份副本在控制隊列中的序號]
+        self.inflight = OrderedDict()
+        self.backlog = deque()  # 等待進入發送窗口的 (QoS 1 報文, 會話日誌標記)
+        self.qos2_received = set()  # 已回覆 PUBREC、等待 PUBREL 的 QoS 2 報文標識符
+        self.next_packet_id = 1
+
+    def send(self, data):
+        """發送控制報文，不受隊列上限限制，也不等待合併"""
+        with self.lock:
+            self.push(data, self.control)
+            self.urgent = True
+        self.notify_writer()
+
+    def push(self, frame, target=None):
+        """將報文加入外發隊列尾部（需持有鎖），target 默認為 QoS 0 隊列"""
+        if not self.queue and not self.control:
+            self.queued_at = time.monotonic()
+        (self.queue if target is None else target).append(frame)
+        self.queue_bytes += len(frame)
+        if target is self.control:
+            self.control_pushed += 1
+
+    def has_output(self):
+        """是否有等待寫出的報文（需持有鎖）"""
+        return bool(self.control or self.queue)
+
+    def flush_due(self):
+        """返回外發隊列應寫出的時間（需持有鎖），0 表示應立即寫出
+
+        隊列中的數據達到 write_batch_bytes、有控制報文或未設置合併延遲時
+        立即寫出，否則最多等待 write_delay 秒，讓高頻消息合併成一次寫出。
+        """
+        if (self.urgent or self.closing or not self.write_delay
+                or self.queue_bytes >= self.write_batch_bytes):
+            return 0
+        return self.queued_at + self.write_delay
+
+    def take_batch(self):
+        """從外發隊列取出一批報文（需持有鎖），控制報文優先，最多 write_batch_bytes 字節"""
+        batch = []
+        size = 0
+        pending_control = len(self.control)
+        for source in (self.control, self.queue):
+            while source and size < self.write_batch_bytes and len(batch) < IOV_MAX:
+                frame = source.popleft()
+                batch.append(frame)
+                size += len(frame)
+        self.queue_bytes -= size
+        self.control_taken += pending_control - len(self.control)
+        self.urgent = bool(self.control)
+        return batch
+
+    def write_some(self, flags=0):
+        """寫出外發隊列，直到隊列已空、套接字緩衝區已滿或需要等待合併
+
+        返回 None 表示已全部寫出，True 表示套接字緩衝區已滿、應等待可寫，
+        否則返回等待合併的到期時間。寫出失敗時拋出 OSError。
+        """
+        while True:
+            if not self.outbufs:
+                with self.lock:
+                    if not self.has_output():
+                        return None
+                    due = self.flush_due()
+                    if due and due > time.monotonic():
+                        return due
+                    self.outbufs = self.take_batch()
+            try:
+                sent = send_buffers(self.sock, self.outbufs, flags)
+            except (BlockingIOError, InterruptedError):
+                return True
+            self.broker.stats.add('bytes_sent', sent)
+            self.broker.stats.add('write_calls')
+            consume_buffers(self.outbufs, sent)
+            if self.outbufs:
+                return True
+
+    def enqueue(self, frame):
+        """將消息放入外發隊列，隊列已滿時按溢出策略處理，返回是否入隊"""
+        return self.admit(self.queue, frame)
+
+    def deliver(self, frame, qos=0, mark=None):
+        """投遞一條 PUBLISH 報文
+
+        QoS 0 報文直接進入外發隊列；QoS 1 報文分配報文標識符後進入發送
+        窗口，窗口已滿時在 backlog 中等待，收到 PUBACK 後依次補入。
+        mark 為來自會話日誌的消息標記，收到 PUBACK 時用於確認會話日誌。
+        """
+        if qos == 0:
+            return self.enqueue(frame)
+        if self.closing:
+            return False
+        # 窗口檢查和放入 backlog 在同一把鎖內完成，否則 PUBACK 可能在兩者之間
+        # 清空窗口，報文留在 backlog 中無人補入
+        with self.lock:
+            if len(self.inflight) < self.max_inflight and not self.backlog:
+                self.start_inflight(frame, mark)
+                overflow, accepted = False, True
+            else:
+                overflow, accepted = self.admit_locked(self.backlog, (frame, mark))
+        return self.admitted(overflow, accepted)
+
+    def admit(self, target, frame):
+        """按隊列上限和溢出策略將報文放入指定隊列"""
+        if self.closing:
+            return False
+        with self.lock:
+            overflow, accepted = self.admit_locked(target, frame)
+        return self.admitted(overflow, accepted)
+
+    def admit_locked(self, target, frame):
+        """將報文放入指定隊列（需持有鎖），返回 (是否溢出, 是否入隊)"""
+        overflow = False
+        accepted = True
+        if len(target) >= self.queue_limit:
+            overflow = True
+            self.dropped += 1
+            if self.overflow_policy == 'drop_oldest':
+                oldest = target.popleft()
+                if target is self.queue:
+                    self.queue_bytes -= len(oldest)
+                elif oldest[1] is not None:
+                    self.session.acknowledge(oldest[1])  # 丟棄的會話消息不再重發
+            else:
+                accepted = False
+        if accepted:
+            if target is self.queue:
+                self.push(frame)
+            else:
+                target.append(frame)
+        return overflow, accepted
+
+    def admitted(self, overflow, accepted):
+        """在鎖外處理入隊結果：記錄溢出、按策略斷開並通知寫出方"""
+        if overflow:
+            if self.overflow_policy == 'disconnect':
+                logger.warning(f"[隊列] 客戶端 {self.client_id} 外發隊列已滿，斷開連接")
+                self.abort()
+                return False
+            if self.dropped % 1000 == 1:
+                logger.warning(
+                    f"[隊列] 客戶端 {self.client_id} 外發隊列已滿 ({self.queue_limit})，"
+                    f"已丟棄 {self.dropped} 條消息")
+        if accepted:
+            self.notify_writer()
+        return accepted
+
+    def start_inflight(self, template, mark=None):
+        """為 QoS 1 報文分配報文標識符，記錄到發送窗口並放入控制隊列（需持有鎖）
+
+        共用的報文模板不會被複製：報文按「固定報頭和主題、報文標識符、
+        消息內容」三段分別寫出，只有兩字節的報文標識符是每個連接獨有的。
+        """
+        packet_id = self.next_packet_id
+        while packet_id in self.inflight:
+            packet_id = packet_id % 65535 + 1
+        self.next_packet_id = packet_id % 65535 + 1
+
+        # 報文標識符位於主題名稱之後
+        _, _, header_len = parse_fixed_header(template)
+        offset = header_len + 2 + \
+            ((template[header_len] << 8) | template[header_len + 1])
+        view = memoryview(template)
+        buffers = [view[:offset], packet_id.to_bytes(2, 'big'), view[offset + 2:]]
+
+        for buf in buffers:
+            self.push(buf, self.control)
+        self.inflight[packet_id] = [buffers, time.monotonic(), mark, self.control_pushed]
+        self.broker.inflight_connections.add(self)
+
+    def acknowledge(self, packet_id):
+        """收到 PUBACK，釋放窗口並補入等待中的報文"""
+        with self.lock:
+            entry = self.inflight.pop(packet_id, None)
+            if entry is None:
+                return False
+            while self.backlog and len(self.inflight) < self.max_inflight:
+                self.start_inflight(*self.backlog.popleft())
+        if entry[2] is not None:
+            self.session.acknowledge(entry[2])
+        self.notify_writer()
+        return True
+
+    def take_unacked(self):
+        """取出未確認的 QoS 1 報文 [(報文, 是否可能已發送)]，不包括來自會話日誌的消息"""
+        with self.lock:
+            unacked = [(b''.join(buffers), True)
+                       for buffers, _, mark, _ in self.inflight.values() if mark is None]
+            unacked.extend((frame, False) for frame, mark in self.backlog if mark is None)
+            self.inflight.clear()
+            self.backlog.clear()
+        return unacked
+
+    def retransmit(self, now, interval):
+        """重發超時未確認的 QoS 1 報文，返回重發數量
+
+        上一份副本仍在控制隊列中（客戶端停止讀取、套接字緩衝區已滿）時不再重複放入，
+        只重新計時，控制隊列不會因重發而無限增長。
+        """
+        count = 0
+        with self.lock:
+            for entry in self.inflight.values():
+                if now - entry[1] >= interval:
+                    entry[1] = now
+                    if self.control_taken < entry[3]:
+                        continue
+                    buffers = entry[0]
+                    if not buffers[0][0] & 0x08:
+                        # 只複製固定報頭和主題，設置 DUP 標誌
+                        prefix = bytearray(buffers[0])
+                        prefix[0] |= 0x08
+                        buffers[0] = bytes(prefix)
+                    for buf in buffers:
+                        self.push(buf, self.control)
+                    entry[3] = self.control_pushed
+                    count += 1
+        if count:
+            self.notify_writer()
+        return count
+
+    def queue_depth(self):
+        """外發隊列中等待發送的報文數"""
+        return len(self.queue) + len(self.control) + len(self.backlog) + len(self.outbufs)
+
+    def clear_output(self):
+        """丟棄所有未寫出的報文（需持有鎖），未確認的 QoS 1 報文保留到清理連接時處理"""
+        self.queue.clear()
+        self.control.clear()
+        self.control_taken = self.control_pushed
+        self.queue_bytes = 0
+
+    def notify_writer(self):
+        """通知寫出方隊列中有新數據"""
+        raise NotImplementedError
+
+    def abort(self):
+        """立即斷開連接，丟棄未發送的數據"""
+        raise NotImplementedError
+
+    def close(self):
+        """關閉連接"""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.close()
+        except:
+            pass
+
+
+class ThreadedConnection(ClientConnection):
+    """線程模式下的連接，讀線程阻塞讀取，外發隊列由所有連接共用的 SharedWriter 寫出
+
+    不支持 MSG_DONTWAIT 的系統（Windows）上退回到每個連接一個寫線程。
+    """
+
+    def __init__(self, sock, address, broker):
+        super().__init__(sock, address, broker)
+        self.cond = threading.Condition(self.lock)
+        self.shared_writer = broker.get_writer()
+        self.released = False  # 已從 SharedWriter 移除，不再寫出
+        self.writer = None
+        if self.shared_writer is None:
+            self.writer_idle = True  # 寫線程在等待新報文，而不是在等待合併
+            self.writer = threading.Thread(target=self.writer_loop, daemon=True)
+            self.writer.start()
+
+    def notify_writer(self):
+        if self.shared_writer is not None:
+            self.shared_writer.request(self)
+            return
+        with self.cond:
+            # 寫線程正在等待合併時，只有需要立即寫出才喚醒它
+            if self.writer_idle or not self.flush_due():
+                self.cond.notify()
+
+    def writer_loop(self):
+        """寫線程：等待報文積累到 write_batch_bytes 或最多 write_delay 秒，再一次寫出"""
+        while True:
+            with self.cond:
+                while True:
+                    if not self.has_output():
+                        if self.closing:
+                            return
+                        self.writer_idle = True
+                        self.cond.wait()
+                        continue
+                    self.writer_idle = False
+                    wait = self.flush_due() - time.monotonic()
+                    if wait <= 0:
+                        break
+                    self.cond.wait(wait)
+                batch = self.take_batch()
+            try:
+                while batch:
+                    sent = send_buffers(self.sock, batch)
+                    self.broker.stats.add('bytes_sent', sent)
+                    self.broker.stats.add('write_calls')
+                    consume_buffers(batch, sent)
+            except OSError:
+                self.abort()
+                return
+
+    def abort(self):
+        with self.cond:
+            self.clear_output()
+        self.shutdown()
+
+    def shutdown(self):
+        """關閉套接字讀寫，使讀線程退出"""
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
+
+    def close(self):
+        if self.closed:
+            return
+        # 等待剩餘報文寫出（例如認證失敗時的 CONNACK）
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        if self.writer is not None:
+            if self.writer is not threading.current_thread():
+                self.writer.join(timeout=1.0)
+        elif self.shared_writer.thread is not threading.current_thread():
+            self.shared_writer.request(self)
+            with self.cond:
+                self.cond.wait_for(lambda: not self.has_output() and not self.outbufs,
+                                   timeout=1.0)
+        self.shutdown()
+        if self.shared_writer is not None:
+            self.shared_writer.release(self)
+        super().close()
+
+
+class SharedWriter:
+    """線程模式下所有連接共用的寫線程
+
+    有數據的連接登記到這裡，寫線程以 MSG_DONTWAIT 非阻塞寫出，套接字緩衝區
+    已滿的連接在選擇器中等待可寫，等待合併的連接在到期後寫出。
+    每個連接不再需要自己的寫線程，慢速訂閱者也不會阻塞其他連接的寫出。
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_sockets = socket.socketpair()
+        for sock in self.wakeup_sockets:
+            sock.setblocking(False)
+        self.selector.register(self.wakeup_sockets[0], selectors.EVENT_READ)
+        self.lock = threading.Lock()
+        self.pending = set()  # 等待寫出的連接
+        self.waiting = set()  # 在選擇器中等待可寫的連接
+        self.delayed = {}  # 等待合併的連接 -> 寫出時間，只由寫線程訪問
+        self.woken = False
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='shared-writer', daemon=True)
+        self.thread.start()
+
+    def request(self, conn):
+        """登記有數據要寫出的連接"""
+        with self.lock:
+            self.pending.add(conn)
+            if self.woken:
+                return
+            self.woken = True
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            self.wakeup_sockets[1].send(b'\0')
+        except OSError:
+            pass  # 喚醒數據已經足夠多
+
+    def release(self, conn):
+        """連接關閉前移除其登記，之後套接字可以安全關閉"""
+        with self.lock:
+            conn.released = True
+            self.pending.discard(conn)
+            if conn in self.waiting:
+                self.waiting.discard(conn)
+                try:
+                    self.selector.unregister(conn.sock)
+                except (KeyError, ValueError):
+                    pass
+
+    def stop(self):
+        self.running = False
+        self.wakeup()
+
+    def run(self):
+        while self.running:
+            timeout = None
+            if self.delayed:
+                timeout = max(0.0, min(self.delayed.values()) - time.monotonic())
+            ready = []
+            for key, _ in self.selector.select(timeout):
+                if key.data is None:
+                    try:
+                        while self.wakeup_sockets[0].recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                else:
+                    ready.append(key.data)
+            with self.lock:
+                for conn in ready:
+                    if conn in self.waiting:
+                        self.waiting.discard(conn)
+                        self.selector.unregister(conn.sock)
+                        self.pending.add(conn)
+                pending, self.pending = self.pending, set()
+                pending.difference_update(self.waiting)
+                self.woken = False
+            if self.delayed:
+                now = time.monotonic()
+                for conn, due in list(self.delayed.items()):
+                    if due <= now:
+                        del self.delayed[conn]
+                        pending.add(conn)
+            for conn in pending:
+                self.flush(conn)
+        self.selector.close()
+        for sock in self.wakeup_sockets:
+            sock.close()
+
+    def flush(self, conn):
+        if conn.released:
+            return
+        try:
+            result = conn.write_some(socket.MSG_DONTWAIT)
+        except OSError:
+            conn.abort()
+            return
+        if result is True:
+            with self.lock:
+                if not conn.released and conn not in self.waiting:
+                    try:
+                        self.selector.register(conn.sock, selectors.EVENT_WRITE, conn)
+                        self.waiting.add(conn)
+                    except (KeyError, ValueError, OSError):
+                        pass  # 連接已關閉
+        elif result is not None:
+            self.delayed[conn] = result
+        elif conn.closing:
+            with conn.cond:
+                conn.cond.notify_all()  # close() 在等待剩餘報文寫出
+
+
+class SelectorConnection(ClientConnection):
+    """事件循環模式下的連接，由事件循環在套接字可寫時寫出外發隊列"""
+
+    def __init__(self, sock, address, broker):
+        super().__init__(sock, address, broker)
+        self.framer = broker.new_framer()
+        self.reading = True
+        self.writing = False
+        self.registered = True  # 是否已在選擇器中註冊（不監聽任何事件時需註銷）
+        self.resume_at = 0.0  # 限流暫停讀取的結束時間
+
+    def notify_writer(self):
+        self.broker.request_flush(self)
+
+    def abort(self):
+        with self.lock:
+            self.closing = True
+            self.clear_output()
+        self.broker.schedule_close(self)
+
+    def flush(self):
+        """寫出隊列中的數據，直到套接字緩衝區已滿；未到合併延遲時交給事件循環稍後寫出"""
+        if self.closed:
+            return
+        try:
+            result = self.write_some()
+        except OSError:
+            self.broker.schedule_close(self)
+            return
+        if result is not None and result is not True:
+            self.broker.delay_flush(self, result)
+        self.set_writing(result is True)
+
+    def set_writing(self, enabled):
+        """切換是否監聽可寫事件"""
+        if enabled == self.writing or self.closed:
+            return
+        self.writing = enabled
+        self.update_events()
+
+    def set_reading(self, enabled):
+        """切換是否監聽可讀事件，限流時暫停讀取"""
+        if enabled == self.reading or self.closed:
+            return
+        self.reading = enabled
+        self.update_events()
+
+    def pause_reading(self, wait):
+        """暫停讀取 wait 秒，到期後由事件循環恢復"""
+        self.resume_at = time.monotonic() + wait
+        self.set_reading(False)
+        heapq.heappush(self.broker.throttled, (self.resume_at, id(self), self))
+
+    def update_events(self):
+        """按讀寫狀態更新選擇器中監聽的事件"""
+        events = 0
+        if self.reading:
+            events |= selectors.EVENT_READ
+        if self.writing:
+            events |= selectors.EVENT_WRITE
+        selector = self.broker.selector
+        if not events:
+            selector.unregister(self.sock)
+            self.registered = False
+        elif self.registered:
+            selector.modify(self.sock, events, self)
+        else:
+            selector.register(self.sock, events, self)
+            self.registered = True
+
+
+def send_buffers(sock, buffers, flags=0):
+    """用一次系統調用寫出多個緩衝區，返回寫出的字節數"""
+    if len(buffers) == 1:
+        return sock.send(buffers[0], flags)
+    if HAS_SENDMSG:
+        return sock.sendmsg(buffers, (), flags)
+    return sock.send(b''.join(buffers), flags)
+
+
+def consume_buffers(buffers, sent):
+    """從緩衝區列表頭部去掉已寫出的 sent 字節，部分寫出的緩衝區保留剩餘部分"""
+    index = 0
+    while index < len(buffers) and sent >= len(buffers[index]):
+        sent -= len(buffers[index])
+        index += 1
+    del buffers[:index]
+    if sent:
+        buffers[0] = memoryview(buffers[0])[sent:]
+
+
+def raise_fd_limit():
+    """嘗試將可打開的文件描述符上限提高到系統允許的最大值"""
+    try:
+        import resource
+    except ImportError:
+        return None  # Windows 不支持
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+def encode_remaining_length(length):
+    """按 MQTT 可變長度格式編碼剩餘長度"""
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length = length // 128
+        if length > 0:
+            byte |= 0x80
+        encoded.append(byte)
+        if length == 0:
+            return encoded
+
+
+def parse_fixed_header(buf, start=0, end=None):
+    """從緩衝區解析固定報頭，返回 (報文類型字節, 剩餘長度, 報頭長度)，數據不足時返回 None"""
+    if end is None:
+        end = len(buf)
+    if end - start < 2:
+        return None
+    multiplier = 1
+    remaining_length = 0
+    offset = start + 1
+    while True:
+        if offset >= end:
+            return None
+        byte = buf[offset]
+        offset += 1
+        remaining_length += (byte & 127) * multiplier
+        multiplier *= 128
+        if (byte & 128) == 0:
+            break
+        if offset - start > 4:
+            raise ValueError("剩餘長度字段超過 4 個字節")
+    return buf[start], remaining_length, offset - start
+
+
+class PacketFramer:
+    """增量報文解析器
+
+    每個連接持有一個接收緩衝區，通過 recv_into 直接讀入，每次讀取後
+    取出其中所有完整的報文，不完整的報文保留到下一次讀取。
+    """
+
+    def __init__(self, buffer_size=4096, max_packet_size=0):
+        self.initial_size = buffer_size
+        self.max_packet_size = max_packet_size
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # 未處理數據的起點
+        self.end = 0    # 已接收數據的終點
+
+    def recv_from(self, sock):
+        """從套接字讀取數據到緩衝區，返回讀取的字節數（0 表示對端關閉）"""
+        if self.end == len(self.buffer):
+            self.make_room(len(self.buffer) - self.start + 1)
+        received = sock.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+    def feed(self, data):
+        """直接向緩衝區追加數據"""
+        needed = self.end - self.start + len(data)
+        if self.end + len(data) > len(self.buffer):
+            self.make_room(needed)
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def packets(self):
+        """取出緩衝區中所有完整的報文，返回 [(報文類型字節, 報文內容)]
+
+        所有完整報文所在的區域只複製一次到不可變的 bytes 中，每個報文的
+        內容是其上的 memoryview 切片，後續解析和轉發都不再複製。
+        """
+        found = []
+        buf = self.buffer
+        first = self.start
+        incomplete = 0  # 未完整接收的報文長度
+        while True:
+            header = parse_fixed_header(buf, self.start, self.end)
+            if header is None:
+                break
+            first_byte, remaining_length, header_len = header
+            packet_len = header_len + remaining_length
+            if self.max_packet_size and packet_len > self.max_packet_size:
+                raise ValueError(f"報文長度 {packet_len} 超過上限 {self.max_packet_size}")
+            if self.end - self.start < packet_len:
+                incomplete = packet_len
+                break
+            payload_start = self.start + header_len - first
+            found.append(
+                (first_byte, payload_start, payload_start + remaining_length))
+            self.start += packet_len
+
+        result = []
+        if found:
+            chunk = memoryview(bytes(self.view[first:self.start]))
+            result = [(first_byte, chunk[begin:end])
+                      for first_byte, begin, end in found]
+
+        # 完整報文已複製出去後，再確保緩衝區能容納未完整的報文
+        if incomplete and self.start + incomplete > len(self.buffer):
+            self.make_room(incomplete)
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > self.initial_size * 4:
+                # 處理完大報文後縮回初始大小，避免空閒連接佔用過多內存
+                self.resize(self.initial_size)
+        return result
+
+    def make_room(self, needed):
+        """將未處理數據移到緩衝區開頭，空間仍不足時擴容"""
+        pending = self.end - self.start
+        if needed <= len(self.buffer):
+            if self.start:
+                self.buffer[:pending] = self.buffer[self.start:self.end]
+                self.start, self.end = 0, pending
+        else:
+            self.resize(max(needed, len(self.buffer) * 2))
+
+    def resize(self, size):
+        """重新分配緩衝區"""
+        pending = self.end - self.start
+        new_buffer = bytearray(max(size, pending))
+        new_buffer[:pending] = self.buffer[self.start:self.end]
+        self.view.release()
+        self.buffer = new_buffer
+        self.view = memoryview(new_buffer)
+        self.start, self.end = 0, pending
+
+
+# 定時器
+
+
+class TimerWheel:
+    """分層時間輪
+
+    每層有 slots 個槽位，第 0 層每個槽位對應一個時間刻度，上一層的每個
+    槽位對應下一層轉一圈的時間。定時項按到期刻度與當前刻度最高的不同
+    位放入對應層，時間走到上層槽位時再逐層下放，最終在第 0 層到期。
+    添加、取消和每個刻度的推進都是 O(1)，與定時項總數無關。
+    """
+
+    def __init__(self, resolution=1.0, slots=64, levels=4):
+        self.resolution = resolution
+        self.bits = slots.bit_length() - 1  # slots 必須為 2 的冪
+        self.mask = slots - 1
+        self.levels = levels
+        self.wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.entries = {}  # 定時項 -> (到期刻度, 層, 槽位)
+        self.origin = time.monotonic()
+        self.current = 0  # 當前刻度
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def schedule(self, item, deadline):
+        """在 deadline（time.monotonic() 時間）到期後觸發 item，已存在時改為新的到期時間"""
+        due = int((deadline - self.origin) / self.resolution) + 1
+        with self.lock:
+            self._remove(item)
+            self._place(item, max(due, self.current + 1))
+
+    def cancel(self, item):
+        with self.lock:
+            self._remove(item)
+
+    def _remove(self, item):
+        entry = self.entries.pop(item, None)
+        if entry:
+            self.wheels[entry[1]][entry[2]].discard(item)
+
+    def _place(self, item, due):
+        level = 0
+        diff = due ^ self.current
+        while level < self.levels - 1 and diff >> (self.bits * (level + 1)):
+            level += 1
+        if diff >> (self.bits * self.levels):
+            # 超出時間輪範圍：放在最高層的 0 號槽位，時間輪轉完一圈時重新計算。
+            # 未超出範圍的定時項到期位必定大於當前位，不會放入該槽位
+            slot = 0
+        else:
+            slot = (due >> (self.bits * level)) & self.mask
+        self.wheels[level][slot].add(item)
+        self.entries[item] = (due, level, slot)
+
+    def advance(self, now=None):
+        """推進到當前時間，返回所有已到期的定時項"""
+        if now is None:
+            now = time.monotonic()
+        target = int((now - self.origin) / self.resolution)
+        expired = []
+        with self.lock:
+            while self.current < target:
+                self.current += 1
+                # 從高層到低層，將走到的槽位中的定時項下放
+                for level in range(self.levels - 1, 0, -1):
+                    if self.current & ((1 << (self.bits * level)) - 1):
+                        continue
+                    bucket = self.wheels[level][
+                        (self.current >> (self.bits * level)) & self.mask]
+                    items = list(bucket)
+                    bucket.clear()
+                    for item in items:
+                        self._place(item, self.entries.pop(item)[0])
+                bucket = self.wheels[0][self.current & self.mask]
+                for item in bucket:
+                    del self.entries[item]
+                expired.extend(bucket)
+                bucket.clear()
+        return expired
+
+
+# 訪問控制
+
+ACL_READ = 1
+ACL_WRITE = 2
+ACL_ACCESS = {'read': ACL_READ, 'write': ACL_WRITE, 'readwrite': ACL_READ | ACL_WRITE}
+ACL_PLACEHOLDER = re.compile('(%[uc])')  # 訪問規則中的用戶名和客戶端 ID 佔位符
+# 替換到訪問規則中的值不能包含的字符：/ 會跨越層級，+、# 會與訂閱過濾器中的通配符相同
+ACL_RESERVED_CHARS = frozenset('/+#')
+
+
+def compile_topic_pattern(pattern, substitutions=None):
+    """將主題模式轉換為正則表達式，`+` 匹配一個層級，`#` 匹配剩餘的零個或多個層級
+
+    substitutions 為 {佔位符: 值}（如 %u、%c），先按層級拆分模式再替換，
+    替換的值只按字面匹配，其中的 `+`、`#` 不會成為通配符。
+    """
+    levels = []
+    for level in pattern.split('/'):
+        if level == '#':
+            # a/# 同時匹配 a 本身
+            return '/'.join(levels) + '(?:/.*)?' if levels else '.*'
+        if level == '+':
+            # 不匹配 #：規則 a/+ 允許訂閱 a/+ 但不允許訂閱 a/#
+            levels.append('[^/#]*')
+        elif substitutions:
+            levels.append(''.join(
+                re.escape(substitutions.get(part, part))
+                for part in ACL_PLACEHOLDER.split(level)))
+        else:
+            levels.append(re.escape(level))
+    return '/'.join(levels)
+
+
+class TopicACL:
+    """編譯後的主題訪問控制規則
+
+    規則為 (主題模式, 訪問類型, 是否允許)，按順序匹配，第一條匹配的規則
+    決定結果，沒有規則匹配時拒絕。每種訪問類型的規則合併為一個正則表達式，
+    判斷結果按主題緩存，重複的主題只需一次字典查找。訂閱時以主題過濾器
+    本身作為主題檢查，過濾器中的 `+`、`#` 只能被規則中的通配符匹配。
+    """
+
+    CACHE_SIZE = 10000
+
+    def __init__(self, rules, substitutions=None):
+        self.matchers = {}
+        self.cache = {}
+        for access in (ACL_READ, ACL_WRITE):
+            selected = [(pattern, allow) for pattern, bits, allow in rules if bits & access]
+            regex = None
+            if selected:
+                # 每條規則一個捕獲組，匹配後通過 lastindex 找到第一條完整匹配的規則
+                regex = re.compile('|'.join(
+                    f"({compile_topic_pattern(pattern, substitutions)})"
+                    for pattern, _ in selected))
+            self.matchers[access] = (regex, [allow for _, allow in selected])
+            self.cache[access] = {}
+
+    def allowed(self, topic, access):
+        """檢查是否允許以指定方式訪問主題"""
+        cache = self.cache[access]
+        decision = cache.get(topic)
+        if decision is None:
+            regex, actions = self.matchers[access]
+            match = regex.fullmatch(topic) if regex else None
+            decision = bool(match) and actions[match.lastindex - 1]
+            if len(cache) >= self.CACHE_SIZE:
+                cache.clear()
+            cache[topic] = decision
+        return decision
+
+
+# 流量限制
+
+RATE_LIMIT_ACTIONS = ('throttle', 'disconnect')
+
+
+class RateLimit:
+    """按每秒消息數和每秒字節數限制客戶端的上行流量（令牌桶）
+
+    令牌以配置的速率補充，最多積累 burst 秒的量。每個報文扣除相應的令牌，
+    餘額可以為負：throttle 時暫停讀取該連接直到餘額回到 0，由 TCP 把壓力
+    傳回客戶端；disconnect 時令牌不足即斷開連接，被拒絕的報文不扣除令牌。
+    同一用戶的連接共用一個實例，因此需要加鎖。
+    """
+
+    def __init__(self, messages_per_second=0, bytes_per_second=0, burst=1.0,
+                 action='throttle'):
+        self.rates = (messages_per_second, bytes_per_second)
+        self.capacity = tuple(rate * burst for rate in self.rates)
+        self.tokens = list(self.capacity)
+        self.updated = time.monotonic()
+        self.action = action if action in RATE_LIMIT_ACTIONS else 'throttle'
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """按配置創建，未設置任何速率時返回 None"""
+        if not config:
+            return None
+        messages = config.get('messages_per_second', 0)
+        size = config.get('bytes_per_second', 0)
+        if not messages and not size:
+            return None
+        return cls(messages, size, config.get('burst', 1.0),
+                   config.get('action', 'throttle'))
+
+    def charge(self, messages, size, now):
+        """扣除一個報文的令牌，返回 (是否超限, 需要暫停讀取的秒數)"""
+        with self.lock:
+            elapsed = now - self.updated
+            self.updated = now
+            exceeded = False
+            for index, amount in enumerate((messages, size)):
+                rate = self.rates[index]
+                if not rate:
+                    continue
+                tokens = min(self.capacity[index], self.tokens[index] + elapsed * rate)
+                self.tokens[index] = tokens
+                # 單個報文超過桶容量時，桶滿即可通過
+                if tokens < min(amount, self.capacity[index]):
+                    exceeded = True
+            if exceeded and self.action == 'disconnect':
+                return True, 0.0
+            wait = 0.0
+            for index, amount in enumerate((messages, size)):
+                rate = self.rates[index]
+                if not rate:
+                    continue
+                self.tokens[index] -= amount
+                if self.tokens[index] < 0:
+                    wait = max(wait, -self.tokens[index] / rate)
+            return exceeded, wait
+
+
+# 訂閱索引
+
+
+class SnapshotMap:
+    """只由一個寫入方修改、可被多個線程無鎖讀取的字典
+
+    寫入方在鎖內原地修改並遞增版本號；讀取方通過 view() 取得只讀快照，
+    快照按版本號緩存，內容不變時所有讀取方共用同一份，
+    修改後第一次讀取時才重新複製。寫入的耗時與字典大小無關。
+    """
+    __slots__ = ('data', 'version', 'cached')
+
+    def __init__(self):
+        self.data = {}
+        self.version = 0
+        self.cached = (0, {})  # (版本號, 快照)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def set(self, key, value):
+        self.data[key] = value
+        self.version += 1
+
+    def pop(self, key):
+        """刪除鍵，返回鍵是否存在"""
+        if key not in self.data:
+            return False
+        del self.data[key]
+        self.version += 1
+        return True
+
+    def view(self):
+        """返回只讀快照，調用方不得修改"""
+        # 先讀版本號再複製：複製結果至少與該版本一樣新，不會把舊內容標成新版本
+        version = self.version
+        cached = self.cached
+        if cached[0] != version:
+            cached = self.cached = (version, self.data.copy())
+        return cached[1]
+
+
+class TrieNode:
+    """訂閱樹節點"""
+    __slots__ = ('children', 'subscribers')
+
+    def __init__(self):
+        self.children = {}                # 主題層級 -> TrieNode，只做單個鍵的增刪
+        self.subscribers = SnapshotMap()  # client_id -> qos
+
+
+class SubscriptionTrie:
+    """按主題層級組織的訂閱樹
+
+    每個節點對應主題過濾器的一個層級，`+` 和 `#` 作為普通子節點存儲。
+    查找發布主題的訂閱者時只沿匹配的分支向下，耗時與主題深度相關，
+    與訂閱總數無關。
+
+    增刪訂閱由一把寫鎖串行化，新分支建好後才掛到樹上；match 不加鎖，
+    只讀取各節點訂閱者表的快照，發布線程之間沒有競爭，
+    也不會看到修改到一半的數據。
+    """
+
+    def __init__(self):
+        self.root = TrieNode()
+        self.lock = threading.Lock()  # 寫鎖，只有增刪訂閱時使用
+
+    def add(self, topic_filter, client_id, qos=0):
+        """添加訂閱"""
+        levels = topic_filter.split('/')
+        with self.lock:
+            node = self.root
+            for index, level in enumerate(levels):
+                child = node.children.get(level)
+                if child is None:
+                    # 缺少的分支先完整建好，再一次性掛到樹上
+                    branch = TrieNode()
+                    tail = branch
+                    for rest in levels[index + 1:]:
+                        tail.children[rest] = TrieNode()
+                        tail = tail.children[rest]
+                    tail.subscribers.set(client_id, qos)
+                    node.children[level] = branch
+                    return
+                node = child
+            node.subscribers.set(client_id, qos)
+
+    def remove(self, topic_filter, client_id):
+        """移除訂閱，並清理不再使用的節點"""
+        with self.lock:
+            path = []
+            node = self.root
+            for level in topic_filter.split('/'):
+                child = node.children.get(level)
+                if child is None:
+                    return False
+                path.append((node, level))
+                node = child
+            if not node.subscribers.pop(client_id):
+                return False
+
+            # 從葉子向上刪除空節點
+            for parent, level in reversed(path):
+                child = parent.children[level]
+                if child.subscribers or child.children:
+                    break
+                del parent.children[level]
+            return True
+
+    def match(self, topic):
+        """返回匹配發布主題的訂閱者 {client_id: qos}
+
+        以 `$` 開頭的主題（例如 $SYS/...）不匹配首層為通配符的過濾器。
+        """
+        result = {}
+        levels = topic.split('/')
+        nodes = [self.root]
+        if topic.startswith('$'):
+            child = self.root.children.get(levels[0])
+            if child is None:
+                return result
+            nodes = [child]
+            levels = levels[1:]
+        for level in levels:
+            next_nodes = []
+            for node in nodes:
+                children = node.children
+                # `#` 匹配當前層級及其以下的所有層級
+                multi = children.get('#')
+                if multi is not None:
+                    self._collect(result, multi)
+                child = children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+                single = children.get('+')
+                if single is not None:
+                    next_nodes.append(single)
+            if not next_nodes:
+                return result
+            nodes = next_nodes
+
+        for node in nodes:
+            self._collect(result, node)
+            # a/# 同時匹配 a 本身
+            multi = node.children.get('#')
+            if multi is not None:
+                self._collect(result, multi)
+        return result
+
+    @staticmethod
+    def _collect(result, node):
+        """合併節點的訂閱者，同一客戶端取最高 QoS"""
+        for client_id, qos in node.subscribers.view().items():
+            if result.get(client_id, -1) < qos:
+                result[client_id] = qos
+
+
+# 共享訂閱
+
+SHARE_PREFIX = '$share/'
+
+
+def parse_shared_filter(topic):
+    """拆分 $share/<組名>/<過濾器>，返回 (組名, 過濾器)；普通訂閱的組名為 None
+
+    組名為空或包含通配符、缺少過濾器時拋出 ValueError。
+    """
+    if not topic.startswith(SHARE_PREFIX):
+        return None, topic
+    parts = topic.split('/', 2)
+    if len(parts) < 3 or not parts[1] or not parts[2] or '+' in parts[1] or '#' in parts[1]:
+        raise ValueError(f"無效的共享訂閱：{topic}")
+    return parts[1], parts[2]
+
+
+class SharedGroup:
+    """共享訂閱組，每條匹配的消息只投遞給組內的一個成員
+
+    組本身作為一個訂閱者放入訂閱樹，投遞時再由選擇策略決定成員。
+    """
+
+    def __init__(self, name, topic_filter):
+        self.name = name
+        self.topic_filter = topic_filter
+        self.key = f"{SHARE_PREFIX}{name}/{topic_filter}"  # 訂閱時使用的完整主題
+        self.members = SnapshotMap()  # client_id -> qos
+        self.cursor = 0  # 輪詢位置
+
+    def __repr__(self):
+        return self.key
+
+
+# 共享訂閱成員選擇策略：strategy(組, [(client_id, 連接, qos)], 主題) -> 選中的成員
+
+
+def pick_round_robin(group, members, topic):
+    """依次輪流選擇成員"""
+    group.cursor = (group.cursor + 1) % len(members)
+    return members[group.cursor]
+
+
+def pick_least_queue(group, members, topic):
+    """選擇外發隊列最短的成員，隊列深度相同時輪流選擇"""
+    group.cursor = (group.cursor + 1) % len(members)
+    rotated = members[group.cursor:] + members[:group.cursor]
+    return min(rotated, key=lambda member: member[1].queue_depth())
+
+
+def pick_sticky(group, members, topic):
+    """按主題哈希選擇成員，同一主題的消息由同一成員處理（成員變化時重新分配）"""
+    return members[zlib.crc32(topic.encode('utf-8')) % len(members)]
+
+
+SHARE_STRATEGIES = {
+    'round_robin': pick_round_robin,
+    'least_queue': pick_least_queue,
+    'sticky': pick_sticky,
+}
+
+
+# 保留消息
+
+
+class RetainedNode:
+    """保留消息樹節點"""
+    __slots__ = ('children', 'topic')
+
+    def __init__(self):
+        self.children = {}  # 主題層級 -> RetainedNode
+        self.topic = None   # 該節點上有保留消息時為完整主題
+
+
+class RetainedStore:
+    """按主題保存的保留消息
+
+    消息按主題層級建立索引，帶通配符的訂閱只遍歷匹配的分支；
+    總大小超過上限時按最近最少使用的順序淘汰。
+    """
+
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes  # 0 表示不限制
+        self.messages = OrderedDict()  # topic -> (payload, qos)，按最近使用排序
+        self.root = RetainedNode()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.messages)
+
+    @staticmethod
+    def entry_size(topic, payload):
+        return len(topic) + len(payload)
+
+    def set(self, topic, payload, qos=0):
+        """保存保留消息，空消息表示刪除該主題的保留消息"""
+        with self.lock:
+            self._discard(topic)
+            if not payload:
+                return
+            payload = bytes(payload)  # 不再引用接收緩衝區
+            self.messages[topic] = (payload, qos)
+            self.size += self.entry_size(topic, payload)
+            node = self.root
+            for level in topic.split('/'):
+                child = node.children.get(level)
+                if child is None:
+                    child = node.children[level] = RetainedNode()
+                node = child
+            node.topic = topic
+
+            # 超出內存上限時淘汰最久未使用的消息
+            while self.max_bytes and self.size > self.max_bytes and len(self.messages) > 1:
+                oldest = next(iter(self.messages))
+                self._discard(oldest)
+                logger.debug(f"[保留] 超出內存上限，淘汰主題 '{oldest}' 的保留消息")
+
+    def _discard(self, topic):
+        """刪除保留消息並清理空節點（需持有鎖）"""
+        entry = self.messages.pop(topic, None)
+        if entry is None:
+            return
+        self.size -= self.entry_size(topic, entry[0])
+        path = []
+        node = self.root
+        for level in topic.split('/'):
+            path.append((node, level))
+            node = node.children[level]
+        node.topic = None
+        for parent, level in reversed(path):
+            child = parent.children[level]
+            if child.topic is not None or child.children:
+                break
+            del parent.children[level]
+
+    def match(self, topic_filter):
+        """返回匹配訂閱主題過濾器的所有保留消息 [(topic, payload, qos)]"""
+        with self.lock:
+            topics = []
+            self._walk(self.root, topic_filter.split('/'), 0, topics)
+            result = []
+            for topic in topics:
+                payload, qos = self.messages[topic]
+                self.messages.move_to_end(topic)
+                result.append((topic, payload, qos))
+            return result
+
+    def _walk(self, node, levels, index, topics):
+        """沿匹配過濾器的分支收集保留消息的主題"""
+        if index == len(levels):
+            if node.topic is not None:
+                topics.append(node.topic)
+            return
+        level = levels[index]
+        if level == '#':
+            if index == 0:
+                # 首層通配符不匹配以 `$` 開頭的主題
+                for key, child in node.children.items():
+                    if not key.startswith('$'):
+                        self._collect(child, topics)
+            else:
+                self._collect(node, topics)
+        elif level == '+':
+            for key, child in node.children.items():
+                if index == 0 and key.startswith('$'):
+                    continue
+                self._walk(child, levels, index + 1, topics)
+        else:
+            child = node.children.get(level)
+            if child is not None:
+                self._walk(child, levels, index + 1, topics)
+
+    def _collect(self, node, topics):
+        """收集節點及其所有子節點上的保留消息主題"""
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.topic is not None:
+                topics.append(node.topic)
+            stack.extend(node.children.values())
+
+
+# 持久會話
+
+
+class PersistentSession:
+    """clean session = 0 的客戶端會話
+
+    訂閱保存在 session.json 中；客戶端離線期間的消息追加寫入分段日誌
+    （NNNNNNNN.seg），重新連接時通過 mmap 讀回並投遞。讀取位置只在內存中
+    推進，QoS 1 消息收到 PUBACK 後才推進確認位置並記錄到 cursor 文件，
+    確認位置之前的分段才會被刪除；連接斷開時讀取位置退回確認位置，
+    未確認的消息在下次連接時帶 DUP 標誌重發。
+    """
+
+    RECORD = struct.Struct('!IBH')  # 消息長度, 標誌（QoS 和 DUP）, 主題長度
+    FLAG_DUP = 0x80
+
+    def __init__(self, directory, client_id, segment_bytes):
+        self.directory = directory
+        self.client_id = client_id
+        self.segment_bytes = segment_bytes
+        self.username = None
+        self.subscriptions = {}  # 主題過濾器 -> QoS
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        segments = self.list_segments()
+        self.ack_pos, self.dup_pos = self.load_cursor() or ((0, 0), (0, 0))
+        if segments:
+            self.ack_pos = max(self.ack_pos, (segments[0], 0))
+        self.first_segment = segments[0] if segments else self.ack_pos[0]
+        self.read_pos = self.ack_pos
+        # 重新打開時總是寫入新的分段，避免接在上次未寫完的記錄之後；
+        # 分段全部刪除後也不能從確認位置之前重新開始編號
+        self.write_pos = max((segments[-1] + 1, 0) if segments else (0, 0),
+                             (self.ack_pos[0] + 1, 0) if self.ack_pos[1] else self.ack_pos)
+        self.outstanding = OrderedDict()  # 已讀出、未確認消息的結束位置 -> 是否已確認
+        self.generation = 0  # 每次退回讀取位置時遞增，使舊連接的確認失效
+
+    def segment_path(self, index):
+        return os.path.join(self.directory, f"{index:08d}.seg")
+
+    def segment_size(self, index):
+        try:
+            return os.path.getsize(self.segment_path(index))
+        except OSError:
+            return 0
+
+    def list_segments(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                      if name.endswith('.seg'))
+
+    def load_cursor(self):
+        """讀取 cursor 文件，返回 (確認位置, DUP 位置)"""
+        try:
+            with open(os.path.join(self.directory, 'cursor'), 'r') as f:
+                fields = [int(field) for field in f.read().split()]
+        except (OSError, ValueError):
+            return None
+        if len(fields) == 2:
+            return tuple(fields), tuple(fields)
+        if len(fields) == 4:
+            return tuple(fields[:2]), tuple(fields[2:])
+        return None
+
+    def save_cursor(self):
+        with open(os.path.join(self.directory, 'cursor'), 'w') as f:
+            f.write(f"{self.ack_pos[0]} {self.ack_pos[1]} "
+                    f"{self.dup_pos[0]} {self.dup_pos[1]}")
+
+    def save(self):
+        """保存會話信息和訂閱"""
+        with self.lock:
+            data = {
+                'client_id': self.client_id,
+                'username': self.username,
+                'subscriptions': self.subscriptions,
+            }
+            path = os.path.join(self.directory, 'session.json')
+            with open(path + '.tmp', 'w') as f:
+                json.dump(data, f)
+            os.replace(path + '.tmp', path)
+
+    def has_pending(self):
+        """是否有尚未投遞的離線消息"""
+        return self.read_pos < self.write_pos
+
+    def append(self, topic, payload, qos, dup=False):
+        """追加一條離線消息，dup 表示該消息可能已經發送過"""
+        topic_bytes = topic.encode('utf-8')
+        flags = qos | (self.FLAG_DUP if dup else 0)
+        record = self.RECORD.pack(len(payload), flags, len(topic_bytes))
+        with self.lock:
+            index, offset = self.write_pos
+            if offset >= self.segment_bytes:
+                index, offset = index + 1, 0
+            with open(self.segment_path(index), 'ab') as f:
+                f.write(record)
+                f.write(topic_bytes)
+                f.write(payload)
+            self.write_pos = (
+                index, offset + len(record) + len(topic_bytes) + len(payload))
+
+    def read_pending(self, limit):
+        """讀取最多 limit 條離線消息 [(topic, payload, qos, dup, mark)]
+
+        每條消息投遞完成（QoS 1 收到 PUBACK，QoS 0 放入外發隊列）後
+        應以 mark 調用 acknowledge。
+        """
+        messages = []
+        with self.lock:
+            while len(messages) < limit and self.read_pos < self.write_pos:
+                index, offset = self.read_pos
+                if offset < self.segment_size(index):
+                    offset = self.read_segment(index, offset, limit, messages)
+                    self.read_pos = (index, offset)
+                    if len(messages) >= limit:
+                        break
+                if index >= self.write_pos[0]:
+                    break
+                self.read_pos = (index + 1, 0)
+            generation = self.generation
+            result = []
+            for topic, payload, flags, end in messages:
+                self.outstanding[end] = False
+                dup = bool(flags & self.FLAG_DUP) or end <= self.dup_pos
+                result.append((topic, payload, flags & 0x03, dup, (generation, end)))
+        return result
+
+    def acknowledge(self, mark):
+        """確認一條已投遞的消息，推進確認位置並刪除已全部確認的分段"""
+        generation, end = mark
+        with self.lock:
+            if generation != self.generation or end not in self.outstanding:
+                return
+            self.outstanding[end] = True
+            advanced = False
+            while self.outstanding:
+                end, acked = next(iter(self.outstanding.items()))
+                if not acked:
+                    break
+                self.outstanding.popitem(last=False)
+                self.ack_pos = end
+                advanced = True
+            if not advanced:
+                return
+            if not self.outstanding and self.read_pos >= self.write_pos:
+                # 所有消息都已確認，刪除剩餘的分段，之後寫入新的分段
+                self.ack_pos = (self.write_pos[0] + 1, 0)
+                self.write_pos = self.read_pos = self.ack_pos
+            while self.first_segment < self.ack_pos[0]:
+                self.remove_segment(self.first_segment)
+                self.first_segment += 1
+            self.save_cursor()
+
+    def rewind(self):
+        """連接斷開或重新連接時，把讀取位置退回確認位置，未確認的消息之後帶 DUP 重發"""
+        with self.lock:
+            self.dup_pos = max(self.dup_pos, self.read_pos)
+            self.read_pos = self.ack_pos
+            self.outstanding.clear()
+            self.generation += 1
+            self.save_cursor()
+
+    def read_segment(self, index, offset, limit, messages):
+        """通過 mmap 從分段中讀取消息，返回新的讀取位置"""
+        with open(self.segment_path(index), 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                end = len(mm)
+                while offset + self.RECORD.size <= end and len(messages) < limit:
+                    payload_len, flags, topic_len = self.RECORD.unpack_from(mm, offset)
+                    start = offset + self.RECORD.size
+                    if start + topic_len + payload_len > end:
+                        break  # 寫入未完成的記錄
+                    topic = str(mm[start:start + topic_len], 'utf-8')
+                    start += topic_len
+                    offset = start + payload_len
+                    messages.append(
+                        (topic, mm[start:offset], flags, (index, offset)))
+        return offset
+
+    def remove_segment(self, index):
+        try:
+            os.remove(self.segment_path(index))
+        except OSError:
+            pass
+
+    def destroy(self):
+        """刪除會話的所有數據"""
+        with self.lock:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class SessionStore:
+    """管理保存在本地磁盤上的所有持久會話
+
+    directory 為 None 時在第一次創建會話時使用只屬於本實例的臨時目錄，
+    Broker 停止時刪除，同一進程中的多個 Broker 不會共用會話。
+    """
+
+    def __init__(self, directory, segment_bytes):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.temporary = directory is None
+        self.lock = threading.Lock()
+
+    def session_path(self, client_id):
+        with self.lock:
+            if self.directory is None:
+                self.directory = tempfile.mkdtemp(prefix='mqtt-sessions-')
+        # 客戶端 ID 可能包含文件名不允許的字符，使用十六進制編碼
+        return os.path.join(self.directory, client_id.encode('utf-8').hex())
+
+    def close(self):
+        """刪除臨時會話目錄"""
+        with self.lock:
+            if self.temporary and self.directory:
+                shutil.rmtree(self.directory, ignore_errors=True)
+                self.directory = None
+
+    def open(self, client_id):
+        """打開或創建客戶端的會話"""
+        return PersistentSession(
+            self.session_path(client_id), client_id, self.segment_bytes)
+
+    def load_all(self, owns=None):
+        """載入磁盤上所有的會話 {client_id: PersistentSession}
+
+        owns(client_id) 為假的會話屬於其他工作進程，不載入。
+        """
+        sessions = {}
+        if self.directory is None or not os.path.isdir(self.directory):
+            return sessions
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                with open(os.path.join(path, 'session.json'), 'r') as f:
+                    data = json.load(f)
+                if owns is not None and not owns(data['client_id']):
+                    continue
+                session = PersistentSession(
+                    path, data['client_id'], self.segment_bytes)
+                session.username = data.get('username')
+                session.subscriptions = data.get('subscriptions', {})
+                sessions[session.client_id] = session
+            except Exception as e:
+                logger.error(f"[錯誤] 無法載入會話 {path}: {e}")
+        return sessions
+
+
+# Broker 事件：通過 MQTTBroker.add_event_hook 註冊的回調會收到以下對象
+
+
+@dataclass(frozen=True)
+class ClientConnected:
+    """客戶端通過認證並完成連接"""
+    client_id: str
+    username: str
+    address: tuple
+    session_present: bool
+
+
+@dataclass(frozen=True)
+class ClientDisconnected:
+    """客戶端連接已清理，graceful 表示客戶端發送了 DISCONNECT"""
+    client_id: str
+    graceful: bool
+
+
+@dataclass(frozen=True)
+class Subscribed:
+    """客戶端訂閱了主題過濾器（包括 $share 共享訂閱）"""
+    client_id: str
+    topic: str
+    qos: int
+
+
+@dataclass(frozen=True)
+class Unsubscribed:
+    """客戶端取消了訂閱"""
+    client_id: str
+    topic: str
+
+
+@dataclass(frozen=True)
+class MessagePublished:
+    """客戶端發布的消息通過權限檢查，即將轉發給訂閱者
+
+    payload 為消息內容的副本，回調可以保存它而不受接收緩衝區重用的影響。
+    """
+    client_id: str
+    topic: str
+    payload: bytes
+    qos: int
+    retain: bool
+
+
+EVENT_TYPES = {
+    ClientConnected: 'connected',
+    ClientDisconnected: 'disconnected',
+    Subscribed: 'subscribed',
+    Unsubscribed: 'unsubscribed',
+    MessagePublished: 'published',
+}
+EVENT_QUEUE_SIZE = 10000  # 事件通道等待寫出的記錄數上限
+EVENT_BATCH = 1000  # 事件通道每批寫出的最大記錄數
+EVENT_WRITE_SIZE = getattr(select, 'PIPE_BUF', 512)  # 不超過此大小的管道寫入是原子的
+EVENT_CLIPPED_FIELDS = ('payload', 'message', 'topic', 'client_id')  # 記錄過長時依次截短的字段
+
+
+def event_record(event, payloads=False):
+    """把 Broker 事件轉換為可 JSON 序列化的字典，type 為 EVENT_TYPES 中的名稱
+
+    MessagePublished 的消息內容換成 size，payloads 為 True 時另附文本形式的內容。
+    """
+    record = dict(event.__dict__)
+    record['type'] = EVENT_TYPES[type(event)]
+    if 'payload' in record:
+        payload = record.pop('payload')
+        record['size'] = len(payload)
+        if payloads:
+            record['payload'] = str(PayloadText(payload))
+    return record
+
+
+class EventLogHandler(logging.Handler):
+    """把日誌記錄作為 {"type": "log"} 記錄寫入事件通道"""
+
+    def __init__(self, channel):
+        super().__init__()
+        self.channel = channel
+
+    def emit(self, record):
+        try:
+            self.channel.put({'type': 'log', 'level': record.levelname,
+                              'message': self.format(record)})
+        except Exception:
+            self.handleError(record)
+
+
+class EventChannel:
+    """把 Broker 事件和日誌以 JSON Lines 寫入管道或套接字的文件描述符，供其他進程讀取
+
+    實例本身就是事件回調（MQTTBroker.add_event_hook）。記錄先放入有界隊列，由後台線程
+    成批編碼寫出，讀取方跟不上時丟棄新記錄，並在下一批中附上 {"type": "events_dropped"}。
+    每次寫入不超過 PIPE_BUF 且在行邊界結束，多個工作進程共用同一管道時各行不會交錯；
+    單條記錄超過 PIPE_BUF 時截短其中的文本字段並標記 "truncated": true。
+    """
+
+    def __init__(self, fd, payloads=False, queue_size=EVENT_QUEUE_SIZE):
+        self.fd = fd
+        self.payloads = payloads
+        self.queue_size = queue_size
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0  # 多個線程累加時可能少計，只用於提示
+        self.closed = False
+        self.thread = None
+        self.encode = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+        if hasattr(os, 'register_at_fork'):
+            # 寫出線程不會被 fork 複製，隊列的鎖也可能正被其他線程持有
+            os.register_at_fork(after_in_child=self.restart)
+
+    def __call__(self, event):
+        self.put(event_record(event, self.payloads))
+
+    def log_handler(self):
+        """返回把日誌寫入本通道的處理器"""
+        return EventLogHandler(self)
+
+    def put(self, record):
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='event-channel', daemon=True)
+        self.thread.start()
+
+    def restart(self):
+        self.queue = queue.Queue(self.queue_size)
+        self.dropped = 0
+        if not self.closed:
+            self.start()
+
+    def close(self, timeout=1.0):
+        """寫出隊列中已有的記錄後停止，程序退出前調用"""
+        if self.closed or self.thread is None:
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass  # 讀取方已停止讀取，放棄剩餘記錄
+        self.thread.join(timeout)
+        self.closed = True
+
+    def run(self):
+        """後台線程：成批取出記錄並寫出，取到 None 時結束"""
+        while not self.closed:
+            records = [self.queue.get()]
+            try:
+                while len(records) < EVENT_BATCH and records[-1] is not None:
+                    records.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            stop = records[-1] is None
+            if stop:
+                records.pop()
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                records.append({'type': 'events_dropped', 'count': dropped})
+            try:
+                self.write(records)
+            except OSError:
+                self.closed = True  # 讀取方已退出，不再記錄日誌以免寫回本通道
+            if stop:
+                return
+
+    def write(self, records):
+        chunk = []
+        size = 0
+        for record in records:
+            line = self.encode_line(record)
+            if line is None:
+                self.dropped += 1
+                continue
+            if chunk and size + len(line) > EVENT_WRITE_SIZE:
+                self.write_all(b''.join(chunk))
+                chunk = []
+                size = 0
+            chunk.append(line)
+            size += len(line)
+        if chunk:
+            self.write_all(b''.join(chunk))
+
+    def encode_line(self, record):
+        """把記錄編碼為一行，超過 EVENT_WRITE_SIZE 時依次截短 EVENT_CLIPPED_FIELDS，
+        仍然過長時返回 None"""
+        line = (self.encode(record) + '\n').encode('utf-8')
+        if len(line) <= EVENT_WRITE_SIZE:
+            return line
+        record = dict(record, truncated=True)
+        for field in EVENT_CLIPPED_FIELDS:
+            value = record.get(field)
+            while isinstance(value, str) and value:
+                line = (self.encode(record) + '\n').encode('utf-8')
+                excess = len(line) - EVENT_WRITE_SIZE
+                if excess <= 0:
+                    return line
+                # 按 UTF-8 字節截短，JSON 中每個字節至少佔一個字節，截去 excess 個字節即可
+                data = value.encode('utf-8')
+                value = record[field] = data[:max(len(data) - excess, 0)].decode(
+                    'utf-8', 'ignore')
+        line = (self.encode(record) + '\n').encode('utf-8')
+        return line if len(line) <= EVENT_WRITE_SIZE else None
+
+    def write_all(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+
+
+class MQTTBroker:
+    """MQTT Broker
+
+    config 與 config.json 的結構相同，未設置的項使用 DEFAULT_CONFIG；
+    users 為 用戶名 -> {"password", "permissions", "acl", "rate_limit"}。
+    指定 users_file 時從該文件載入用戶，並在文件修改後自動重新載入。
+    創建實例不會讀取任何文件以外的全局狀態，同一進程中可以運行多個 Broker。
+    """
+
+    def __init__(self, host=None, port=None, engine=None, config=None, users=None,
+                 users_file=None):
+        self.config = config = build_config(config)
+        self.host = config['broker']['host'] if host is None else host
+        self.port = config['broker']['port'] if port is None else port  # 0 表示由系統分配
+        self.engine = engine or config['broker'].get('engine', 'thread')
+        self.recv_buffer_size = config['broker'].get('recv_buffer_size', 4096)
+        self.max_packet_size = config['mqtt'].get('max_packet_size', 0)
+        self.outbound_queue_size = config['broker'].get('outbound_queue_size', 1000)
+        # 寫出合併：報文最多等待 write_delay 秒，或積累到 write_batch_bytes 字節後一次寫出
+        self.write_delay = config['broker'].get('write_delay_ms', 0) / 1000.0
+        self.write_batch_bytes = config['broker'].get('write_batch_bytes', 65536)
+        self.overflow_policy = config['broker'].get('overflow_policy', 'drop_oldest')
+        if self.overflow_policy not in OVERFLOW_POLICIES:
+            logger.warning(
+                f"[配置] 未知的溢出策略 {self.overflow_policy}，使用 drop_oldest")
+            self.overflow_policy = 'drop_oldest'
+        self.max_inflight = config['mqtt'].get('max_inflight', 20)
+        self.retry_interval = config['mqtt'].get('retry_interval', 10)
+        self.log_payloads = config['logging'].get('payloads', False)  # 是否在日誌中輸出消息內容
+        # 流量限制：每個客戶端各自的限制，以及 users.json 中同一用戶所有連接共用的限制
+        self.client_rate_limit = config['mqtt'].get('rate_limit') or {}
+        self.user_rate_limits = {}  # 用戶名 -> RateLimit
+        self.inflight_connections = set()  # 有未確認 QoS 1 報文的連接
+        # 連接准入控制：限制同時在認證中的連接數和每秒新連接數，應對重連風暴
+        self.max_half_open = config['broker'].get('max_half_open', 256)
+        self.connect_timeout = config['broker'].get('connect_timeout', 10)
+        self.admission_policy = config['broker'].get('admission_policy', 'queue')
+        if self.admission_policy not in ADMISSION_POLICIES:
+            logger.warning(f"[配置] 未知的准入策略 {self.admission_policy}，使用 queue")
+            self.admission_policy = 'queue'
+        connects_per_second = config['broker'].get('connects_per_second', 0)
+        self.connect_rate = RateLimit(
+            connects_per_second,
+            action='disconnect' if self.admission_policy == 'refuse' else 'throttle'
+        ) if connects_per_second else None
+        self.half_open = 0  # 已接受但尚未完成 CONNECT 的連接數
+        self.refused = 0  # 拒絕的連接數，只在接受連接的線程中修改，用於限制日誌頻率
+        self.admission_cond = threading.Condition()
+        self.accepting = False  # 事件循環模式下監聽套接字是否在選擇器中
+        self.accept_resume_at = 0.0  # 事件循環模式下按新連接速率暫停接受的結束時間
+        self.keepalive_timers = TimerWheel(TICK_INTERVAL)  # 按 keepalive 到期時間排列的連接
+        self.socket = None
+        # 路由表的所有修改（連接登記、訂閱增刪）都持有這把鎖串行執行；
+        # 發布線程只讀取訂閱樹快照和單個鍵，不加鎖
+        self.routing_lock = threading.RLock()
+        self.clients = {}  # client_id -> ClientConnection
+        self.client_info = {}  # client_id -> {'username', 'connected', 'last_seen'}
+        self.topics = defaultdict(set)  # topic -> {client_id}
+        self.client_topics = defaultdict(set)  # client_id -> {topic}，斷開時只需處理自己的訂閱
+        self.acls = {}  # (用戶名, 客戶端 ID) -> TopicACL，規則不含 %c 時客戶端 ID 為 None
+        # 已驗證憑據緩存：(用戶名, 密碼哈希) -> 密碼的 HMAC，重複連接時無需再計算 PBKDF2
+        self.credential_cache = {}
+        self.credential_key = os.urandom(32)
+        # 驗證失敗的憑據：(用戶名, 密碼哈希, 密碼的 HMAC)，重複嘗試同一錯誤密碼時無需再計算 PBKDF2
+        self.failed_credentials = OrderedDict()
+        # 事件循環模式下在線程池中計算 PBKDF2（hashlib 計算時釋放 GIL），首次使用時創建
+        self.auth_threads = config['mqtt'].get('auth_threads', 2)
+        self.auth_pool = None
+        self.users_file = users_file
+        self.users_signature = self.users_file_signature()
+        if users is None:
+            users = load_users(users_file) if users_file else {}
+        self.users = users
+        self.subscriptions = SubscriptionTrie()  # 用於按發布主題查找訂閱者
+        self.shared_groups = {}  # $share/<組名>/<過濾器> -> SharedGroup
+        strategy = config['mqtt'].get('shared_subscription_strategy', 'round_robin')
+        if strategy not in SHARE_STRATEGIES:
+            logger.warning(f"[配置] 未知的共享訂閱策略 {strategy}，使用 round_robin")
+            strategy = 'round_robin'
+        self.share_strategy = SHARE_STRATEGIES[strategy]  # 可替換為自定義的選擇函數
+        self.retained = RetainedStore(
+            config['mqtt'].get('retained_max_bytes', 64 * 1024 * 1024))
+        self.session_store = SessionStore(
+            config['mqtt'].get('session_dir'),
+            config['mqtt'].get('session_segment_bytes', 1024 * 1024))
+        self.queue_qos0_offline = config['mqtt'].get('queue_qos0_offline', False)
+        self.sessions = {}  # client_id -> PersistentSession（clean session = 0 的客戶端）
+        self.replaying = set()  # 正在補發離線消息的連接
+        self.reuse_port = False  # 多進程模式下通過 SO_REUSEPORT 共享監聽端口
+        self.cluster = None  # 多進程模式下的 WorkerCluster
+        self.node_id = config['broker'].get('node_id') or socket.gethostname()
+        self.bridges = [Bridge(self, bridge_config)
+                        for bridge_config in config.get('bridges', [])]
+        self.running = False
+        self.selector = None
+        self.wakeup_sockets = None
+        self.loop_thread = None
+        self.loop_lock = threading.Lock()
+        self.writer = None  # 線程模式連接共用的 SharedWriter，首次使用時創建
+        self.pending_close = set()
+        self.pending_calls = deque()  # 其他線程交給事件循環執行的回調
+        self.event_hooks = ()  # 事件回調，整體替換，發送事件時不加鎖
+        self.pending_flush = set()
+        self.delayed_flush = {}  # 等待合併的連接 -> 寫出時間，按加入順序排列
+        self.throttled = []  # 限流暫停讀取的連接 [(恢復時間, id, 連接)]，最小堆
+        self.stats = ThreadCounters([
+            'publishes_received',       # 收到的 PUBLISH 報文數
+            'publish_frames_built',     # 構建的外發 PUBLISH 報文數
+            'messages_sent',            # 發送給訂閱者的消息數
+            'messages_dropped',         # 因外發隊列已滿而丟棄的消息數
+            'retransmits',              # QoS 1 重發次數
+            'messages_stored',          # 寫入離線會話日誌的消息數
+            'peer_forwards',            # 轉發給其他工作進程的消息數
+            'connection_handoffs',      # 轉交給負責該客戶端的工作進程的連接數
+            'bridge_messages_out',      # 經橋接發往對端的消息數
+            'bridge_messages_in',       # 經橋接從對端收到的消息數
+            'bridge_messages_dropped',  # 橋接未連接或隊列已滿時丟棄的消息數
+            'bytes_received',           # 從套接字讀取的字節數
+            'bytes_sent',               # 寫入套接字的字節數
+            'write_calls',              # 寫套接字的系統調用次數
+            'rate_limited',             # 因超過流量限制而暫停讀取的次數
+            'rate_limit_disconnects',   # 因超過流量限制而斷開的連接數
+            'connections_refused',      # 因超過准入限制而拒絕的連接數
+            'connect_timeouts',         # 未在 connect_timeout 內完成 CONNECT 的連接數
+        ])
+        # $SYS 指標
+        self.sys_interval = config['mqtt'].get('sys_interval', 10)
+        self.sys_prefix = '$SYS/broker'
+        self.started_at = time.monotonic()
+        self.last_sys = None  # (時間, 統計快照)，用於計算每秒速率
+
+    def start(self):
+        """啟動 MQTT Broker，阻塞直到 Broker 停止"""
+        self.bind()
+        self.serve()
+
+    def start_in_background(self):
+        """在調用線程中完成監聽，然後在後台線程中處理連接，返回該線程
+
+        返回時端口已可連接（port 為 0 時 self.port 是系統分配的端口），
+        調用 stop() 停止 Broker。
+        """
+        self.bind()
+        thread = threading.Thread(target=self.serve, name=f"mqtt-broker-{self.port}",
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def bind(self):
+        """監聽端口，恢復持久會話並啟動後台任務"""
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind((self.host, self.port))
+        self.port = self.socket.getsockname()[1]
+        self.socket.listen(self.config["broker"].get("max_connections", 5))
+        self.running = True
+        self.restore_sessions()
+        if self.users_file:
+            threading.Thread(target=self.watch_users, daemon=True).start()
+        for bridge in self.bridges:
+            bridge.start()
+
+        # 顯示啟動信息
+        logger.info(f"[啟動] MQTT Broker 已啟動並監聽在 {self.host}:{self.port}")
+        logger.info(f"[啟動] 連接處理引擎: {self.engine}")
+
+        # 監聽所有地址時顯示可用的 IP 地址
+        if self.host in ('', '0.0.0.0'):
+            ip_addresses = get_all_ip_addresses()
+            if ip_addresses:
+                logger.info(f"[網絡] MQTT Broker 可通過以下 IP 地址訪問:")
+                for interface, ip in ip_addresses:
+                    logger.info(f"[網絡] 接口: {interface}, IP: {ip}:{self.port}")
+            else:
+                logger.info(f"[網絡] 未發現任何網絡接口")
+
+    def serve(self):
+        """處理連接直到 Broker 停止"""
+        try:
+            if self.engine == 'selector':
+                self.serve_selector()
+            else:
+                self.serve_threads()
+        except KeyboardInterrupt:
+            logger.info("[關閉] 收到中斷信號，正在關閉 Broker...")
+        except Exception as e:
+            if self.running:
+                logger.error(f"[錯誤] 發生錯誤：{e}")
+        finally:
+            self.stop()
+
+    def serve_threads(self):
+        """線程模式：每個連接使用一個線程"""
+        threading.Thread(target=self.housekeeping, daemon=True).start()
+        while self.running:
+            if self.admission_policy == 'queue':
+                self.wait_for_admission()
+            client_socket, address = self.socket.accept()
+            admitted, wait = self.admit_connection(client_socket, address)
+            if not admitted:
+                continue
+            logger.info(f"[連接] 收到來自 {address} 的新連接")
+            client_thread = threading.Thread(
+                target=self.handle_client, args=(client_socket, address))
+            client_thread.daemon = True
+            client_thread.start()
+            if wait:
+                time.sleep(wait)  # 按新連接速率暫停接受，其餘連接留在監聽隊列中
+
+    def wait_for_admission(self):
+        """queue 策略：認證中的連接已達上限時等待名額釋放，新連接留在內核監聽隊列中"""
+        with self.admission_cond:
+            while (self.running and self.max_half_open
+                   and self.half_open >= self.max_half_open):
+                self.admission_cond.wait(TICK_INTERVAL)
+
+    def admit_connection(self, client_socket, address):
+        """新連接的准入控制，返回 (是否接受, 接受下一個連接前應等待的秒數)
+
+        接受的連接計入認證中的連接數；refuse 策略下超過上限或速率的連接
+        立即關閉，不為其創建線程或緩衝區。
+        """
+        with self.admission_cond:
+            if not self.max_half_open or self.half_open < self.max_half_open:
+                exceeded, wait = False, 0.0
+                if self.connect_rate:
+                    exceeded, wait = self.connect_rate.charge(1, 0, time.monotonic())
+                if not (exceeded and self.admission_policy == 'refuse'):
+                    self.half_open += 1
+                    return True, wait
+        self.stats.add('connections_refused')
+        self.refused += 1
+        if self.refused % 100 == 1:
+            logger.warning(
+                f"[連接] 新連接過多，拒絕來自 {address} 的連接（累計拒絕 {self.refused} 個）")
+        try:
+            client_socket.close()
+        except OSError:
+            pass
+        return False, 0.0
+
+    def release_half_open(self, conn):
+        """連接已完成 CONNECT 或已關閉，釋放其准入名額"""
+        with self.admission_cond:
+            if not conn.half_open:
+                return
+            conn.half_open = False
+            self.half_open -= 1
+            self.admission_cond.notify()
+
+    def watch_connect_timeout(self, conn):
+        """新連接需在 connect_timeout 秒內發送 CONNECT，由 keepalive 時間輪檢查"""
+        conn.half_open = True
+        if self.connect_timeout:
+            self.keepalive_timers.schedule(conn, time.monotonic() + self.connect_timeout)
+
+    def serve_selector(self):
+        """事件循環模式：單線程通過 selectors 處理所有連接"""
+        fd_limit = raise_fd_limit()
+        if fd_limit:
+            logger.info(f"[啟動] 文件描述符上限: {fd_limit}")
+
+        self.selector = selectors.DefaultSelector()
+        self.loop_thread = threading.current_thread()
+        self.socket.setblocking(False)
+        self.set_accepting(True)
+
+        # 用於從其他線程喚醒事件循環（例如停止 Broker）
+        self.wakeup_sockets = socket.socketpair()
+        for s in self.wakeup_sockets:
+            s.setblocking(False)
+        self.selector.register(
+            self.wakeup_sockets[0], selectors.EVENT_READ, 'wakeup')
+
+        try:
+            next_tick = time.monotonic() + TICK_INTERVAL
+            while self.running:
+                wake_at = next_tick
+                if self.delayed_flush:
+                    wake_at = min(wake_at, next(iter(self.delayed_flush.values())))
+                if self.throttled:
+                    wake_at = min(wake_at, self.throttled[0][0])
+                if not self.accepting and self.accept_resume_at:
+                    wake_at = min(wake_at, self.accept_resume_at)
+                events = self.selector.select(
+                    timeout=max(0, wake_at - time.monotonic()))
+                for key, mask in events:
+                    if key.data is None:
+                        self.accept_ready()
+                    elif key.data == 'wakeup':
+                        try:
+                            while self.wakeup_sockets[0].recv(4096):
+                                pass
+                        except (BlockingIOError, InterruptedError):
+                            pass
+                    else:
+                        conn = key.data
+                        if mask & selectors.EVENT_READ:
+                            self.read_ready(conn)
+                        if mask & selectors.EVENT_WRITE:
+                            conn.flush()
+                if time.monotonic() >= next_tick:
+                    self.tick()
+                    next_tick = time.monotonic() + TICK_INTERVAL
+                self.run_pending_calls()
+                self.resume_throttled()
+                self.flush_delayed()
+                self.flush_pending()
+                self.close_pending()
+                self.update_accepting()
+        finally:
+            for s in self.wakeup_sockets:
+                s.close()
+            self.selector.close()
+
+    def wakeup(self):
+        """喚醒事件循環"""
+        if self.wakeup_sockets:
+            try:
+                self.wakeup_sockets[1].send(b'\0')
+            except OSError:
+                pass
+
+    def accept_ready(self):
+        """接受所有已就緒的新連接，達到准入限制時暫停監聽"""
+        while self.accepting:
+            try:
+                client_socket, address = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            admitted, wait = self.admit_connection(client_socket, address)
+            if not admitted:
+                continue
+            logger.info(f"[連接] 收到來自 {address} 的新連接")
+            self.register_connection(client_socket, address)
+            if wait:
+                self.accept_resume_at = time.monotonic() + wait
+            self.update_accepting()
+
+    def register_connection(self, client_socket, address, data=b''):
+        """事件循環模式：開始處理一個連接，data 為其他工作進程轉交連接時已讀取的數據"""
+        client_socket.setblocking(False)
+        conn = SelectorConnection(client_socket, address, self)
+        self.selector.register(client_socket, selectors.EVENT_READ, conn)
+        self.watch_connect_timeout(conn)
+        if data:
+            conn.framer.feed(data)
+            try:
+                packets = conn.framer.packets()
+            except Exception as e:
+                logger.error(f"[錯誤] 處理客戶端 {address} 時出錯：{e}")
+                self.schedule_close(conn)
+                return
+            self.process_packets(conn, packets)
+
+    def adopt_connection(self, client_socket, data):
+        """接管其他工作進程轉交的連接，data 從客戶端的 CONNECT 報文開始"""
+        try:
+            address = client_socket.getpeername()
+        except OSError:
+            client_socket.close()
+            return
+        with self.admission_cond:
+            self.half_open += 1  # 對方已完成准入檢查，這裡不再拒絕
+        logger.info(f"[集群] 接管來自 {address} 的連接")
+        if self.engine == 'selector':
+            self.call_in_loop(lambda: self.register_connection(client_socket, address, data))
+        else:
+            client_socket.setblocking(True)
+            threading.Thread(target=self.handle_client,
+                             args=(client_socket, address, data), daemon=True).start()
+
+    def hand_off(self, conn, packets, framer):
+        """把連接轉交給 conn.handoff 號工作進程，packets 為從 CONNECT 開始尚未處理的報文
+
+        轉交成功後關閉本進程中的套接字（不調用 shutdown，連接由對方繼續使用）；
+        對方不可用時回覆 CONNACK 返回碼 3（服務不可用）。
+        """
+        data = b''.join(bytes([first_byte]) + bytes(encode_remaining_length(len(payload)))
+                        + bytes(payload) for first_byte, payload in packets)
+        data += bytes(framer.view[framer.start:framer.end])
+        owner, conn.handoff = conn.handoff, None
+        if self.cluster.transfer(owner, conn.sock, data):
+            if self.selector:
+                try:
+                    self.selector.unregister(conn.sock)
+                except (KeyError, ValueError):
+                    pass
+            conn.sock.close()
+            return
+        logger.warning(f"[集群] 無法把 {conn.address} 的連接轉交給工作進程 {owner}")
+        self.send_connack(conn, 0x03)
+
+    def update_accepting(self):
+        """queue 策略：按准入名額和新連接速率決定是否監聽新連接"""
+        if self.admission_policy != 'queue':
+            return
+        if self.accept_resume_at and self.accept_resume_at <= time.monotonic():
+            self.accept_resume_at = 0.0
+        full = self.max_half_open and self.half_open >= self.max_half_open
+        self.set_accepting(not full and not self.accept_resume_at)
+
+    def set_accepting(self, enabled):
+        """在選擇器中註冊或註銷監聽套接字，暫停時新連接留在內核監聽隊列中"""
+        if enabled == self.accepting:
+            return
+        self.accepting = enabled
+        if enabled:
+            self.selector.register(self.socket, selectors.EVENT_READ, None)
+        else:
+            self.selector.unregister(self.socket)
+
+    def get_writer(self):
+        """返回線程模式連接共用的寫線程，不支持 MSG_DONTWAIT 時返回 None"""
+        if not hasattr(socket, 'MSG_DONTWAIT'):
+            return None
+        with self.loop_lock:
+            if self.writer is None:
+                self.writer = SharedWriter()
+            return self.writer
+
+    def new_framer(self):
+        """為新連接創建報文解析器"""
+        return PacketFramer(self.recv_buffer_size, self.max_packet_size)
+
+    def read_ready(self, conn):
+        """讀取數據並處理其中所有完整的報文"""
+        try:
+            received = conn.framer.recv_from(conn.sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            logger.error(f"[錯誤] 處理客戶端 {conn.client_id} 時出錯：{e}")
+            self.schedule_close(conn)
+            return
+        if not received:
+            logger.info(f"[斷開] 客戶端連接已關閉")
+            self.schedule_close(conn)
+            return
+        self.stats.add('bytes_received', received)
+        try:
+            packets = conn.framer.packets()
+        except Exception as e:
+            logger.error(f"[錯誤] 處理客戶端 {conn.client_id} 時出錯：{e}")
+            self.schedule_close(conn)
+            return
+        self.process_packets(conn, packets)
+
+    def process_packets(self, conn, packets):
+        """依次處理報文；等待密碼驗證時暫存其餘報文，驗證完成後繼續處理"""
+        wait = 0.0
+        try:
+            for i, (first_byte, payload) in enumerate(packets):
+                if conn in self.pending_close:
+                    break
+                if conn.rate_limits:
+                    wait = self.charge_packet(conn, first_byte, len(payload))
+                    if wait is None:
+                        self.schedule_close(conn)
+                        break
+                if not self.process_packet(conn, first_byte, payload):
+                    if conn.handoff is not None:
+                        self.hand_off(conn, packets[i:], conn.framer)
+                    self.schedule_close(conn)
+                    break
+                if conn.auth_pending:
+                    conn.held_packets = packets[i + 1:]
+                    break
+        except Exception as e:
+            logger.error(f"[錯誤] 處理客戶端 {conn.client_id} 時出錯：{e}")
+            self.schedule_close(conn)
+        if wait and conn not in self.pending_close:
+            self.throttle(conn, wait)
+            conn.pause_reading(wait)
+
+    def in_loop_thread(self):
+        """當前是否在事件循環線程中"""
+        return threading.current_thread() is self.loop_thread
+
+    def call_in_loop(self, callback):
+        """從其他線程請求事件循環調用 callback()"""
+        self.pending_calls.append(callback)
+        self.wakeup()
+
+    def run_pending_calls(self):
+        calls = self.pending_calls
+        while calls:
+            callback = calls.popleft()
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"[錯誤] 事件循環回調出錯：{e}")
+
+    def schedule_close(self, conn):
+        """標記連接待關閉，在當前事件處理結束後統一清理"""
+        with self.loop_lock:
+            self.pending_close.add(conn)
+        if not self.in_loop_thread():
+            self.wakeup()
+
+    def request_flush(self, conn):
+        """標記連接有待寫出的數據，在當前事件處理結束後統一寫出"""
+        with self.loop_lock:
+            self.pending_flush.add(conn)
+        if not self.in_loop_thread():
+            self.wakeup()
+
+    def flush_pending(self):
+        """寫出所有標記連接的外發隊列"""
+        with self.loop_lock:
+            pending, self.pending_flush = self.pending_flush, set()
+        for conn in pending:
+            conn.flush()
+
+    def resume_throttled(self):
+        """恢復限流暫停已到期的連接的讀取"""
+        now = time.monotonic()
+        while self.throttled and self.throttled[0][0] <= now:
+            resume_at, _, conn = heapq.heappop(self.throttled)
+            # 正在驗證密碼的連接由 finish_connect 恢復讀取
+            if conn.resume_at == resume_at and not conn.auth_pending:
+                conn.set_reading(True)
+
+    def delay_flush(self, conn, due):
+        """連接的外發數據在等待合併，到 due 時再寫出（僅在事件循環線程中調用）"""
+        if conn not in self.delayed_flush:
+            self.delayed_flush[conn] = due
+
+    def flush_delayed(self):
+        """寫出合併延遲已到期的連接"""
+        # 延遲相同，先加入的連接先到期，只需檢查頭部
+        now = time.monotonic()
+        delayed = self.delayed_flush
+        while delayed:
+            conn, due = next(iter(delayed.items()))
+            if due > now:
+                break
+            del delayed[conn]
+            conn.flush()
+
+    def close_pending(self):
+        """關閉所有待關閉的連接"""
+        while self.pending_close:
+            with self.loop_lock:
+                conn = self.pending_close.pop()
+            if conn.closed:
+                continue
+            conn.closing = True  # 不再等待合併
+            conn.flush()  # 盡量發出剩餘報文（例如認證失敗時的 CONNACK）
+            self.delayed_flush.pop(conn, None)
+            try:
+                self.selector.unregister(conn.sock)
+            except (KeyError, ValueError):
+                pass
+            self.cleanup_client(conn)
+            conn.close()
+
+    def stop(self):
+        """停止 MQTT Broker"""
+        self.running = False
+        self.wakeup()
+        if self.cluster:
+            self.cluster.stop()
+        for bridge in self.bridges:
+            bridge.stop()
+        if self.socket:
+            try:
+                # 喚醒阻塞在 accept() 中的線程，僅 close() 在 Linux 上不會使其返回
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.socket.close()
+        active_clients = list(self.clients.keys())
+        for client_id in active_clients:
+            try:
+                conn = self.clients[client_id]
+                conn.abort()
+                conn.close()
+                logger.info(f"[關閉] 關閉客戶端 {client_id} 的連接")
+            except:
+                pass
+        if self.writer:
+            self.writer.stop()
+        if self.auth_pool:
+            self.auth_pool.shutdown(wait=False)
+        self.session_store.close()
+        logger.info("[關閉] MQTT Broker 已完全關閉")
+
+    def handle_client(self, client_socket, address, data=b''):
+        """處理客戶端連接，data 為其他工作進程轉交連接時已讀取的數據"""
+        conn = ThreadedConnection(client_socket, address, self)
+        self.watch_connect_timeout(conn)
+        framer = self.new_framer()
+        framer.feed(data)
+
+        try:
+            running = True
+            while running and self.running:
+                if data:
+                    data = b''  # 先處理轉交時附帶的數據
+                else:
+                    # 一次讀取盡可能多的數據，不完整的報文留在緩衝區
+                    received = framer.recv_from(client_socket)
+                    if not received:
+                        logger.info(f"[斷開] 客戶端連接已關閉")
+                        break  # 客戶端斷開連接
+                    self.stats.add('bytes_received', received)
+
+                # 處理不同類型的 MQTT 報文
+                wait = 0.0
+                packets = framer.packets()
+                for i, (first_byte, payload) in enumerate(packets):
+                    if conn.rate_limits:
+                        wait = self.charge_packet(conn, first_byte, len(payload))
+                        if wait is None:
+                            running = False
+                            break
+                    if not self.process_packet(conn, first_byte, payload):
+                        if conn.handoff is not None:
+                            self.hand_off(conn, packets[i:], framer)
+                        running = False
+                        break
+
+                # 超過流量限制時暫停讀取，由 TCP 讓客戶端放慢發送
+                if running and wait:
+                    self.throttle(conn, wait)
+                    time.sleep(wait)
+
+        except Exception as e:
+            if not conn.closed:
+                logger.error(f"[錯誤] 處理客戶端 {conn.client_id} 時出錯：{e}")
+        finally:
+            self.cleanup_client(conn)
+            conn.close()
+
+    def charge_packet(self, conn, first_byte, size):
+        """按連接的流量限制扣除令牌，返回需要暫停讀取的秒數，應斷開連接時返回 None"""
+        messages = 1 if first_byte & 0xF0 == PUBLISH else 0
+        now = time.monotonic()
+        wait = 0.0
+        for limit in conn.rate_limits:
+            exceeded, delay = limit.charge(messages, size, now)
+            if limit.action == 'disconnect':
+                if exceeded:
+                    self.stats.add('rate_limit_disconnects')
+                    logger.warning(f"[限流] 客戶端 {conn.client_id} 超過流量限制，斷開連接")
+                    return None
+            elif delay > wait:
+                wait = delay
+        return wait
+
+    def throttle(self, conn, wait):
+        """記錄一次限流暫停"""
+        conn.throttled += 1
+        self.stats.add('rate_limited')
+        if conn.throttled % 100 == 1:
+            logger.warning(
+                f"[限流] 客戶端 {conn.client_id} 超過流量限制，暫停讀取 {wait:.3f} 秒"
+                f"（累計 {conn.throttled} 次）")
+
+    def process_packet(self, conn, first_byte, payload):
+        """處理一個完整的 MQTT 報文，返回 False 表示應關閉連接"""
+        packet_type = first_byte & 0xF0
+        client_id = conn.client_id
+        # 只記錄時間，是否超時由時間輪到期時再檢查
+        conn.last_activity = time.monotonic()
+
+        # 處理不同類型的 MQTT 報文
+        if packet_type == CONNECT:
+            client_id, username, password, clean_session, keepalive = self.parse_connect(
+                payload)
+            if client_id and self.cluster:
+                owner = self.cluster.owner(client_id)
+                if owner != self.cluster.index:
+                    # 同一客戶端 ID 總由同一個工作進程處理，交給調用方轉交連接
+                    conn.handoff = owner
+                    return False
+            authenticated = False
+            if client_id:
+                authenticated = self.check_credentials(client_id, username, password)
+                if authenticated is None:
+                    if self.in_loop_thread():
+                        # 不在事件循環中計算 PBKDF2，完成前暫停讀取該連接
+                        self.verify_in_background(
+                            conn, client_id, username, password, clean_session, keepalive)
+                        return True
+                    authenticated = self.verify_credentials(username, password)
+            return self.accept_connect(
+                conn, client_id, username, clean_session, keepalive, authenticated)
+
+        elif packet_type == PUBLISH:
+            if not client_id:
+                logger.warning(f"[發布] 未認證客戶端嘗試發布消息")
+                return True  # 忽略未認證客戶端
+
+            qos = (first_byte >> 1) & 0x03
+            retain = bool(first_byte & 0x01)
+            if qos > 2:
+                logger.warning(f"[發布] 客戶端 {client_id} 發送了無效的 QoS 3 報文，斷開連接")
+                return False
+            topic, message, packet_id = self.parse_publish(payload, qos)
+            if topic is None:
+                return True  # 報文格式錯誤，已記錄日誌
+            if qos == 2 and packet_id in conn.qos2_received:
+                # 客戶端未收到 PUBREC 而重發，不再轉發
+                self.send_ack(conn, PUBREC, packet_id)
+                return True
+            if self.log_payloads:
+                publish_logger.info("[發布] 客戶端 %s 發布到主題 '%s': %s",
+                                    client_id, topic, PayloadText(message))
+            else:
+                publish_logger.info("[發布] 客戶端 %s 發布到主題 '%s'（%d 字節）",
+                                    client_id, topic, len(message))
+
+            # 檢查權限
+            if not conn.acl.allowed(topic, ACL_WRITE):
+                logger.warning(
+                    f"[權限] 客戶端 {client_id} 沒有發布到主題 '{topic}' 的權限")
+            else:
+                # 轉發消息給訂閱者
+                self.stats.add('publishes_received')
+                if self.event_hooks:
+                    self.emit_event(MessagePublished(client_id, topic, bytes(message), qos, retain))
+                # 向訂閱者最高以 QoS 1 投遞
+                self.route_publish(client_id, topic, message, min(qos, MAX_QOS), retain,
+                                   from_bridge=conn.is_bridge)
+
+            # MQTT 3.1.1 沒有否定確認，無權限時同樣回覆確認，避免客戶端無限重發
+            if qos == 1:
+                self.send_puback(conn, packet_id)
+            elif qos == 2:
+                # QoS 2 第一步：回覆 PUBREC，收到 PUBREL 前不再轉發相同報文標識符的重發
+                conn.qos2_received.add(packet_id)
+                self.send_ack(conn, PUBREC, packet_id)
+
+        elif packet_type == PUBACK:
+            if client_id and len(payload) >= 2:
+                conn.acknowledge((payload[0] << 8) | payload[1])
+
+        elif packet_type == PUBREL:
+            if client_id and len(payload) >= 2:
+                packet_id = (payload[0] << 8) | payload[1]
+                conn.qos2_received.discard(packet_id)
+                self.send_ack(conn, PUBCOMP, packet_id)
+
+        elif packet_type == SUBSCRIBE:
+            if not client_id:
+                logger.warning(f"[訂閱] 未認證客戶端嘗試訂閱主題")
+                return True  # 忽略未認證客戶端
+
+            packet_id, topics = self.parse_subscribe(payload)
+
+            # 訂閱主題，最高支持 QoS 1，無權限的過濾器返回 0x80
+            granted = []
+            for topic, qos in topics:
+                try:
+                    _, topic_filter = parse_shared_filter(topic)
+                except ValueError as e:
+                    logger.warning(f"[訂閱] 客戶端 {client_id} {e}")
+                    granted.append(0x80)
+                    continue
+                if not conn.acl.allowed(topic_filter, ACL_READ):
+                    logger.warning(
+                        f"[權限] 客戶端 {client_id} 沒有訂閱主題 {topic} 的權限")
+                    granted.append(0x80)
+                    continue
+                qos = min(qos, MAX_QOS)
+                self.add_subscription(client_id, topic, qos)
+                if conn.session:
+                    conn.session.subscriptions[topic] = qos
+                granted.append(qos)
+                logger.info(f"[訂閱] 客戶端 {client_id} 訂閱主題：{topic}")
+                if self.event_hooks:
+                    self.emit_event(Subscribed(client_id, topic, qos))
+
+            if conn.session:
+                conn.session.save()
+
+            # 發送訂閱確認
+            self.send_suback(conn, packet_id, granted)
+
+            # 發送匹配的保留消息，共享訂閱不發送保留消息
+            for (topic, _), qos in zip(topics, granted):
+                if qos != 0x80 and not topic.startswith(SHARE_PREFIX):
+                    self.send_retained(conn, topic, qos)
+
+        elif packet_type == UNSUBSCRIBE:
+            if not client_id:
+                logger.warning(f"[取消訂閱] 未認證客戶端嘗試取消訂閱")
+                return True  # 忽略未認證客戶端
+
+            packet_id, topics = self.parse_unsubscribe(payload)
+            if packet_id is None:
+                return True  # 報文格式錯誤，已記錄日誌
+            for topic in topics:
+                removed = self.remove_subscription(client_id, topic)
+                if conn.session:
+                    conn.session.subscriptions.pop(topic, None)
+                logger.info(f"[取消訂閱] 客戶端 {client_id} 取消訂閱主題：{topic}")
+                if removed and self.event_hooks:
+                    self.emit_event(Unsubscribed(client_id, topic))
+            if conn.session:
+                conn.session.save()
+            self.send_unsuback(conn, packet_id)
+
+        elif packet_type == PINGREQ:
+            if client_id:
+                conn.send(bytes([PINGRESP, 0]))
+
+        elif packet_type == DISCONNECT:
+            logger.info(f"[斷開] 客戶端 {client_id} 正常斷開連接")
+            conn.disconnected = True
+            return False
+
+        return True
+
+    def accept_connect(self, conn, client_id, username, clean_session, keepalive,
+                       authenticated):
+        """處理憑據檢查結果：拒絕連接，或登記客戶端並發送 CONNACK，返回 False 表示應關閉連接"""
+        if not authenticated:
+            # 認證失敗
+            logger.warning(f"[認證] 客戶端 {client_id} 認證失敗")
+            self.send_connack(conn, 0x05)  # 認證失敗
+            self.release_half_open(conn)
+            return False
+        is_bridge = self.is_bridge_user(username)
+        if client_id.startswith(BRIDGE_CLIENT_PREFIX) and not is_bridge:
+            logger.warning(
+                f"[認證] 用戶 {username} 不是橋接用戶，不能使用客戶端 ID {client_id}")
+            self.send_connack(conn, 0x02)  # 客戶端標識符不合格
+            self.release_half_open(conn)
+            return False
+        if not self.acl_identity_valid(username, client_id):
+            logger.warning(
+                f"[權限] 客戶端 {client_id} 的用戶名或客戶端 ID 含有 /、+ 或 #，"
+                f"不能代入訪問規則")
+            self.send_connack(conn, 0x02)  # 客戶端標識符不合格
+            self.release_half_open(conn)
+            return False
 
+        # 認證成功，存儲客戶端信息
+        conn.client_id = client_id
+        conn.is_bridge = is_bridge
+        conn.keepalive = keepalive
+        conn.acl = self.acl_for(username, client_id)
+        conn.rate_limits = self.rate_limits_for(username, conn.is_bridge)
+        if keepalive:
+            self.keepalive_timers.schedule(
+                conn, conn.last_activity + keepalive * KEEPALIVE_GRACE)
+        else:
+            self.keepalive_timers.cancel(conn)  # CONNECT 超時檢查
+        with self.routing_lock:
+            self.clients[client_id] = conn
+            self.client_info[client_id] = {
+                'username': username,
+                'connected': True,
+                'last_seen': time.time(),
+                'address': conn.address
+            }
+        session_present = self.attach_session(conn, username, clean_session)
 
-class MQTTBroker:
-    def __init__(self, host=HOST, port=PORT):
-        self.host = host
-        self.port = port
-        self.socket = None
-        self.clients = {}  # client_id -> socket
-        self.client_info = {}  # client_id -> {'username', 'connected', 'last_seen'}
-        self.topics = defaultdict(list)  # topic -> [client_ids]
-        self.running = False
+        # 發送連接確認
+        self.send_connack(conn, 0x00, session_present)  # 連接接受
+        self.release_half_open(conn)
+        logger.info(f"[認證] 客戶端 {client_id} (用戶: {username}) 連接成功")
+        if self.event_hooks:
+            self.emit_event(ClientConnected(client_id, username, conn.address,
+                                            session_present))
 
-    def start(self):
-        """啟動 MQTT Broker"""
-        # 獲取所有網絡接口的 IP 地址
-        ip_addresses = get_all_ip_addresses()
+        # 補發離線期間的消息
+        if conn.session and conn.session.has_pending():
+            self.replaying.add(conn)
+            self.replay_session(conn)
+        return True
 
-        # 開始監聽
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.socket.bind((self.host, self.port))
-        self.socket.listen(CONFIG["broker"].get("max_connections", 5))
-        self.running = True
+    def verify_in_background(self, conn, client_id, username, password, clean_session,
+                             keepalive):
+        """在線程池中驗證密碼，結果交回事件循環後繼續處理該連接的報文"""
+        if self.auth_pool is None:
+            self.auth_pool = ThreadPoolExecutor(
+                max_workers=max(1, self.auth_threads), thread_name_prefix='auth')
+        conn.auth_pending = True
+        conn.set_reading(False)
+        future = self.auth_pool.submit(self.verify_credentials, username, password)
 
-        # 顯示啟動信息
-        logger.info(f"[啟動] MQTT Broker 已啟動並監聽在 {self.host}:{self.port}")
+        def finish(future):
+            try:
+                authenticated = future.result()
+            except Exception as e:
+                logger.error(f"[錯誤] 驗證客戶端 {client_id} 的憑據時出錯：{e}")
+                authenticated = False
+            self.call_in_loop(lambda: self.finish_connect(
+                conn, client_id, username, clean_session, keepalive, authenticated))
 
-        # 顯示所有可用的 IP 地址
-        if ip_addresses:
-            logger.info(f"[網絡] MQTT Broker 可通過以下 IP 地址訪問:")
-            for interface, ip in ip_addresses:
-                logger.info(f"[網絡] 接口: {interface}, IP: {ip}:{self.port}")
-        else:
-            logger.info(f"[網絡] 未發現任何網絡接口")
+        future.add_done_callback(finish)
 
+    def finish_connect(self, conn, client_id, username, clean_session, keepalive,
+                       authenticated):
+        """在事件循環中完成 CONNECT，並處理驗證期間暫存的報文"""
+        conn.auth_pending = False
+        if conn.closed or conn in self.pending_close:
+            return
         try:
-            while self.running:
-                client_socket, address = self.socket.accept()
-                logger.info(f"[連接] 收到來自 {address} 的新連接")
-                client_thread = threading.Thread(
-                    target=self.handle_client, args=(client_socket, address))
-                client_thread.daemon = True
-                client_thread.start()
-        except KeyboardInterrupt:
-            logger.info("[關閉] 收到中斷信號，正在關閉 Broker...")
+            accepted = self.accept_connect(
+                conn, client_id, username, clean_session, keepalive, authenticated)
         except Exception as e:
-            logger.error(f"[錯誤] 發生錯誤：{e}")
-        finally:
-            self.stop()
+            logger.error(f"[錯誤] 處理客戶端 {client_id} 時出錯：{e}")
+            accepted = False
+        if not accepted:
+            self.schedule_close(conn)
+            return
+        held, conn.held_packets = conn.held_packets, ()
+        self.process_packets(conn, held)
+        if conn.resume_at <= time.monotonic():
+            conn.set_reading(True)
 
-    def stop(self):
-        """停止 MQTT Broker"""
-        self.running = False
-        if self.socket:
-            self.socket.close()
-        active_clients = list(self.clients.keys())
-        for client_id in active_clients:
-            try:
-                self.clients[client_id].close()
-                logger.info(f"[關閉] 關閉客戶端 {client_id} 的連接")
-            except:
-                pass
-        logger.info("[關閉] MQTT Broker 已完全關閉")
+    def cleanup_client(self, conn):
+        """清理客戶端資源"""
+        client_id = conn.client_id
+        self.keepalive_timers.cancel(conn)
+        self.release_half_open(conn)
+        if not client_id:
+            return
+        with self.routing_lock:
+            # 同一 client_id 重新連接後，舊連接不應清除新連接的資源
+            if self.clients.get(client_id) is not conn:
+                return
+            del self.clients[client_id]
+            if client_id in self.client_info:
+                self.client_info[client_id]['connected'] = False
+            self.replaying.discard(conn)
 
-    def handle_client(self, client_socket, address):
-        """處理客戶端連接"""
-        client_id = None
+            if conn.session:
+                # 持久會話保留訂閱，離線期間的消息寫入會話日誌
+                self.save_unacked(conn)
+                logger.info(f"[清理] 客戶端 {client_id} 已離線，保留其持久會話")
+            else:
+                # 從主題訂閱列表中移除
+                self.remove_subscriptions(client_id)
+                logger.info(f"[清理] 已移除客戶端 {client_id} 的所有資源")
 
-        try:
-            while self.running:
-                # 解析 MQTT 報文頭
-                packet_type_byte = client_socket.recv(1)
-                if not packet_type_byte:
-                    logger.info(f"[斷開] 客戶端連接已關閉")
-                    break  # 客戶端斷開連接
+        if self.event_hooks:
+            self.emit_event(ClientDisconnected(client_id, conn.disconnected))
 
-                packet_type = packet_type_byte[0] & 0xF0
+    def add_event_hook(self, hook):
+        """註冊事件回調 hook(event)，event 為 ClientConnected、ClientDisconnected、
+        Subscribed、Unsubscribed 或 MessagePublished
 
-                # 解析剩餘長度
-                multiplier = 1
-                remaining_length = 0
-                while True:
-                    byte = client_socket.recv(1)[0]
-                    remaining_length += (byte & 127) * multiplier
-                    multiplier *= 128
-                    if (byte & 128) == 0:
-                        break
+        回調在處理該報文的線程中同步調用，應盡快返回（例如放入隊列）；
+        回調拋出的異常會被記錄，不影響報文處理。
+        """
+        self.event_hooks = self.event_hooks + (hook,)
 
-                # 讀取完整的報文
-                payload = b''
-                if remaining_length > 0:
-                    payload = client_socket.recv(remaining_length)
+    def remove_event_hook(self, hook):
+        """移除事件回調"""
+        self.event_hooks = tuple(h for h in self.event_hooks if h is not hook)
 
-                # 處理不同類型的 MQTT 報文
-                if packet_type == CONNECT:
-                    client_id, username, password = self.parse_connect(payload)
-                    if not client_id or not self.authenticate(client_id, username, password):
-                        # 認證失敗
-                        logger.warning(f"[認證] 客戶端 {client_id} 認證失敗")
-                        self.send_connack(client_socket, 0x05)  # 認證失敗
-                        break
+    def emit_event(self, event):
+        """把事件交給所有回調"""
+        for hook in self.event_hooks:
+            try:
+                hook(event)
+            except Exception as e:
+                logger.error(f"[錯誤] 事件回調處理 {type(event).__name__} 時出錯：{e}")
 
-                    # 認證成功，存儲客戶端信息
-                    self.clients[client_id] = client_socket
-                    self.client_info[client_id] = {
-                        'username': username,
-                        'connected': True,
-                        'last_seen': time.time(),
-                        'address': address
-                    }
+    def add_subscription(self, client_id, topic, qos):
+        """添加一個訂閱，topic 為 $share/<組名>/<過濾器> 時加入共享訂閱組"""
+        group_name, topic_filter = parse_shared_filter(topic)
+        with self.routing_lock:
+            clients = self.topics[topic]
+            if not clients and self.cluster:
+                self.cluster.announce(SUBSCRIBE, topic)
+            clients.add(client_id)
+            self.client_topics[client_id].add(topic)
+            if group_name is None:
+                self.subscriptions.add(topic, client_id, qos)
+                return
+            group = self.shared_groups.get(topic)
+            if group is None:
+                group = self.shared_groups[topic] = SharedGroup(group_name, topic_filter)
+                self.subscriptions.add(topic_filter, group)
+            group.members.set(client_id, qos)
 
-                    # 發送連接確認
-                    self.send_connack(client_socket, 0x00)  # 連接接受
-                    logger.info(f"[認證] 客戶端 {client_id} (用戶: {username}) 連接成功")
+    def remove_subscription(self, client_id, topic):
+        """移除一個訂閱，返回訂閱是否存在"""
+        with self.routing_lock:
+            clients = self.topics.get(topic)
+            if not clients or client_id not in clients:
+                return False
+            clients.discard(client_id)
+            client_topics = self.client_topics.get(client_id)
+            if client_topics:
+                client_topics.discard(topic)
+                if not client_topics:
+                    del self.client_topics[client_id]
+            group_name, topic_filter = parse_shared_filter(topic)
+            if group_name is None:
+                self.subscriptions.remove(topic, client_id)
+            else:
+                group = self.shared_groups.get(topic)
+                if group:
+                    group.members.pop(client_id)
+                    if not group.members:
+                        del self.shared_groups[topic]
+                        self.subscriptions.remove(topic_filter, group)
+            if not clients:
+                del self.topics[topic]
+                if self.cluster:
+                    self.cluster.announce(UNSUBSCRIBE, topic)
+            return True
 
-                elif packet_type == PUBLISH:
-                    if not client_id:
-                        logger.warning(f"[發布] 未認證客戶端嘗試發布消息")
-                        continue  # 忽略未認證客戶端
+    def remove_subscriptions(self, client_id):
+        """移除客戶端的所有訂閱，耗時只與該客戶端自己的訂閱數有關"""
+        with self.routing_lock:
+            for topic in list(self.client_topics.get(client_id, ())):
+                self.remove_subscription(client_id, topic)
 
-                    topic, message = self.parse_publish(payload)
-                    logger.info(
-                        f"[發布] 客戶端 {client_id} 發布到主題 '{topic}': {message}")
+    def subscription_snapshot(self):
+        """返回當前訂閱的副本 {topic: 訂閱者數}，供狀態顯示和集群同步使用"""
+        with self.routing_lock:
+            return {topic: len(clients) for topic, clients in self.topics.items()}
 
-                    # 檢查權限
-                    username = self.client_info[client_id]['username']
-                    if not self.check_permission(username, "write"):
-                        logger.warning(
-                            f"[權限] 客戶端 {client_id} (用戶: {username}) 沒有發布權限")
-                        continue
+    def pick_shared_member(self, group, topic, sender_id, from_bridge):
+        """按選擇策略從共享訂閱組中選出一個成員，返回 (client_id, qos)
 
-                    # 轉發消息給訂閱者
-                    self.broadcast_message(client_id, topic, message)
-
-                elif packet_type == SUBSCRIBE:
-                    if not client_id:
-                        logger.warning(f"[訂閱] 未認證客戶端嘗試訂閱主題")
-                        continue  # 忽略未認證客戶端
-
-                    # 檢查權限
-                    username = self.client_info[client_id]['username']
-                    if not self.check_permission(username, "read"):
-                        logger.warning(
-                            f"[權限] 客戶端 {client_id} (用戶: {username}) 沒有訂閱權限")
-                        self.send_suback(client_socket, 0, [
-                                         0x80] * 10)  # 拒絕所有訂閱
-                        continue
+        只在在線、有讀取權限的成員中選擇；沒有在線成員時交給一個有持久會話的
+        成員，消息寫入其離線日誌；都沒有時返回 (None, 0)。
+        """
+        snapshot = group.members.view()
+        members = []
+        for client_id, qos in snapshot.items():
+            conn = self.clients.get(client_id)
+            if conn is None or conn.closing or client_id == sender_id:
+                continue
+            if from_bridge and conn.is_bridge:
+                continue
+            if not conn.acl.allowed(topic, ACL_READ):
+                continue
+            members.append((client_id, conn, qos))
+        if members:
+            client_id, _, qos = self.share_strategy(group, members, topic)
+            return client_id, qos
+        for client_id, qos in snapshot.items():
+            if client_id != sender_id and client_id in self.sessions:
+                return client_id, qos
+        return None, 0
 
-                    packet_id, topics = self.parse_subscribe(payload)
+    def route_publish(self, sender_id, topic, message, qos=0, retain=False,
+                      from_peer=False, from_bridge=False, shares=frozenset()):
+        """處理一條發布：保存保留消息、投遞本地訂閱者，並按需轉發到其他工作進程和橋接
 
-                    # 訂閱主題
-                    for topic, qos in topics:
-                        if client_id not in self.topics[topic]:
-                            self.topics[topic].append(client_id)
-                        logger.info(f"[訂閱] 客戶端 {client_id} 訂閱主題：{topic}")
+        from_peer 表示消息來自其他工作進程，from_bridge 表示消息經橋接而來；
+        這兩類消息都不再轉發出去，避免重複和環路。多進程模式下共享訂閱組的
+        成員可能分佈在多個工作進程上，由收到發布的進程為每個組選定一個進程投遞；
+        shares 為來自其他工作進程的消息中指定由本進程投遞的組。
+        """
+        if retain:
+            self.retained.set(topic, message, qos)
+        if from_peer:
+            self.broadcast_message(sender_id, topic, message, qos, from_bridge,
+                                   shares.__contains__)
+            return
+        assigned = {}
+        share_filter = None
+        if self.cluster:
+            skipped, assigned = self.cluster.assign_shares(topic)
+            if skipped:
+                share_filter = lambda key: key not in skipped
+        self.broadcast_message(sender_id, topic, message, qos, from_bridge, share_filter)
+        if self.cluster:
+            self.cluster.forward(topic, message, qos, retain, from_bridge, assigned)
+        if self.bridges and not from_bridge:
+            frames = {}
+            for bridge in self.bridges:
+                bridge.forward(topic, message, qos, retain, frames)
 
-                    # 發送訂閱確認
-                    self.send_suback(client_socket, packet_id,
-                                     [0] * len(topics))
+    def route_from_peer(self, first_byte, payload, shares=frozenset()):
+        """投遞其他工作進程轉發來的消息，只發給本地訂閱者和 shares 中的共享訂閱組"""
+        qos = (first_byte >> 1) & 0x03
+        topic, message, _ = self.parse_publish(payload, qos)
+        if topic is None:
+            return
+        # 工作進程之間用 DUP 標誌表示消息經橋接而來
+        self.route_publish(None, topic, message, qos, bool(first_byte & 0x01),
+                           from_peer=True, from_bridge=bool(first_byte & 0x08),
+                           shares=shares)
 
-                elif packet_type == DISCONNECT:
-                    logger.info(f"[斷開] 客戶端 {client_id} 正常斷開連接")
-                    break
+    def restore_sessions(self):
+        """啟動時載入磁盤上的持久會話並恢復其訂閱"""
+        owns = None
+        if self.cluster:
+            owns = lambda client_id: self.cluster.owner(client_id) == self.cluster.index
+        self.sessions = self.session_store.load_all(owns)
+        for client_id, session in self.sessions.items():
+            for topic, qos in session.subscriptions.items():
+                self.add_subscription(client_id, topic, qos)
+        if self.sessions:
+            logger.info(f"[會話] 已恢復 {len(self.sessions)} 個持久會話")
 
-        except Exception as e:
-            logger.error(f"[錯誤] 處理客戶端 {client_id} 時出錯：{e}")
-        finally:
-            # 清理客戶端資源
-            if client_id and client_id in self.clients:
-                del self.clients[client_id]
-                if client_id in self.client_info:
-                    self.client_info[client_id]['connected'] = False
+    def attach_session(self, conn, username, clean_session):
+        """按 clean session 標誌處理客戶端會話，返回是否存在已有會話"""
+        client_id = conn.client_id
+        session = self.sessions.get(client_id)
+        if clean_session:
+            if session:
+                # 丟棄舊的持久會話及其訂閱
+                del self.sessions[client_id]
+                self.remove_subscriptions(client_id)
+                session.destroy()
+            return False
 
-                # 從主題訂閱列表中移除
-                for topic in self.topics:
-                    if client_id in self.topics[topic]:
-                        self.topics[topic].remove(client_id)
+        session_present = session is not None
+        if session is None:
+            session = self.sessions[client_id] = self.session_store.open(client_id)
+        else:
+            # 上一個連接未確認的消息從確認位置重新補發
+            session.rewind()
+        session.username = username
+        session.save()
+        conn.session = session
+        return session_present
 
-                logger.info(f"[清理] 已移除客戶端 {client_id} 的所有資源")
+    def save_unacked(self, conn):
+        """連接斷開時把未確認的 QoS 1 消息寫回會話日誌，下次連接時重發
 
-            try:
-                client_socket.close()
-            except:
-                pass
+        來自會話日誌的消息只需退回讀取位置；直接投遞的消息追加到日誌末尾，
+        它們總是晚於日誌中的消息投遞，因此順序不變。
+        """
+        session = conn.session
+        try:
+            session.rewind()
+            for frame, dup in conn.take_unacked():
+                qos = (frame[0] >> 1) & 0x03
+                _, _, header_len = parse_fixed_header(frame)
+                topic, message, _ = self.parse_publish(memoryview(frame)[header_len:], qos)
+                if topic is not None:
+                    session.append(topic, message, qos, dup)
+                    self.stats.add('messages_stored')
+        except OSError as e:
+            # 例如 Broker 停止後臨時會話目錄已被刪除
+            logger.error(f"[錯誤] 無法保存客戶端 {conn.client_id} 未確認的消息：{e}")
+
+    def replay_session(self, conn):
+        """在外發隊列有空間時補發會話日誌中的離線消息"""
+        session = conn.session
+        room = conn.queue_limit - conn.queue_depth()
+        if room > 0:
+            for topic, payload, qos, dup, mark in session.read_pending(room):
+                frame = self.build_publish(topic, payload, qos, dup=dup)
+                delivered = conn.deliver(frame, qos, mark)
+                # QoS 0 消息放入隊列即算完成；連接關閉時保留，下次連接重發
+                if qos == 0 or (not delivered and not conn.closing):
+                    session.acknowledge(mark)
+        if not session.has_pending():
+            self.replaying.discard(conn)
 
     def parse_connect(self, payload):
-        """解析 CONNECT 報文"""
+        """解析 CONNECT 報文，返回 (客戶端 ID, 用戶名, 密碼, clean session 標誌, keepalive)"""
         try:
             # 跳過協議名稱和版本
             offset = 0
@@ -307,13 +3335,14 @@ class MQTTBroker:
             connect_flags = payload[offset]
             offset += 1
 
-            # 跳過保持連接
+            # 保持連接（秒）
+            keepalive = (payload[offset] << 8) + payload[offset+1]
             offset += 2
 
             # 獲取客戶端 ID
             client_id_len = (payload[offset] << 8) + payload[offset+1]
             offset += 2
-            client_id = payload[offset:offset+client_id_len].decode('utf-8')
+            client_id = str(payload[offset:offset+client_id_len], 'utf-8')
             offset += client_id_len
 
             # 檢查是否有用戶名
@@ -322,25 +3351,32 @@ class MQTTBroker:
             if connect_flags & 0x80:  # 用戶名標誌
                 username_len = (payload[offset] << 8) + payload[offset+1]
                 offset += 2
-                username = payload[offset:offset+username_len].decode('utf-8')
+                username = str(payload[offset:offset+username_len], 'utf-8')
                 offset += username_len
 
                 # 檢查是否有密碼
                 if connect_flags & 0x40:  # 密碼標誌
                     password_len = (payload[offset] << 8) + payload[offset+1]
                     offset += 2
-                    password = payload[offset:offset +
-                                       password_len].decode('utf-8')
+                    password = str(
+                        payload[offset:offset+password_len], 'utf-8')
 
-            return client_id, username, password
+            return client_id, username, password, bool(connect_flags & 0x02), keepalive
         except Exception as e:
             logger.error(f"[錯誤] 解析 CONNECT 時出錯：{e}")
-            return None, None, None
+            return None, None, None, True, 0
 
     def authenticate(self, client_id, username, password):
-        """驗證客戶端憑據"""
+        """驗證客戶端憑據，緩存未命中時計算 PBKDF2（約 100 毫秒）"""
+        result = self.check_credentials(client_id, username, password)
+        if result is None:
+            result = self.verify_credentials(username, password)
+        return result
+
+    def check_credentials(self, client_id, username, password):
+        """不計算 PBKDF2 的憑據檢查，返回是否通過，需要計算 PBKDF2 時返回 None"""
         # 檢查是否允許匿名連接
-        if CONFIG["mqtt"].get("allow_anonymous", False):
+        if self.config["mqtt"].get("allow_anonymous", False):
             logger.info(f"[認證] 允許匿名連接，客戶端 {client_id} 被授權")
             return True
 
@@ -350,90 +3386,286 @@ class MQTTBroker:
             return False
 
         # 檢查用戶是否存在
-        if username not in USERS:
+        user = self.users.get(username)
+        if user is None:
             logger.warning(f"[認證] 用戶 {username} 不存在")
             return False
 
-        # 檢查密碼
-        if USERS[username]["password"] != password:
+        # 檢查密碼，驗證過的憑據只需比較 HMAC
+        if password is None:
+            logger.warning(f"[認證] 用戶 {username} 密碼錯誤")
+            return False
+        token = self.credential_token(password)
+        cached = self.credential_cache.get((username, user["password"]))
+        if cached is not None and hmac.compare_digest(cached, token):
+            logger.info(f"[認證] 用戶 {username} 認證成功")
+            return True
+        if (username, user["password"], token) in self.failed_credentials:
             logger.warning(f"[認證] 用戶 {username} 密碼錯誤")
             return False
+        return None
 
+    def credential_token(self, password):
+        return hmac.new(self.credential_key, password.encode('utf-8'), 'sha256').digest()
+
+    def verify_credentials(self, username, password):
+        """計算 PBKDF2 驗證密碼並緩存結果，可以在線程池中調用"""
+        user = self.users.get(username)
+        if user is None or password is None:
+            return False
+        token = self.credential_token(password)
+        if not verify_password(password, user["password"]):
+            failed = self.failed_credentials
+            failed[(username, user["password"], token)] = True
+            if len(failed) > FAILED_CREDENTIALS_SIZE:
+                failed.popitem(last=False)
+            logger.warning(f"[認證] 用戶 {username} 密碼錯誤")
+            return False
+        self.credential_cache[(username, user["password"])] = token
         logger.info(f"[認證] 用戶 {username} 認證成功")
         return True
 
+    def is_bridge_user(self, username):
+        """用戶是否在 users.json 中標記為橋接用戶（"bridge": true）
+
+        橋接連接不受每個連接的默認流量限制，收到的消息也不再轉發給其他橋接。
+        """
+        user = self.users.get(username)
+        return bool(user and user.get("bridge"))
+
     def check_permission(self, username, permission_type):
         """檢查用戶是否有指定的權限"""
         # 如果允許匿名，則所有人都有權限
-        if CONFIG["mqtt"].get("allow_anonymous", False):
+        if self.config["mqtt"].get("allow_anonymous", False):
             return True
 
         # 檢查用戶是否存在
-        if username not in USERS:
+        if username not in self.users:
             return False
 
         # 檢查權限
-        return permission_type in USERS[username]["permissions"]
+        return permission_type in self.users[username]["permissions"]
+
+    def users_file_signature(self):
+        """用戶文件的修改時間和大小，文件不存在或未指定用戶文件時為 None"""
+        if not self.users_file:
+            return None
+        try:
+            stat = os.stat(self.users_file)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def watch_users(self):
+        """後台線程：用戶文件有變化時重新載入"""
+        while self.running:
+            time.sleep(USERS_RELOAD_INTERVAL)
+            try:
+                self.reload_users()
+            except Exception as e:
+                logger.error(f"[錯誤] 重新載入用戶文件時出錯：{e}")
 
-    def send_connack(self, client_socket, return_code):
+    def reload_users(self):
+        """用戶文件修改後重新載入，並更新憑據緩存和在線客戶端的訪問控制規則
+
+        新的用戶字典整體替換 self.users，認證和權限檢查不需要加鎖。
+        文件內容無效時保留原有用戶，下次檢查時再試。
+        """
+        signature = self.users_file_signature()
+        if signature is None or signature == self.users_signature:
+            return False
+        with open(self.users_file, 'r') as f:
+            users = parse_users(json.load(f))
+        self.users_signature = signature
+        self.users = users
+        # 密碼已修改或用戶已刪除的憑據不再有效
+        self.credential_cache = {
+            key: token for key, token in self.credential_cache.items()
+            if key[0] in users and users[key[0]]["password"] == key[1]}
+        self.failed_credentials = OrderedDict()
+        self.acls = {}
+        self.user_rate_limits = {}
+        for client_id, conn in list(self.clients.items()):
+            info = self.client_info.get(client_id)
+            if info:
+                conn.acl = self.acl_for(info['username'], client_id)
+                conn.is_bridge = self.is_bridge_user(info['username'])
+                conn.rate_limits = self.rate_limits_for(info['username'], conn.is_bridge)
+        logger.info(f"[用戶] 用戶文件已更新，重新載入 {len(users)} 個用戶")
+        return True
+
+    def acl_for(self, username, client_id):
+        """取得用戶的主題訪問控制規則，同一用戶的連接共用編譯結果和判斷緩存"""
+        user = self.users.get(username)
+        rules = user.get('acl') if user else None
+        per_client = bool(rules) and any('%c' in rule['pattern'] for rule in rules)
+        key = (username, client_id if per_client else None)
+        acl = self.acls.get(key)
+        if acl is None:
+            acl = self.acls[key] = self.compile_acl(username, client_id)
+        return acl
+
+    def rate_limits_for(self, username, is_bridge=False):
+        """取得連接適用的流量限制：mqtt.rate_limit（每個連接各一份）和用戶的 rate_limit
+
+        橋接連接匯集了對端所有發布者的消息，不受每個連接的默認限制。
+        """
+        limits = []
+        if not is_bridge:
+            limit = RateLimit.from_config(self.client_rate_limit)
+            if limit:
+                limits.append(limit)
+        user = self.users.get(username)
+        if user and user.get('rate_limit'):
+            limit = self.user_rate_limits.get(username)
+            if limit is None:
+                # 多個連接同時登錄時只保留一個實例
+                limit = self.user_rate_limits.setdefault(
+                    username, RateLimit.from_config(user['rate_limit']))
+            if limit:
+                limits.append(limit)
+        return tuple(limits)
+
+    def compile_acl(self, username, client_id):
+        """按 users.json 編譯用戶的訪問控制規則
+
+        permissions 中的 read/write 決定用戶最多能擁有的訪問類型；acl 為
+        [{"pattern": ..., "access": "read|write|readwrite", "action": "allow|deny"}]，
+        模式中的 %u、%c 替換為用戶名和客戶端 ID。未設置 acl 時不限制主題。
+        """
+        if self.config["mqtt"].get("allow_anonymous", False):
+            return TopicACL([('#', ACL_READ | ACL_WRITE, True)])
+        permitted = 0
+        if self.check_permission(username, "read"):
+            permitted |= ACL_READ
+        if self.check_permission(username, "write"):
+            permitted |= ACL_WRITE
+        rules = self.users[username].get('acl') if username in self.users else None
+        if not rules:
+            return TopicACL([('#', permitted, True)])
+        compiled = []
+        for rule in rules:
+            access = ACL_ACCESS.get(rule.get('access', 'readwrite'), 0)
+            compiled.append((rule['pattern'], access & permitted,
+                             rule.get('action', 'allow') == 'allow'))
+        return TopicACL(compiled, {'%u': username, '%c': client_id or ''})
+
+    def acl_identity_valid(self, username, client_id):
+        """檢查用戶名和客戶端 ID 能否代入訪問規則中的 %u、%c
+
+        值中含有 /、+、# 時可能匹配到其他客戶端的主題（例如客戶端 ID 為 #
+        時，規則 dev/%c 允許訂閱 dev/#），這樣的連接會被拒絕。
+        """
+        if self.config["mqtt"].get("allow_anonymous", False):
+            return True
+        user = self.users.get(username)
+        for rule in (user.get('acl') or ()) if user else ():
+            for placeholder, value in (('%u', username), ('%c', client_id)):
+                if placeholder in rule['pattern'] and not ACL_RESERVED_CHARS.isdisjoint(value or ''):
+                    return False
+        return True
+
+    def send_connack(self, conn, return_code, session_present=False):
         """發送 CONNACK 報文"""
         packet = bytearray()
         packet.append(CONNACK)  # 報文類型
         packet.append(2)        # 剩餘長度
-        packet.append(0)        # 連接確認標誌
+        packet.append(1 if session_present else 0)  # 連接確認標誌
         packet.append(return_code)  # 返回碼
-        client_socket.send(packet)
+        conn.send(packet)
 
-    def parse_publish(self, payload):
-        """解析 PUBLISH 報文"""
+    def parse_publish(self, payload, qos=0):
+        """解析 PUBLISH 報文，返回 (主題, 消息內容, 報文標識符)"""
         try:
             offset = 0
 
             # 獲取主題名稱
             topic_len = (payload[offset] << 8) + payload[offset+1]
             offset += 2
-            topic = payload[offset:offset+topic_len].decode('utf-8')
+            topic = str(payload[offset:offset+topic_len], 'utf-8')
             offset += topic_len
 
-            # 跳過報文標識符（QoS > 0 時）
-            if (payload[0] & 0x06) > 0:
+            # 報文標識符（QoS > 0 時）
+            packet_id = None
+            if qos > 0:
+                packet_id = (payload[offset] << 8) + payload[offset+1]
                 offset += 2
 
-            # 獲取消息內容
-            message = payload[offset:].decode('utf-8')
+            # 消息內容保持為原始字節（memoryview 切片），支持任意二進制數據
+            message = payload[offset:]
 
-            return topic, message
+            return topic, message, packet_id
         except Exception as e:
             logger.error(f"[錯誤] 解析 PUBLISH 時出錯：{e}")
-            return None, None
+            return None, None, None
 
-    def broadcast_message(self, sender_id, topic, message):
-        """向訂閱者廣播消息"""
+    def broadcast_message(self, sender_id, topic, message, qos=0, from_bridge=False,
+                          share_filter=None):
+        """向訂閱者廣播消息，經橋接而來的消息不再發給橋接連接
+
+        share_filter(組的完整主題) 為假的共享訂閱組由其他工作進程投遞，None 表示投遞所有組。
+        """
         broadcast_count = 0
-        for subscriber_topic in self.topics:
-            if self.topic_matches(subscriber_topic, topic):
-                for client_id in self.topics[subscriber_topic]:
-                    if client_id != sender_id and client_id in self.clients:
-                        try:
-                            username = self.client_info[client_id]['username']
-                            # 檢查接收者的讀取權限
-                            if not self.check_permission(username, "read"):
-                                continue
+        frames = {}  # QoS -> 報文，每種 QoS 只在有接收者時構建一次，所有訂閱者共用
+        for client_id, sub_qos in self.subscriptions.match(topic).items():
+            if type(client_id) is SharedGroup:
+                if share_filter is not None and not share_filter(client_id.key):
+                    continue
+                client_id, sub_qos = self.pick_shared_member(
+                    client_id, topic, sender_id, from_bridge)
+                if client_id is None:
+                    continue
+            if client_id == sender_id:
+                continue
+            conn = self.clients.get(client_id)
+            # 離線的會話只能按客戶端 ID 前綴判斷，該前綴只有橋接用戶可以使用
+            if from_bridge and (conn.is_bridge if conn
+                                else client_id.startswith(BRIDGE_CLIENT_PREFIX)):
+                continue
+            session = conn.session if conn else self.sessions.get(client_id)
+            if conn is None and session is None:
+                continue
+            try:
+                # 檢查接收者的讀取權限
+                acl = conn.acl if conn else self.acl_for(session.username, client_id)
+                if not acl.allowed(topic, ACL_READ):
+                    continue
+
+                # 按發布與訂閱中較低的 QoS 投遞
+                deliver_qos = min(qos, sub_qos)
 
-                            self.send_publish(
-                                self.clients[client_id], topic, message)
-                            broadcast_count += 1
-                            logger.debug(
-                                f"[廣播] 轉發消息到 {client_id}：'{topic}' => {message}")
-                        except Exception as e:
-                            logger.error(f"[錯誤] 向客戶端 {client_id} 發送消息時出錯：{e}")
+                if conn is None or (session and session.has_pending()):
+                    # 客戶端離線或仍在補發離線消息時寫入會話日誌，保持消息順序
+                    if deliver_qos > 0 or self.queue_qos0_offline:
+                        session.append(topic, message, deliver_qos)
+                        self.stats.add('messages_stored')
+                        if conn:
+                            self.replaying.add(conn)
+                    continue
 
-        logger.info(f"[廣播] 已將消息 '{topic}' 廣播給 {broadcast_count} 個訂閱者")
+                frame = frames.get(deliver_qos)
+                if frame is None:
+                    frame = frames[deliver_qos] = self.build_publish(
+                        topic, message, deliver_qos)
+                if not conn.deliver(frame, deliver_qos):
+                    self.stats.add('messages_dropped')
+                    continue
+                broadcast_count += 1
+                self.stats.add('messages_sent')
+                broadcast_logger.debug("[廣播] 轉發消息到 %s：'%s'", client_id, topic)
+            except Exception as e:
+                logger.error(f"[錯誤] 向客戶端 {client_id} 發送消息時出錯：{e}")
+
+        broadcast_logger.info("[廣播] 已將消息 '%s' 廣播給 %d 個訂閱者", topic, broadcast_count)
 
     def topic_matches(self, subscription, topic):
         """檢查訂閱的主題是否匹配發布的主題"""
         # 實現通配符主題匹配
         # 如 a/b/c 匹配 a/b/c，a/# 匹配 a/b/c，a/+/c 匹配 a/b/c
+        # 以 $ 開頭的主題不匹配首層為通配符的訂閱
+        if topic.startswith('$') and subscription[:1] in ('+', '#'):
+            return False
+
         sub_parts = subscription.split('/')
         topic_parts = topic.split('/')
 
@@ -454,39 +3686,62 @@ class MQTTBroker:
 
         return True
 
-    def send_publish(self, client_socket, topic, message):
-        """發送 PUBLISH 報文"""
-        try:
-            topic_bytes = topic.encode('utf-8')
+    def send_retained(self, conn, topic_filter, granted_qos):
+        """向新訂閱者發送匹配過濾器的保留消息"""
+        for topic, payload, qos in self.retained.match(topic_filter):
+            if not conn.acl.allowed(topic, ACL_READ):
+                continue
+            deliver_qos = min(qos, granted_qos)
+            conn.deliver(self.build_publish(
+                topic, payload, deliver_qos, retain=True), deliver_qos)
+            logger.debug(f"[保留] 向客戶端 {conn.client_id} 發送主題 '{topic}' 的保留消息")
+
+    def build_publish(self, topic, message, qos=0, retain=False, dup=False):
+        """構建 PUBLISH 報文，返回可供所有訂閱者共用的不可變字節串
+
+        QoS 1 報文中的報文標識符預留為 0，由各連接投遞時填入。
+        """
+        topic_bytes = topic.encode('utf-8')
+        if isinstance(message, str):
             message_bytes = message.encode('utf-8')
+        else:
+            message_bytes = message  # bytes / memoryview，直接寫入不做轉換
 
-            packet = bytearray()
-            packet.append(PUBLISH)  # 報文類型
+        packet = bytearray()
+        # 報文類型、DUP、QoS 與保留標誌
+        packet.append(PUBLISH | (0x08 if dup else 0) | (qos << 1) | (0x01 if retain else 0))
 
-            # 計算剩餘長度
-            remaining_length = 2 + len(topic_bytes) + len(message_bytes)
+        # 剩餘長度
+        packet_id_len = 2 if qos > 0 else 0
+        packet.extend(encode_remaining_length(
+            2 + len(topic_bytes) + packet_id_len + len(message_bytes)))
 
-            # 編碼剩餘長度
-            while True:
-                byte = remaining_length % 128
-                remaining_length = remaining_length // 128
-                if remaining_length > 0:
-                    byte |= 0x80
-                packet.append(byte)
-                if remaining_length == 0:
-                    break
+        # 主題名稱
+        packet.append((len(topic_bytes) >> 8) & 0xFF)
+        packet.append(len(topic_bytes) & 0xFF)
+        packet.extend(topic_bytes)
 
-            # 主題名稱
-            packet.append((len(topic_bytes) >> 8) & 0xFF)
-            packet.append(len(topic_bytes) & 0xFF)
-            packet.extend(topic_bytes)
+        # 報文標識符佔位
+        packet.extend(bytes(packet_id_len))
 
-            # 消息內容
-            packet.extend(message_bytes)
+        # 消息內容
+        packet.extend(message_bytes)
 
-            client_socket.send(packet)
-        except Exception as e:
-            logger.error(f"[錯誤] 發送 PUBLISH 時出錯：{e}")
+        self.stats.add('publish_frames_built')
+        return bytes(packet)
+
+    def send_puback(self, conn, packet_id):
+        """發送 PUBACK 報文"""
+        self.send_ack(conn, PUBACK, packet_id)
+
+    def send_ack(self, conn, packet_type, packet_id):
+        """發送只包含報文標識符的確認報文（PUBACK、PUBREC、PUBCOMP）"""
+        packet = bytearray()
+        packet.append(packet_type)  # 報文類型
+        packet.append(2)            # 剩餘長度
+        packet.append((packet_id >> 8) & 0xFF)
+        packet.append(packet_id & 0xFF)
+        conn.send(packet)
 
     def parse_subscribe(self, payload):
         """解析 SUBSCRIBE 報文"""
@@ -502,7 +3757,7 @@ class MQTTBroker:
                 # 獲取主題過濾器
                 topic_len = (payload[offset] << 8) + payload[offset+1]
                 offset += 2
-                topic = payload[offset:offset+topic_len].decode('utf-8')
+                topic = str(payload[offset:offset+topic_len], 'utf-8')
                 offset += topic_len
 
                 # 獲取 QoS
@@ -516,7 +3771,28 @@ class MQTTBroker:
             logger.error(f"[錯誤] 解析 SUBSCRIBE 時出錯：{e}")
             return None, []
 
-    def send_suback(self, client_socket, packet_id, return_codes):
+    def parse_unsubscribe(self, payload):
+        """解析 UNSUBSCRIBE 報文"""
+        try:
+            offset = 0
+
+            # 獲取報文標識符
+            packet_id = (payload[offset] << 8) + payload[offset+1]
+            offset += 2
+
+            topics = []
+            while offset < len(payload):
+                topic_len = (payload[offset] << 8) + payload[offset+1]
+                offset += 2
+                topics.append(str(payload[offset:offset+topic_len], 'utf-8'))
+                offset += topic_len
+
+            return packet_id, topics
+        except Exception as e:
+            logger.error(f"[錯誤] 解析 UNSUBSCRIBE 時出錯：{e}")
+            return None, []
+
+    def send_suback(self, conn, packet_id, return_codes):
         """發送 SUBACK 報文"""
         try:
             packet = bytearray()
@@ -534,53 +3810,773 @@ class MQTTBroker:
             for code in return_codes:
                 packet.append(code)
 
-            client_socket.send(packet)
+            conn.send(packet)
         except Exception as e:
             logger.error(f"[錯誤] 發送 SUBACK 時出錯：{e}")
 
+    def send_unsuback(self, conn, packet_id):
+        """發送 UNSUBACK 報文"""
+        conn.send(bytes([UNSUBACK, 2, (packet_id >> 8) & 0xFF, packet_id & 0xFF]))
+
+    def tick(self):
+        """定時維護任務：斷開超時的連接，重發超時未確認的 QoS 1 報文，繼續補發離線消息"""
+        now = time.monotonic()
+        for conn in self.keepalive_timers.advance(now):
+            self.check_keepalive(conn, now)
+        for conn in list(self.inflight_connections):
+            if conn.closed or not conn.inflight:
+                self.inflight_connections.discard(conn)
+                continue
+            self.stats.add('retransmits', conn.retransmit(
+                now, self.retry_interval))
+        for conn in list(self.replaying):
+            if conn.closed:
+                self.replaying.discard(conn)
+            else:
+                self.replay_session(conn)
+        if self.sys_interval and (
+                self.last_sys is None or now - self.last_sys[0] >= self.sys_interval):
+            self.publish_sys_metrics(now)
+
+    def collect_sys_metrics(self, now):
+        """合併各線程的計數，生成 $SYS 主題下的指標 {子主題: 值}"""
+        stats = self.stats.snapshot()
+        depths = [conn.queue_depth() for conn in list(self.clients.values())]
+        metrics = {
+            'uptime': int(now - self.started_at),
+            'clients/connected': len(self.clients),
+            'clients/persistent': len(self.sessions),
+            'clients/half_open': self.half_open,
+            'clients/refused': stats['connections_refused'],
+            'clients/connect_timeouts': stats['connect_timeouts'],
+            'messages/received': stats['publishes_received'],
+            'messages/sent': stats['messages_sent'],
+            'messages/dropped': stats['messages_dropped'],
+            'messages/stored': stats['messages_stored'],
+            'messages/retransmitted': stats['retransmits'],
+            'bytes/received': stats['bytes_received'],
+            'bytes/sent': stats['bytes_sent'],
+            'writes/count': stats['write_calls'],
+            'ratelimit/throttled': stats['rate_limited'],
+            'ratelimit/disconnected': stats['rate_limit_disconnects'],
+            'subscriptions/count': sum(self.subscription_snapshot().values()),
+            'retained/count': len(self.retained),
+            'retained/bytes': self.retained.size,
+            'queue/depth': sum(depths),
+            'queue/max_depth': max(depths, default=0),
+        }
+        # 每秒速率按距上次發布的時間計算
+        if self.last_sys is not None:
+            last_time, last_stats = self.last_sys
+            elapsed = max(now - last_time, 1e-6)
+            for name, key in (('load/messages/received', 'publishes_received'),
+                              ('load/messages/sent', 'messages_sent'),
+                              ('load/bytes/received', 'bytes_received'),
+                              ('load/bytes/sent', 'bytes_sent')):
+                metrics[name] = round((stats[key] - last_stats[key]) / elapsed, 2)
+        self.last_sys = (now, stats)
+        return metrics
+
+    def publish_sys_metrics(self, now):
+        """以保留消息發布 $SYS 指標，訂閱者無需解析日誌即可監控 Broker"""
+        for name, value in self.collect_sys_metrics(now).items():
+            self.route_publish(None, f"{self.sys_prefix}/{name}",
+                               str(value).encode('ascii'), 0, True)
+
+    def check_keepalive(self, conn, now):
+        """連接的 keepalive 定時到期：期間有收到報文則順延，否則斷開"""
+        if conn.closed or conn.closing:
+            return
+        if conn.client_id is None:
+            self.stats.add('connect_timeouts')
+            logger.warning(
+                f"[超時] 來自 {conn.address} 的連接超過 {self.connect_timeout:g} 秒未完成 CONNECT，斷開連接")
+            conn.abort()
+            return
+        deadline = conn.last_activity + conn.keepalive * KEEPALIVE_GRACE
+        if deadline > now:
+            self.keepalive_timers.schedule(conn, deadline)
+            return
+        logger.warning(
+            f"[超時] 客戶端 {conn.client_id} 超過 {conn.keepalive * KEEPALIVE_GRACE:g} 秒未發送任何報文，斷開連接")
+        conn.abort()
+
+    def housekeeping(self):
+        """線程模式下定時執行維護任務"""
+        while self.running:
+            time.sleep(TICK_INTERVAL)
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error(f"[錯誤] 執行維護任務時出錯：{e}")
+
+    def get_queue_depths(self):
+        """返回每個已連接客戶端的外發隊列深度 {client_id: depth}"""
+        return {client_id: conn.queue_depth()
+                for client_id, conn in list(self.clients.items())}
+
     def print_status(self):
         """打印 Broker 狀態信息"""
+        with self.routing_lock:
+            client_info = {client_id: dict(info)
+                           for client_id, info in self.client_info.items()}
+        subscriptions = self.subscription_snapshot()
         connected_clients = sum(
-            1 for info in self.client_info.values() if info['connected'])
+            1 for info in client_info.values() if info['connected'])
 
         print("\n=== MQTT Broker 狀態 ===")
         print(f"[狀態] 運行地址: {self.host}:{self.port}")
         print(f"[狀態] 已連接客戶端: {connected_clients}")
+        print(f"[狀態] 活動訂閱: {sum(subscriptions.values())}")
+        print(f"[狀態] 主題數量: {len(subscriptions)}")
+        print(f"[狀態] 保留消息: {len(self.retained)} ({self.retained.size} 字節)")
+        stats = self.stats.snapshot()
         print(
-            f"[狀態] 活動訂閱: {sum(len(clients) for clients in self.topics.values())}")
-        print(f"[狀態] 主題數量: {len(self.topics)}")
+            f"[狀態] 收到消息: {stats['publishes_received']}, "
+            f"構建報文: {stats['publish_frames_built']}, "
+            f"發送消息: {stats['messages_sent']}, "
+            f"丟棄消息: {stats['messages_dropped']}, "
+            f"QoS 1 重發: {stats['retransmits']}")
 
         print("\n活動客戶端:")
-        for client_id, info in self.client_info.items():
+        for client_id, info in client_info.items():
             if info['connected']:
                 last_seen = time.strftime(
                     '%Y-%m-%d %H:%M:%S', time.localtime(info['last_seen']))
+                conn = self.clients.get(client_id)
+                depth = conn.queue_depth() if conn else 0
+                dropped = conn.dropped if conn else 0
+                throttled = conn.throttled if conn else 0
                 print(
-                    f"[客戶端] ID: {client_id}, 用戶: {info['username']}, 地址: {info['address']}, 最後活動: {last_seen}")
+                    f"[客戶端] ID: {client_id}, 用戶: {info['username']}, 地址: {info['address']}, 最後活動: {last_seen}, "
+                    f"隊列深度: {depth}, 丟棄: {dropped}, 限流: {throttled}")
 
         print("\n活動訂閱:")
-        for topic, clients in self.topics.items():
-            if clients:
-                print(f"[訂閱] 主題: {topic}, 訂閱者: {len(clients)}")
+        for topic, count in subscriptions.items():
+            print(f"[訂閱] 主題: {topic}, 訂閱者: {count}")
 
 
-if __name__ == "__main__":
-    # 檢查 netifaces 庫是否安裝
-    try:
-        import netifaces
-    except ImportError:
-        print("[警告] 缺少 netifaces 庫，無法顯示網絡接口信息。請使用 pip install netifaces 安裝。")
-        # 定義一個簡單的替代函數
+# Broker 橋接
 
-        def get_all_ip_addresses():
+
+class BridgeLink:
+    """橋接使用的一條到對端 Broker 的持久連接
+
+    連接作為普通 MQTT 客戶端登錄對端，客戶端 ID 以 BRIDGE_CLIENT_PREFIX
+    開頭；對端按登錄用戶（users.json 中的 "bridge": true）識別橋接連接。
+    斷開後自動重連。
+    """
+
+    def __init__(self, bridge, index):
+        self.bridge = bridge
+        self.index = index
+        self.client_id = f"{BRIDGE_CLIENT_PREFIX}{bridge.node_id}-{bridge.name}-{index}"
+        self.conn = None
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        """連接對端並處理收到的報文，斷開後重連"""
+        bridge = self.bridge
+        delay = 1
+        while not bridge.stopped:
+            conn = None
             try:
-                hostname = socket.gethostname()
-                ip = socket.gethostbyname(hostname)
-                return [("local", ip)]
-            except:
-                return []
+                sock = socket.create_connection(
+                    (bridge.host, bridge.port), timeout=10)
+                sock.settimeout(None)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                conn = ThreadedConnection(sock, (bridge.host, bridge.port), bridge.broker)
+                conn.client_id = self.client_id
+                conn.queue_limit = bridge.queue_size
+                conn.send(build_connect_packet(
+                    self.client_id, bridge.username, bridge.password))
+                self.serve(conn)
+                delay = 1
+            except OSError as e:
+                logger.warning(
+                    f"[橋接] {bridge.name} 連接 {bridge.host}:{bridge.port} 失敗：{e}")
+            except Exception as e:
+                logger.error(f"[錯誤] 橋接 {bridge.name} 出錯：{e}")
+            finally:
+                self.conn = None
+                if conn:
+                    conn.abort()
+                    conn.close()
+            if not bridge.stopped:
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    def serve(self, conn):
+        """讀取對端發來的報文"""
+        bridge = self.bridge
+        broker = bridge.broker
+        framer = PacketFramer()
+        while framer.recv_from(conn.sock):
+            for first_byte, payload in framer.packets():
+                packet_type = first_byte & 0xF0
+                if packet_type == CONNACK:
+                    if payload[1] != 0:
+                        raise ConnectionError(f"對端拒絕連接，返回碼 {payload[1]}")
+                    logger.info(
+                        f"[橋接] {bridge.name} 連接 {self.index} 已連接到 {bridge.host}:{bridge.port}")
+                    # 只由第一條連接訂閱對端主題，避免重複接收
+                    if self.index == 0 and bridge.inbound and bridge.in_topics:
+                        conn.send(build_subscribe_packet(bridge.in_topics))
+                    self.conn = conn
+                elif packet_type == PUBLISH:
+                    qos = (first_byte >> 1) & 0x03
+                    topic, message, packet_id = broker.parse_publish(payload, qos)
+                    if topic is None:
+                        continue
+                    broker.stats.add('bridge_messages_in')
+                    broker.route_publish(
+                        None, topic, message, qos, bool(first_byte & 0x01), from_bridge=True)
+                    if qos > 0:
+                        broker.send_puback(conn, packet_id)
+                elif packet_type == PUBACK:
+                    conn.acknowledge((payload[0] << 8) | payload[1])
+
+    def send(self, frame, qos):
+        """發送報文，連接斷開時丟棄"""
+        conn = self.conn
+        if conn is None or not conn.deliver(frame, qos):
+            self.bridge.broker.stats.add('bridge_messages_dropped')
+            return False
+        return True
+
+
+class Bridge:
+    """將匹配的主題轉發到另一個 Broker，或從對端訂閱主題到本地
+
+    配置示例：
+        {"name": "site-b", "host": "10.0.0.2", "port": 1883,
+         "username": "bridge", "password": "secret", "connections": 2,
+         "topics": [{"pattern": "sensors/#", "direction": "out", "qos": 0}]}
+
+    direction 為 out（本地到對端）、in（對端到本地）或 both。出站消息
+    按主題哈希分配到固定的連接，保證同一主題的消息順序。經橋接收到的
+    消息不會再轉發給任何橋接，從而避免環路。
+    """
+
+    def __init__(self, broker, config, inbound=True):
+        self.broker = broker
+        self.name = config.get('name', config['host'])
+        self.host = config['host']
+        self.port = config.get('port', 1883)
+        self.username = config.get('username')
+        self.password = config.get('password')
+        self.node_id = broker.node_id
+        self.inbound = inbound
+        self.queue_size = config.get('queue_size', 10000)
+        self.stopped = False
+
+        self.out_filters = SubscriptionTrie()  # client_id 為模式序號
+        self.in_topics = []
+        for index, topic in enumerate(config.get('topics', [])):
+            direction = topic.get('direction', 'out')
+            qos = min(topic.get('qos', 0), MAX_QOS)
+            if direction in ('out', 'both'):
+                self.out_filters.add(topic['pattern'], index, qos)
+            if direction in ('in', 'both'):
+                self.in_topics.append((topic['pattern'], qos))
+
+        self.links = [BridgeLink(self, i)
+                      for i in range(max(1, config.get('connections', 2)))]
+
+    def start(self):
+        logger.info(f"[橋接] 啟動橋接 {self.name} -> {self.host}:{self.port}，"
+                    f"{len(self.links)} 條連接")
+        for link in self.links:
+            link.start()
+
+    def stop(self):
+        self.stopped = True
+        for link in self.links:
+            conn = link.conn
+            if conn:
+                conn.abort()
+
+    def forward(self, topic, message, qos, retain, frames):
+        """轉發匹配出站模式的消息，frames 為各橋接共用的報文緩存"""
+        matches = self.out_filters.match(topic)
+        if not matches:
+            return
+        out_qos = min(qos, max(matches.values()))
+        frame = frames.get(out_qos)
+        if frame is None:
+            frame = frames[out_qos] = self.broker.build_publish(
+                topic, message, out_qos, retain)
+        link = self.links[zlib.crc32(topic.encode('utf-8')) % len(self.links)]
+        if link.send(frame, out_qos):
+            self.broker.stats.add('bridge_messages_out')
+
+
+def build_connect_packet(client_id, username=None, password=None, keep_alive=0):
+    """構建 CONNECT 報文（MQTT 3.1.1，clean session）"""
+    flags = 0x02
+    body = bytearray()
+    body.extend(b'\x00\x04MQTT\x04')
+    if username is not None:
+        flags |= 0x80
+        if password is not None:
+            flags |= 0x40
+    body.append(flags)
+    body.extend(keep_alive.to_bytes(2, 'big'))
+    for field in (client_id, username, password):
+        if field is None:
+            continue
+        data = field.encode('utf-8')
+        body.extend(len(data).to_bytes(2, 'big'))
+        body.extend(data)
+    return bytes([CONNECT]) + bytes(encode_remaining_length(len(body))) + bytes(body)
+
+
+def build_subscribe_packet(topics, packet_id=1):
+    """構建 SUBSCRIBE 報文，topics 為 [(主題過濾器, QoS)]"""
+    body = bytearray(packet_id.to_bytes(2, 'big'))
+    for topic_filter, qos in topics:
+        data = topic_filter.encode('utf-8')
+        body.extend(len(data).to_bytes(2, 'big'))
+        body.extend(data)
+        body.append(qos)
+    return bytes([SUBSCRIBE | 0x02]) + bytes(encode_remaining_length(len(body))) + bytes(body)
+
+
+# 多進程工作模式
+
+
+# 連接其他工作進程失敗或連接斷開後的重試間隔（秒），逐次加倍
+PEER_RETRY_MIN = 0.1
+PEER_RETRY_MAX = 5.0
+
+# 工作進程之間指定由對方投遞共享訂閱組的發布，使用 MQTT 3.1.1 的保留報文類型
+PEER_SHARED_PUBLISH = 0xF0
+
+# 轉交客戶端連接時隨套接字一起發送的已讀數據上限（字節）
+HANDOFF_MAX_DATA = 65536
+
+
+class PeerLink:
+    """與另一個工作進程之間的 Unix 套接字連接
+
+    連接上傳輸的是普通 MQTT 報文：CONNECT 報文的內容為對方的工作進程
+    編號，PUBLISH 為需要轉發的消息（DUP 標誌表示消息經橋接而來），
+    SUBSCRIBE/UNSUBSCRIBE 用於同步本進程上有訂閱者的主題（含共享訂閱），
+    PEER_SHARED_PUBLISH 為附帶了應由對方投遞的共享訂閱組的 PUBLISH。
+    """
+
+    def __init__(self, cluster, sock, peer_index=None):
+        self.cluster = cluster
+        self.sock = sock
+        self.peer_index = peer_index
+        self.filters = set()  # 對方同步過來的主題（含 $share/<組名>/<過濾器>）
+        self.conn = ThreadedConnection(sock, f"worker-{peer_index}", cluster.broker)
+        self.conn.queue_limit = cluster.queue_size
+        # 不沿用客戶端的溢出策略：disconnect 會永久斷開進程間的連接
+        self.conn.overflow_policy = 'drop_oldest'
+
+    def start(self):
+        threading.Thread(target=self.reader_loop, daemon=True).start()
+
+    def reader_loop(self):
+        """讀取並處理對方發來的報文"""
+        framer = PacketFramer()
+        try:
+            while framer.recv_from(self.sock):
+                for first_byte, payload in framer.packets():
+                    self.cluster.handle_packet(self, first_byte, payload)
+        except OSError:
+            pass
+        except Exception as e:
+            logger.error(f"[集群] 處理工作進程 {self.peer_index} 的報文時出錯：{e}")
+        finally:
+            self.cluster.remove_link(self)
+            self.conn.abort()
+            self.conn.close()
+
 
-    broker = MQTTBroker(host=HOST, port=PORT)
+class WorkerCluster:
+    """工作進程之間的消息轉發
+
+    每個工作進程在 run_dir 下監聽 worker-<編號>.sock，並主動連接所有
+    編號更小的工作進程，形成兩兩相連的網絡。本進程收到的發布只轉發給
+    有匹配訂閱的工作進程（保留消息轉發給所有進程），從其他進程收到
+    的消息只投遞給本地訂閱者，不再轉發，避免環路。
+
+    每個客戶端 ID 按哈希歸屬一個工作進程，其他進程收到該客戶端的 CONNECT
+    時通過 worker-<編號>.handoff 把套接字轉交過去，持久會話因此總在同一個
+    進程中恢復。成員分佈在多個進程上的共享訂閱組，由收到發布的進程輪流
+    選定一個進程投遞，每條消息仍只發給組內一個成員。
+    """
+
+    def __init__(self, broker, index, count, run_dir, queue_size=10000):
+        self.broker = broker
+        self.index = index
+        self.count = count
+        self.run_dir = run_dir
+        self.queue_size = queue_size
+        self.links = {}  # 工作進程編號 -> PeerLink
+        self.peer_filters = SubscriptionTrie()  # 其他工作進程的訂閱，client_id 為進程編號
+        # 其他工作進程的共享訂閱，client_id 為 (進程編號, $share/<組名>/<過濾器>)
+        self.peer_shares = SubscriptionTrie()
+        self.share_cursors = defaultdict(int)  # 共享訂閱組 -> 輪詢位置
+        self.lock = threading.Lock()
+        self.server = None
+        self.handoff_socket = None
+        self.stopped = False
+
+    def socket_path(self, index):
+        return os.path.join(self.run_dir, f"worker-{index}.sock")
+
+    def handoff_path(self, index):
+        return os.path.join(self.run_dir, f"worker-{index}.handoff")
+
+    def owner(self, client_id):
+        """負責該客戶端 ID 的工作進程編號"""
+        return zlib.crc32(client_id.encode('utf-8')) % self.count
+
+    def start(self):
+        """開始監聽並連接其他工作進程"""
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path(self.index))
+        self.server.listen(self.count)
+        self.handoff_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.handoff_socket.bind(self.handoff_path(self.index))
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+        threading.Thread(target=self.handoff_loop, daemon=True).start()
+        for peer_index in range(self.index):
+            threading.Thread(target=self.connect_peer,
+                             args=(peer_index,), daemon=True).start()
+
+    def transfer(self, peer_index, sock, data):
+        """把客戶端套接字和已讀取的數據轉交給另一個工作進程，返回是否成功"""
+        if len(data) > HANDOFF_MAX_DATA:
+            return False
+        fds = array.array('i', [sock.fileno()])
+        try:
+            self.handoff_socket.sendmsg(
+                [data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)],
+                0, self.handoff_path(peer_index))
+        except OSError as e:
+            logger.error(f"[集群] 轉交連接給工作進程 {peer_index} 失敗：{e}")
+            return False
+        self.broker.stats.add('connection_handoffs')
+        return True
+
+    def handoff_loop(self):
+        """接收其他工作進程轉交的客戶端連接"""
+        fd_size = array.array('i').itemsize
+        while True:
+            try:
+                data, ancdata, _, _ = self.handoff_socket.recvmsg(
+                    HANDOFF_MAX_DATA, socket.CMSG_SPACE(fd_size))
+            except OSError:
+                return
+            fds = array.array('i')
+            for level, kind, cmsg_data in ancdata:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    fds.frombytes(cmsg_data[:len(cmsg_data) - len(cmsg_data) % fd_size])
+            for fd in fds:
+                sock = socket.socket(fileno=fd)
+                if self.stopped:
+                    sock.close()
+                    continue
+                self.broker.adopt_connection(sock, data)
+
+    def accept_loop(self):
+        while True:
+            try:
+                sock, _ = self.server.accept()
+            except OSError:
+                return
+            PeerLink(self, sock).start()
+
+    def connect_peer(self, peer_index):
+        """連接編號更小的工作進程，對方尚未啟動或連接斷開時重試"""
+        path = self.socket_path(peer_index)
+        delay = PEER_RETRY_MIN
+        while not self.stopped:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(path)
+            except OSError:
+                sock.close()
+                time.sleep(delay)
+                delay = min(delay * 2, PEER_RETRY_MAX)
+                continue
+            delay = PEER_RETRY_MIN
+            link = PeerLink(self, sock, peer_index)
+            link.conn.send(bytes([CONNECT, 2, self.index >> 8, self.index & 0xFF]))
+            self.add_link(link)
+            link.reader_loop()  # 阻塞到連接斷開
+            if not self.stopped:
+                logger.warning(f"[集群] 與工作進程 {peer_index} 的連接已斷開，重新連接")
+                time.sleep(delay)
+
+    def add_link(self, link):
+        """登記連接，並把本地所有訂閱的主題同步給對方"""
+        with self.lock:
+            self.links[link.peer_index] = link
+        for topic in self.broker.subscription_snapshot():
+            link.conn.send(build_filter_packet(SUBSCRIBE, topic))
+        logger.info(f"[集群] 工作進程 {self.index} 已連接工作進程 {link.peer_index}")
+
+    def remove_link(self, link):
+        with self.lock:
+            if self.links.get(link.peer_index) is link:
+                del self.links[link.peer_index]
+        for topic in list(link.filters):
+            self.remove_peer_topic(link, topic)
+
+    def add_peer_topic(self, link, topic):
+        """登記對方進程上有訂閱者的主題"""
+        group_name, topic_filter = parse_shared_filter(topic)
+        link.filters.add(topic)
+        if group_name is None:
+            self.peer_filters.add(topic, link.peer_index)
+        else:
+            self.peer_shares.add(topic_filter, (link.peer_index, topic))
+
+    def remove_peer_topic(self, link, topic):
+        group_name, topic_filter = parse_shared_filter(topic)
+        link.filters.discard(topic)
+        if group_name is None:
+            self.peer_filters.remove(topic, link.peer_index)
+        else:
+            self.peer_shares.remove(topic_filter, (link.peer_index, topic))
+
+    def handle_packet(self, link, first_byte, payload):
+        """處理其他工作進程發來的報文"""
+        packet_type = first_byte & 0xF0
+        if packet_type == CONNECT:
+            link.peer_index = (payload[0] << 8) | payload[1]
+            link.conn.address = f"worker-{link.peer_index}"
+            self.add_link(link)
+        elif packet_type == PUBLISH:
+            self.broker.route_from_peer(first_byte, payload)
+        elif packet_type == PEER_SHARED_PUBLISH:
+            shares, first_byte, payload = parse_peer_shared_publish(payload)
+            self.broker.route_from_peer(first_byte, payload, shares)
+        elif packet_type == SUBSCRIBE:
+            _, topics = self.broker.parse_subscribe(payload)
+            for topic, _ in topics:
+                self.add_peer_topic(link, topic)
+        elif packet_type == UNSUBSCRIBE:
+            _, topics = self.broker.parse_unsubscribe(payload)
+            for topic in topics:
+                self.remove_peer_topic(link, topic)
+
+    def assign_shares(self, topic):
+        """為成員分佈在多個工作進程上的共享訂閱組選定投遞的進程
+
+        返回 (不由本進程投遞的組, {進程編號: [由該進程投遞的組]})；
+        只有本地成員的組不在其中，照常由本進程投遞。
+        """
+        remote = defaultdict(list)
+        for peer_index, key in self.peer_shares.match(topic):
+            remote[key].append(peer_index)
+        skipped = set()
+        assigned = defaultdict(list)
+        if not remote:
+            return skipped, assigned
+        with self.lock:
+            for key, peers in remote.items():
+                candidates = sorted(peer for peer in peers if peer in self.links)
+                if key in self.broker.shared_groups:
+                    candidates.append(self.index)
+                if not candidates:
+                    continue
+                cursor = self.share_cursors[key]
+                self.share_cursors[key] = cursor + 1
+                chosen = candidates[cursor % len(candidates)]
+                if chosen != self.index:
+                    skipped.add(key)
+                    assigned[chosen].append(key)
+        return skipped, assigned
+
+    def forward(self, topic, message, qos, retain, from_bridge=False, assigned=None):
+        """將本地收到的發布轉發給需要的工作進程，assigned 為各進程應投遞的共享訂閱組"""
+        with self.lock:
+            links = dict(self.links)
+        if not links:
+            return
+        if retain:
+            targets = set(links)  # 保留消息需要同步到所有進程
+        else:
+            targets = set(self.peer_filters.match(topic))
+        if assigned:
+            targets.update(assigned)
+        frame = None
+        for peer_index in targets:
+            link = links.get(peer_index)
+            if link is None:
+                continue
+            if frame is None:
+                frame = self.broker.build_publish(topic, message, qos, retain)
+                if from_bridge:
+                    frame = bytes([frame[0] | 0x08]) + frame[1:]
+            shares = assigned.get(peer_index) if assigned else None
+            if shares:
+                link.conn.enqueue(build_peer_shared_publish(shares, frame))
+            else:
+                link.conn.enqueue(frame)
+            self.broker.stats.add('peer_forwards')
+
+    def announce(self, packet_type, topic_filter):
+        """通知其他工作進程本地新增或不再有訂閱者的主題過濾器"""
+        packet = build_filter_packet(packet_type, topic_filter)
+        with self.lock:
+            links = list(self.links.values())
+        for link in links:
+            link.conn.send(packet)
+
+    def stop(self):
+        self.stopped = True
+        if self.server:
+            self.server.close()
+        if self.handoff_socket:
+            try:
+                # 喚醒阻塞在 recvmsg() 中的線程
+                self.handoff_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.handoff_socket.close()
+        with self.lock:
+            links = list(self.links.values())
+        for link in links:
+            link.conn.abort()
+
+
+def build_peer_shared_publish(shares, frame):
+    """構建 PEER_SHARED_PUBLISH 報文：組數、各組的完整主題，之後是原 PUBLISH 報文"""
+    body = bytearray(len(shares).to_bytes(2, 'big'))
+    for key in shares:
+        data = key.encode('utf-8')
+        body.extend(len(data).to_bytes(2, 'big'))
+        body.extend(data)
+    body.extend(frame)
+    return bytes([PEER_SHARED_PUBLISH]) + bytes(encode_remaining_length(len(body))) + bytes(body)
+
+
+def parse_peer_shared_publish(payload):
+    """解析 PEER_SHARED_PUBLISH 報文，返回 (共享訂閱組集合, PUBLISH 類型字節, PUBLISH 內容)"""
+    count = (payload[0] << 8) | payload[1]
+    pos = 2
+    shares = set()
+    for _ in range(count):
+        length = (payload[pos] << 8) | payload[pos + 1]
+        shares.add(bytes(payload[pos + 2:pos + 2 + length]).decode('utf-8'))
+        pos += 2 + length
+    first_byte, remaining_length, header_len = parse_fixed_header(payload, pos)
+    start = pos + header_len
+    return shares, first_byte, payload[start:start + remaining_length]
+
+
+def build_filter_packet(packet_type, topic_filter):
+    """構建只包含一個主題過濾器的 SUBSCRIBE 或 UNSUBSCRIBE 報文"""
+    topic_bytes = topic_filter.encode('utf-8')
+    body = bytearray(2)  # 報文標識符
+    body.append(len(topic_bytes) >> 8)
+    body.append(len(topic_bytes) & 0xFF)
+    body.extend(topic_bytes)
+    if packet_type == SUBSCRIBE:
+        body.append(0)  # QoS
+    return bytes([packet_type | 0x02]) + bytes(encode_remaining_length(len(body))) + bytes(body)
+
+
+def run_worker(index, count, run_dir, config, users_file=USERS_FILE, event_hook=None):
+    """工作進程入口"""
+    broker = MQTTBroker(config=config, users_file=users_file)
+    if event_hook:
+        broker.add_event_hook(event_hook)
+    broker.reuse_port = True
+    # 所有工作進程共用會話目錄，各自只載入歸屬自己的客戶端的會話
+    broker.cluster = WorkerCluster(broker, index, count, run_dir)
+    broker.sys_prefix = f"$SYS/broker/workers/{index}"
+    # 出站橋接由各工作進程轉發自己收到的消息，入站訂閱只在第一個進程建立
+    for bridge in broker.bridges:
+        bridge.inbound = index == 0
+    broker.cluster.start()
+    logger.info(f"[集群] 工作進程 {index} (PID {os.getpid()}) 正在啟動")
+    broker.start()
+
+
+def run_workers(count, config, users_file=USERS_FILE, event_hook=None):
+    """啟動多個共享監聽端口的工作進程，並等待它們退出"""
+    run_dir = tempfile.mkdtemp(prefix='mqtt-broker-')
+    children = []
+    for index in range(count):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(index, count, run_dir, config, users_file, event_hook)
+            except KeyboardInterrupt:
+                pass
+            except Exception as e:
+                logger.error(f"[錯誤] 工作進程 {index} 異常退出：{e}")
+                code = 1
+            finally:
+                stop_logging()
+                os._exit(code)
+        children.append(pid)
+    logger.info(f"[集群] 已啟動 {count} 個工作進程: {children}")
+
+    def terminate(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        for pid in children:
+            while True:
+                try:
+                    os.waitpid(pid, 0)
+                    break
+                except InterruptedError:
+                    continue
+    except KeyboardInterrupt:
+        terminate(None, None)
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+        logger.info("[集群] 所有工作進程已退出")
+
+
+if __name__ == "__main__":
+    config = build_config(load_config())
+    if config['mqtt'].get('session_dir') is None:
+        config['mqtt']['session_dir'] = MAIN_SESSION_DIR
+    # --event-fd N：把事件和日誌以 JSON Lines 寫入文件描述符 N（由 Web 管理介面傳入的管道）
+    event_channel = None
+    if '--event-fd' in sys.argv:
+        event_fd = int(sys.argv[sys.argv.index('--event-fd') + 1])
+        event_channel = EventChannel(event_fd, payloads=config['logging']['payloads'])
+        event_channel.start()
+        atexit.register(event_channel.close)  # 在 stop_logging 之後執行，寫出最後的日誌
+    setup_logging(config['logging'],
+                  [event_channel.log_handler()] if event_channel else ())
+
+    workers = config['broker'].get('workers', 1)
+    if workers > 1:
+        if hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT'):
+            print(f"[啟動] MQTT Broker 以 {workers} 個工作進程啟動")
+            run_workers(workers, config, event_hook=event_channel)
+            sys.exit(0)
+        print("[警告] 當前系統不支持 fork 或 SO_REUSEPORT，使用單進程模式")
+
+    broker = MQTTBroker(config=config, users_file=USERS_FILE)
+    if event_channel:
+        broker.add_event_hook(event_channel)
 
     # 創建狀態監控線程
     def status_monitor(broker):
@@ -598,5 +4594,8 @@ if __name__ == "__main__":
         broker.start()
     except KeyboardInterrupt:
         print("[關閉] 收到 KeyboardInterrupt，正在關閉...")
+    except Exception as e:
+        logger.error(f"[錯誤] Broker 啟動失敗：{e}")
+        raise
     finally:
         broker.stop()
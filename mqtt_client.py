@@ -42,6 +42,15 @@ def load_user_info(user_file="users.json", username="user"):
         return {"username": "user", "password": "password"}
 
 
+def load_password(username):
+    """從用戶文件獲取密碼，密碼已哈希保存時需要通過 -p 指定"""
+    password = load_user_info(username=username).get("password", "password")
+    if password.startswith("pbkdf2_sha256$"):
+        print(f"[錯誤] 用戶 {username} 的密碼已加密保存，請使用 -p 指定密碼")
+        sys.exit(1)
+    return password
+
+
 # 載入配置
 CONFIG = load_config()
 
@@ -114,8 +123,7 @@ def run_subscriber(username="user", password=None, topic=MQTT_TOPIC):
     """運行 MQTT 訂閱者"""
     # 如果沒有提供密碼，則從配置中獲取
     if password is None:
-        user_info = load_user_info(username=username)
-        password = user_info.get("password", "password")
+        password = load_password(username)
 
     # 設置用戶資料字典
     userdata = {
@@ -159,8 +167,7 @@ def run_publisher(username="user", password=None, topic=MQTT_TOPIC):
     """運行 MQTT 發布者"""
     # 如果沒有提供密碼，則從配置中獲取
     if password is None:
-        user_info = load_user_info(username=username)
-        password = user_info.get("password", "password")
+        password = load_password(username)
 
     # 設置用戶資料字典
     userdata = {
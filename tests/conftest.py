@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+# 測試直接導入倉庫根目錄下的 mqtt_broker.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mqtt_broker import MQTTBroker  # noqa: E402
+
+
+@pytest.fixture(params=['thread', 'selector'])
+def start_broker(request):
+    """啟動監聽本機端口 0 的嵌入式 Broker，兩種連接引擎各運行一次，測試結束時停止
+
+    config 與 config.json 的結構相同，未設置 mqtt.allow_anonymous 時允許匿名連接。
+    """
+    brokers = []
+
+    def start(config=None, users=None, **kwargs):
+        config = dict(config or {})
+        config['mqtt'] = dict({'allow_anonymous': users is None}, **config.get('mqtt', {}))
+        broker = MQTTBroker(host='127.0.0.1', port=0, engine=request.param,
+                            config=config, users=users, **kwargs)
+        broker.start_in_background()
+        brokers.append(broker)
+        return broker
+
+    yield start
+    for broker in brokers:
+        broker.stop()
@@ -0,0 +1,145 @@
+"""套接字層面測試使用的最小 MQTT 3.1.1 客戶端，不依賴 Broker 的解析代碼"""
+
+import socket
+import struct
+import time
+from collections import namedtuple
+
+Publish = namedtuple('Publish', 'topic payload qos dup retain packet_id')
+
+
+def encode_string(value):
+    data = value.encode('utf-8') if isinstance(value, str) else value
+    return struct.pack('!H', len(data)) + data
+
+
+def encode_packet(first_byte, body):
+    length = bytearray()
+    remaining = len(body)
+    while True:
+        digit, remaining = remaining % 128, remaining // 128
+        length.append(digit | (0x80 if remaining else 0))
+        if not remaining:
+            break
+    return bytes([first_byte]) + bytes(length) + body
+
+
+class TestClient:
+    """阻塞式測試客戶端，read 返回 (報文類型字節, 報文內容)，超時返回 None"""
+
+    __test__ = False  # 不是 pytest 測試類
+
+    def __init__(self, port, client_id='', username=None, password=None,
+                 clean_session=True, keepalive=60, connect=True):
+        self.sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+        self.buffer = b''
+        self.connack = None
+        if connect:
+            self.connect(client_id, username, password, clean_session, keepalive)
+
+    def connect(self, client_id, username=None, password=None, clean_session=True,
+                keepalive=60):
+        """發送 CONNECT，返回 (返回碼, session_present)"""
+        flags = 0x02 if clean_session else 0
+        payload = encode_string(client_id)
+        if username is not None:
+            flags |= 0x80
+            payload += encode_string(username)
+            if password is not None:
+                flags |= 0x40
+                payload += encode_string(password)
+        self.send(0x10, encode_string('MQTT') + bytes([4, flags])
+                  + struct.pack('!H', keepalive) + payload)
+        packet = self.read()
+        assert packet is not None and packet[0] == 0x20, packet
+        self.connack = (packet[1][1], bool(packet[1][0] & 0x01))
+        return self.connack
+
+    def send(self, first_byte, body=b''):
+        self.sock.sendall(encode_packet(first_byte, body))
+
+    def read(self, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while True:
+            packet = self.parse()
+            if packet is not None:
+                return packet
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self.sock.settimeout(remaining)
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                return None
+            if not data:
+                raise ConnectionError('broker closed the connection')
+            self.buffer += data
+
+    def parse(self):
+        buf = self.buffer
+        if len(buf) < 2:
+            return None
+        length = 0
+        for index in range(1, min(len(buf), 5)):
+            length |= (buf[index] & 0x7F) << (7 * (index - 1))
+            if not buf[index] & 0x80:
+                start = index + 1
+                break
+        else:
+            return None
+        if len(buf) < start + length:
+            return None
+        self.buffer = buf[start + length:]
+        return buf[0], buf[start:start + length]
+
+    def closed(self, timeout=5.0):
+        """等待 Broker 斷開連接，期間收到的報文被忽略"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                self.read(deadline - time.monotonic())
+            except (ConnectionError, OSError):
+                return True
+        return False
+
+    def subscribe(self, topic_filter, qos=0, packet_id=1):
+        """訂閱並返回 SUBACK 中的返回碼"""
+        self.send(0x82, struct.pack('!H', packet_id) + encode_string(topic_filter) + bytes([qos]))
+        packet = self.expect(0x90)
+        return packet[1][2]
+
+    def unsubscribe(self, topic_filter, packet_id=1):
+        self.send(0xA2, struct.pack('!H', packet_id) + encode_string(topic_filter))
+        self.expect(0xB0)
+
+    def publish(self, topic, payload, qos=0, packet_id=1, retain=False, dup=False):
+        payload = payload.encode('utf-8') if isinstance(payload, str) else payload
+        body = encode_string(topic) + (struct.pack('!H', packet_id) if qos else b'') + payload
+        self.send(0x30 | (0x08 if dup else 0) | (qos << 1) | (1 if retain else 0), body)
+
+    def puback(self, packet_id):
+        self.send(0x40, struct.pack('!H', packet_id))
+
+    def expect(self, packet_type, timeout=5.0):
+        """讀取下一個報文並檢查類型（高四位）"""
+        packet = self.read(timeout)
+        assert packet is not None, f"timed out waiting for {packet_type:#x}"
+        assert packet[0] & 0xF0 == packet_type, packet
+        return packet
+
+    def expect_publish(self, timeout=5.0):
+        first_byte, body = self.expect(0x30, timeout)
+        qos = (first_byte >> 1) & 0x03
+        topic_len = struct.unpack_from('!H', body)[0]
+        topic = body[2:2 + topic_len].decode('utf-8')
+        offset = 2 + topic_len
+        packet_id = None
+        if qos:
+            packet_id = struct.unpack_from('!H', body, offset)[0]
+            offset += 2
+        return Publish(topic, body[offset:], qos, bool(first_byte & 0x08),
+                       bool(first_byte & 0x01), packet_id)
+
+    def close(self):
+        self.sock.close()
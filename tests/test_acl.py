@@ -0,0 +1,52 @@
+from mqtt_broker import ACL_READ, ACL_WRITE, MQTTBroker, TopicACL, compile_topic_pattern
+
+
+def test_first_matching_rule_decides():
+    acl = TopicACL([
+        ('secret/#', ACL_READ | ACL_WRITE, False),
+        ('+/status', ACL_READ, True),
+        ('#', ACL_WRITE, True),
+    ])
+    assert acl.allowed('dev/status', ACL_READ)
+    assert not acl.allowed('secret/status', ACL_READ)
+    assert not acl.allowed('dev/other', ACL_READ)
+    assert acl.allowed('dev/other', ACL_WRITE)
+    assert not acl.allowed('secret', ACL_WRITE)
+
+
+def test_hash_matches_parent_level():
+    acl = TopicACL([('a/#', ACL_READ, True)])
+    assert acl.allowed('a', ACL_READ)
+    assert acl.allowed('a/b/c', ACL_READ)
+    assert not acl.allowed('ab', ACL_READ)
+
+
+def test_filters_only_matched_by_rule_wildcards():
+    acl = TopicACL([('dev/+', ACL_READ, True)])
+    assert acl.allowed('dev/+', ACL_READ)
+    assert not acl.allowed('dev/#', ACL_READ)
+
+
+def test_substitutions_match_literally():
+    assert compile_topic_pattern('dev/%c/#', {'%c': 'a.b'}) == r'dev/a\.b(?:/.*)?'
+    acl = TopicACL([('dev/%c/%u', ACL_READ, True)], {'%c': 'a+b', '%u': '#'})
+    assert acl.allowed('dev/a+b/#', ACL_READ)
+    assert not acl.allowed('dev/axb/#', ACL_READ)
+    assert not acl.allowed('dev/a+b/alice', ACL_READ)
+
+
+def test_identity_with_wildcards_refused():
+    users = {'alice': {'password': 'secret', 'permissions': ['read', 'write'],
+                       'acl': [{'pattern': 'dev/%c/#', 'access': 'readwrite'}]},
+             'bob': {'password': 'secret', 'permissions': ['read']}}
+    broker = MQTTBroker(host='127.0.0.1', port=0, users=users)
+    assert broker.acl_identity_valid('alice', 'sensor-1')
+    assert not broker.acl_identity_valid('alice', '#')
+    assert not broker.acl_identity_valid('alice', 'a/b')
+    # 沒有訪問規則的用戶不受限制
+    assert broker.acl_identity_valid('bob', '#')
+
+    acl = broker.compile_acl('alice', 'sensor-1')
+    assert acl.allowed('dev/sensor-1/temp', ACL_WRITE)
+    assert not acl.allowed('dev/sensor-2/temp', ACL_WRITE)
+    assert not broker.compile_acl('bob', 'x').allowed('a', ACL_WRITE)
@@ -0,0 +1,76 @@
+import socket
+import time
+
+from mqtt_test_client import TestClient
+
+
+def idle_socket(port):
+    """只建立 TCP 連接、不發送 CONNECT 的客戶端"""
+    return socket.create_connection(('127.0.0.1', port), timeout=5)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def is_closed(sock, timeout=1.0):
+    sock.settimeout(timeout)
+    try:
+        return sock.recv(1) == b''
+    except socket.timeout:
+        return False
+    except OSError:
+        return True
+
+
+def test_connect_timeout_drops_silent_connection(start_broker):
+    broker = start_broker({'broker': {'connect_timeout': 1}})
+    silent = idle_socket(broker.port)
+    assert is_closed(silent, timeout=4.0)
+    assert broker.stats.snapshot()['connect_timeouts'] == 1
+    assert wait_for(lambda: broker.half_open == 0)
+
+
+def test_refuse_policy_closes_connections_over_half_open_limit(start_broker):
+    broker = start_broker({'broker': {'max_half_open': 2, 'admission_policy': 'refuse'}})
+    waiting = [idle_socket(broker.port) for _ in range(2)]
+    time.sleep(0.2)
+    extra = idle_socket(broker.port)
+    assert is_closed(extra)
+    assert broker.stats.snapshot()['connections_refused'] == 1
+
+    # 等待中的連接關閉後釋放名額
+    waiting[0].close()
+    time.sleep(0.2)
+    client = TestClient(broker.port, 'late')
+    assert client.connack == (0, False)
+
+
+def test_queue_policy_waits_for_half_open_slot(start_broker):
+    broker = start_broker({'broker': {'max_half_open': 1}})
+    first = TestClient(broker.port, 'first', connect=False)
+    time.sleep(0.2)
+    second = TestClient(broker.port, 'second', connect=False)
+    second.send(0x10, b'\x00\x04MQTT\x04\x02\x00\x3c\x00\x06second')
+    # 第二個連接留在監聽隊列中，尚未被接受
+    assert second.read(0.5) is None
+
+    first.connect('first')
+    packet = second.read()
+    assert packet is not None and packet[0] == 0x20
+    assert broker.stats.snapshot()['connections_refused'] == 0
+
+
+def test_refuse_policy_limits_new_connection_rate(start_broker):
+    # 監聽隊列足夠長，連接不會因隊列已滿而被內核延遲
+    broker = start_broker({'broker': {'connects_per_second': 5, 'admission_policy': 'refuse',
+                                      'max_connections': 64}})
+    sockets = [idle_socket(broker.port) for _ in range(15)]
+    refused = sum(is_closed(sock, timeout=0.2) for sock in sockets)
+    assert 5 <= refused <= 10
+    assert broker.stats.snapshot()['connections_refused'] == refused
@@ -0,0 +1,50 @@
+import time
+
+from mqtt_test_client import TestClient
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_bridged_publish_reaches_peer_without_looping_back(start_broker):
+    users = {'bridge': {'password': 'secret', 'permissions': ['read', 'write'],
+                        'bridge': True},
+             'user': {'password': 'secret', 'permissions': ['read', 'write']}}
+    broker_b = start_broker(users=users)
+    # 雙向橋接：A 的消息發往 B，同時從 B 訂閱同一主題，最容易形成環路
+    broker_a = start_broker({'bridges': [{
+        'name': 'b', 'host': '127.0.0.1', 'port': broker_b.port,
+        'username': 'bridge', 'password': 'secret', 'connections': 1,
+        'topics': [{'pattern': 'loop/#', 'direction': 'both', 'qos': 1}],
+    }]})
+    link = broker_a.bridges[0].links[0]
+    assert wait_for(lambda: link.conn is not None)
+    assert wait_for(lambda: 'loop/#' in broker_b.subscription_snapshot())
+
+    sub_a = TestClient(broker_a.port, 'sub-a')
+    sub_a.subscribe('loop/#', qos=1)
+    sub_b = TestClient(broker_b.port, 'sub-b', 'user', 'secret')
+    sub_b.subscribe('loop/#', qos=1)
+    pub = TestClient(broker_a.port, 'pub')
+    pub.publish('loop/x', b'hello', qos=1, packet_id=1)
+    pub.expect(0x40)
+
+    message = sub_b.expect_publish()
+    assert (message.topic, message.payload) == ('loop/x', b'hello')
+    sub_b.puback(message.packet_id)
+    message = sub_a.expect_publish()
+    assert message.payload == b'hello'
+    sub_a.puback(message.packet_id)
+
+    # B 不會把經橋接收到的消息送回 A
+    assert sub_a.read(0.5) is None
+    assert sub_b.read(0.1) is None
+    assert broker_b.stats.snapshot()['bridge_messages_in'] == 0
+    assert broker_a.stats.snapshot()['bridge_messages_in'] == 0
+    assert broker_a.stats.snapshot()['bridge_messages_out'] == 1
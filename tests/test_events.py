@@ -0,0 +1,97 @@
+import json
+import os
+import time
+
+from mqtt_broker import (EVENT_WRITE_SIZE, ClientConnected, ClientDisconnected, EventChannel,
+                         MessagePublished, Subscribed, Unsubscribed)
+from mqtt_test_client import TestClient
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def read_lines(fd):
+    data = b''
+    while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            return [json.loads(line) for line in data.decode('utf-8').splitlines()]
+        data += chunk
+
+
+def test_hooks_receive_typed_events(start_broker):
+    broker = start_broker()
+    events = []
+    broker.add_event_hook(events.append)
+
+    client = TestClient(broker.port, 'dev-1')
+    client.subscribe('cmd/#', qos=1)
+    client.publish('state/dev-1', b'\x00on')
+    client.unsubscribe('cmd/#')
+    client.send(0xE0)  # DISCONNECT
+    assert wait_for(lambda: any(type(event) is ClientDisconnected for event in events))
+
+    assert [type(event) for event in events] == [
+        ClientConnected, Subscribed, MessagePublished, Unsubscribed, ClientDisconnected]
+    connected, subscribed, published, unsubscribed, disconnected = events
+    assert (connected.client_id, connected.session_present) == ('dev-1', False)
+    assert (subscribed.topic, subscribed.qos) == ('cmd/#', 1)
+    assert (published.topic, published.payload, published.qos, published.retain) == \
+        ('state/dev-1', b'\x00on', 0, False)
+    assert type(published.payload) is bytes
+    assert unsubscribed.topic == 'cmd/#'
+    assert disconnected.graceful
+
+
+def test_channel_writes_json_lines(start_broker):
+    broker = start_broker()
+    read_fd, write_fd = os.pipe()
+    channel = EventChannel(write_fd)
+    channel.start()
+    broker.add_event_hook(channel)
+
+    client = TestClient(broker.port, 'dev-1')
+    client.publish('state/dev-1', b'secret')
+    client.close()
+    assert wait_for(lambda: not broker.clients)
+    channel.close()
+    os.close(write_fd)
+
+    records = read_lines(read_fd)
+    os.close(read_fd)
+    assert [record['type'] for record in records] == ['connected', 'published', 'disconnected']
+    published = records[1]
+    # 默認不輸出消息內容，只有大小
+    assert (published['topic'], published['size']) == ('state/dev-1', 6)
+    assert 'payload' not in published
+    assert records[2] == {'type': 'disconnected', 'client_id': 'dev-1', 'graceful': False}
+
+
+def test_channel_truncates_records_to_pipe_buf():
+    read_fd, write_fd = os.pipe()
+    channel = EventChannel(write_fd, payloads=True)
+    channel.start()
+    payload = ('好' * EVENT_WRITE_SIZE).encode('utf-8')
+    channel(MessagePublished('dev-1', 'big', payload, 0, False))
+    channel(MessagePublished('dev-1', 'small', b'ok', 0, False))
+    channel.close()
+    os.close(write_fd)
+
+    data = os.read(read_fd, 65536)
+    os.close(read_fd)
+    lines = data.splitlines(keepends=True)
+    assert len(lines) == 2
+    assert all(len(line) <= EVENT_WRITE_SIZE for line in lines)
+    big, small = (json.loads(line) for line in lines)
+    assert big['truncated'] and big['size'] == len(payload)
+    # 只截去超出的部分，CJK 字符按字節計算
+    assert big['payload'] == '好' * len(big['payload'])
+    assert len(big['payload'].encode('utf-8')) > EVENT_WRITE_SIZE // 2
+    assert small == {'type': 'published', 'client_id': 'dev-1', 'topic': 'small',
+                     'size': 2, 'qos': 0, 'retain': False, 'payload': 'ok'}
@@ -0,0 +1,64 @@
+import socket
+
+import pytest
+
+from mqtt_broker import PacketFramer, encode_remaining_length
+
+
+def packet(first_byte, payload):
+    return bytes([first_byte]) + encode_remaining_length(len(payload)) + payload
+
+
+def contents(packets):
+    return [(first_byte, bytes(body)) for first_byte, body in packets]
+
+
+def test_packets_split_across_feeds():
+    framer = PacketFramer(buffer_size=16)
+    data = packet(0x30, b'hello') + packet(0xC0, b'') + packet(0x30, b'x' * 40)
+    found = []
+    for index in range(0, len(data), 3):
+        framer.feed(data[index:index + 3])
+        found.extend(contents(framer.packets()))
+    assert found == [(0x30, b'hello'), (0xC0, b''), (0x30, b'x' * 40)]
+    assert framer.start == framer.end == 0
+
+
+def test_complete_packets_survive_make_room():
+    # 同一次讀取中完整報文之後跟著需要擴容的不完整報文，擴容不能破壞已取出的報文
+    framer = PacketFramer(buffer_size=16)
+    large = packet(0x30, b'L' * 30)
+    framer.feed(packet(0x30, b'abc') + packet(0x30, b'def') + large[:4])
+    assert contents(framer.packets()) == [(0x30, b'abc'), (0x30, b'def')]
+    framer.feed(large[4:])
+    assert contents(framer.packets()) == [(0x30, b'L' * 30)]
+
+
+def test_recv_from_compacts_and_grows():
+    framer = PacketFramer(buffer_size=8)
+    left, right = socket.socketpair()
+    try:
+        data = packet(0x30, b'ab') + packet(0x30, b'y' * 20)
+        left.sendall(data)
+        found = []
+        while len(found) < 2:
+            assert framer.recv_from(right) > 0
+            found.extend(contents(framer.packets()))
+        assert found == [(0x30, b'ab'), (0x30, b'y' * 20)]
+    finally:
+        left.close()
+        right.close()
+
+
+def test_buffer_shrinks_after_large_packet():
+    framer = PacketFramer(buffer_size=16)
+    framer.feed(packet(0x30, b'z' * 200))
+    assert contents(framer.packets()) == [(0x30, b'z' * 200)]
+    assert len(framer.buffer) == 16
+
+
+def test_max_packet_size():
+    framer = PacketFramer(buffer_size=16, max_packet_size=10)
+    framer.feed(packet(0x30, b'x' * 20)[:4])
+    with pytest.raises(ValueError):
+        framer.packets()
@@ -0,0 +1,103 @@
+import socket
+import struct
+import time
+
+from mqtt_test_client import TestClient
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_qos1_publish_is_acknowledged_and_delivered(start_broker):
+    broker = start_broker()
+    sub = TestClient(broker.port, 'sub')
+    assert sub.subscribe('q/#', qos=1) == 1
+    pub = TestClient(broker.port, 'pub')
+    pub.publish('q/a', b'\x00\x01binary', qos=1, packet_id=7)
+    assert pub.expect(0x40)[1] == struct.pack('!H', 7)
+
+    message = sub.expect_publish()
+    assert (message.topic, message.payload, message.qos, message.dup) == \
+        ('q/a', b'\x00\x01binary', 1, False)
+    sub.puback(message.packet_id)
+
+
+def test_inflight_window_and_order(start_broker):
+    broker = start_broker({'mqtt': {'max_inflight': 2}})
+    sub = TestClient(broker.port, 'sub')
+    sub.subscribe('q', qos=1)
+    pub = TestClient(broker.port, 'pub')
+    for index in range(6):
+        pub.publish('q', b'%d' % index, qos=1, packet_id=index + 1)
+
+    first = [sub.expect_publish() for _ in range(2)]
+    assert sub.read(0.3) is None  # 窗口已滿，收到 PUBACK 前不再發送
+    received = [m.payload for m in first]
+    for message in first:
+        sub.puback(message.packet_id)
+    while len(received) < 6:
+        message = sub.expect_publish()
+        received.append(message.payload)
+        sub.puback(message.packet_id)
+    assert received == [b'%d' % index for index in range(6)]
+
+
+def test_unacknowledged_message_is_retransmitted_with_dup(start_broker):
+    broker = start_broker({'mqtt': {'retry_interval': 1}})
+    sub = TestClient(broker.port, 'sub')
+    sub.subscribe('q', qos=1)
+    pub = TestClient(broker.port, 'pub')
+    pub.publish('q', b'again', qos=1)
+
+    message = sub.expect_publish()
+    retry = sub.expect_publish(timeout=5)
+    assert retry.dup and retry.packet_id == message.packet_id and retry.payload == b'again'
+    sub.puback(message.packet_id)
+    assert sub.read(2.5) is None
+
+
+def test_qos2_is_delivered_once(start_broker):
+    broker = start_broker()
+    sub = TestClient(broker.port, 'sub')
+    sub.subscribe('q', qos=1)
+    pub = TestClient(broker.port, 'pub')
+    pub.publish('q', b'once', qos=2, packet_id=9)
+    assert pub.expect(0x50)[1] == struct.pack('!H', 9)  # PUBREC
+    pub.publish('q', b'once', qos=2, packet_id=9, dup=True)
+    assert pub.expect(0x50)[1] == struct.pack('!H', 9)
+    pub.send(0x62, struct.pack('!H', 9))  # PUBREL
+    assert pub.expect(0x70)[1] == struct.pack('!H', 9)  # PUBCOMP
+
+    message = sub.expect_publish()
+    assert (message.payload, message.qos) == (b'once', 1)
+    sub.puback(message.packet_id)
+    assert sub.read(0.3) is None
+
+
+def test_stalled_subscriber_does_not_grow_control_queue(start_broker):
+    # 訂閱者不讀取數據、窗口已滿時，重發不能在控制隊列中不斷堆積副本
+    broker = start_broker({'mqtt': {'max_inflight': 4, 'retry_interval': 1}})
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.connect(('127.0.0.1', broker.port))
+    sub = TestClient.__new__(TestClient)
+    sub.sock, sub.buffer = sock, b''
+    sub.connect('stalled')
+    sub.subscribe('big', qos=1)
+    pub = TestClient(broker.port, 'pub')
+    for index in range(4):
+        pub.publish('big', bytes(2 * 1024 * 1024), qos=1, packet_id=index + 1)
+        pub.expect(0x40)
+
+    assert wait_for(lambda: 'stalled' in broker.clients
+                    and len(broker.clients['stalled'].inflight) == 4)
+    conn = broker.clients['stalled']
+    time.sleep(3.5)
+    with conn.lock:
+        assert len(conn.control) <= 3 * 4
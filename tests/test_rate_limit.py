@@ -0,0 +1,49 @@
+import time
+
+from mqtt_test_client import TestClient
+
+
+def test_throttle_slows_publisher_without_dropping(start_broker):
+    broker = start_broker({'mqtt': {'rate_limit': {'bytes_per_second': 4000}}})
+    sub = TestClient(broker.port, 'sub')
+    sub.subscribe('load')
+    pub = TestClient(broker.port, 'pub')
+
+    started = time.monotonic()
+    for index in range(16):
+        pub.publish('load', b'%02d' % index + b'x' * 998)
+    payloads = [sub.expect_publish().payload[:2] for _ in range(16)]
+    elapsed = time.monotonic() - started
+
+    assert payloads == [b'%02d' % index for index in range(16)]
+    # 16 KB 中桶內的 4 KB 和一個接收緩衝區可立即通過，其餘按每秒 4000 字節放行
+    assert elapsed >= 1.0
+    assert broker.stats.snapshot()['rate_limited'] > 0
+    assert broker.clients['pub'].throttled > 0
+
+
+def test_disconnect_action_drops_flooding_client(start_broker):
+    broker = start_broker({'mqtt': {'rate_limit': {
+        'messages_per_second': 5, 'action': 'disconnect'}}})
+    pub = TestClient(broker.port, 'pub')
+    for index in range(20):
+        pub.publish('load', b'x')
+    assert pub.closed()
+    assert broker.stats.snapshot()['rate_limit_disconnects'] == 1
+
+
+def test_user_limit_is_shared_by_connections(start_broker):
+    users = {'device': {'password': 'secret', 'permissions': ['read', 'write'],
+                        'rate_limit': {'bytes_per_second': 100, 'action': 'disconnect'}},
+             'reader': {'password': 'secret', 'permissions': ['read', 'write']}}
+    broker = start_broker(users=users)
+    first = TestClient(broker.port, 'd1', 'device', 'secret')
+    second = TestClient(broker.port, 'd2', 'device', 'secret')
+    first.publish('load', b'x' * 60)
+    first.subscribe('sync')  # 確認第一條已處理
+    second.publish('load', b'x' * 60)
+    assert second.closed()
+    # 其他用戶不受影響
+    reader = TestClient(broker.port, 'r1', 'reader', 'secret')
+    reader.publish('load', b'x' * 200)
+    assert reader.subscribe('sync') == 0
@@ -0,0 +1,52 @@
+from mqtt_broker import RetainedStore
+from mqtt_test_client import TestClient
+
+
+def test_new_subscription_receives_matching_retained_messages(start_broker):
+    broker = start_broker()
+    pub = TestClient(broker.port, 'pub')
+    pub.publish('home/kitchen/temp', b'21', retain=True)
+    pub.publish('home/garage/temp', b'15', retain=True)
+    pub.publish('home/kitchen/humidity', b'40', retain=True)
+    pub.publish('office/temp', b'23', retain=True)
+    pub.publish('home/kitchen/temp', b'live')  # 不帶 RETAIN，不改變保留消息
+    pub.subscribe('sync')  # SUBACK 之後前面的發布都已處理
+
+    sub = TestClient(broker.port, 'sub')
+    sub.subscribe('home/+/temp')
+    received = {}
+    for _ in range(2):
+        message = sub.expect_publish()
+        assert message.retain
+        received[message.topic] = message.payload
+    assert received == {'home/kitchen/temp': b'21', 'home/garage/temp': b'15'}
+    assert sub.read(0.2) is None
+
+    # 已訂閱的客戶端照常收到不帶 RETAIN 標誌的消息
+    pub.publish('home/garage/temp', b'16', retain=True)
+    message = sub.expect_publish()
+    assert (message.payload, message.retain) == (b'16', False)
+
+
+def test_empty_payload_clears_retained_message(start_broker):
+    broker = start_broker()
+    pub = TestClient(broker.port, 'pub')
+    pub.publish('state/a', b'on', retain=True)
+    pub.publish('state/a', b'', retain=True)
+    pub.subscribe('sync')
+
+    sub = TestClient(broker.port, 'sub')
+    sub.subscribe('state/#')
+    assert sub.read(0.3) is None
+    assert len(broker.retained) == 0
+
+
+def test_store_evicts_least_recently_used():
+    store = RetainedStore(max_bytes=30)
+    store.set('a/1', b'x' * 7)  # 每條 10 字節
+    store.set('a/2', b'x' * 7)
+    store.set('a/3', b'x' * 7)
+    assert [topic for topic, _, _ in store.match('a/1')] == ['a/1']  # 讀取後成為最近使用
+    store.set('a/4', b'x' * 7)
+    assert sorted(topic for topic, _, _ in store.match('a/#')) == ['a/1', 'a/3', 'a/4']
+    assert store.size == 30
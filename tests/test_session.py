@@ -0,0 +1,73 @@
+import os
+
+from mqtt_broker import PersistentSession
+
+
+def open_session(path):
+    return PersistentSession(str(path), 'client', segment_bytes=64)
+
+
+def read_all(session):
+    return [(topic, bytes(payload), qos, dup)
+            for topic, payload, qos, dup, _ in session.read_pending(100)]
+
+
+def drain(session):
+    messages = session.read_pending(100)
+    for message in messages:
+        session.acknowledge(message[4])
+    return [(topic, bytes(payload)) for topic, payload, _, _, _ in messages]
+
+
+def segments(path):
+    return sorted(name for name in os.listdir(path) if name.endswith('.seg'))
+
+
+def test_drain_removes_segments_and_restart_writes_after_cursor(tmp_path):
+    session = open_session(tmp_path)
+    for index in range(10):
+        session.append('t', b'%d' % index * 10, 1)
+    assert len(segments(tmp_path)) > 1
+    assert len(drain(session)) == 10
+    assert segments(tmp_path) == []
+
+    session = open_session(tmp_path)
+    assert not session.has_pending()
+    session.append('t', b'new', 1)
+    assert session.write_pos >= session.ack_pos
+    assert drain(open_session(tmp_path)) == [('t', b'new')]
+
+
+def test_cursor_only_advances_on_acknowledge(tmp_path):
+    session = open_session(tmp_path)
+    for payload in (b'a', b'b', b'c'):
+        session.append('t', payload, 1)
+    first, second, third = session.read_pending(100)
+    session.acknowledge(first[4])
+    session.acknowledge(third[4])
+
+    # 未確認的第二條消息之後的位置不會寫入 cursor，重啟後從第二條開始重發
+    reopened = open_session(tmp_path)
+    assert [payload for _, payload, _, _ in read_all(reopened)] == [b'b', b'c']
+
+
+def test_rewind_redelivers_with_dup(tmp_path):
+    session = open_session(tmp_path)
+    for payload in (b'a', b'b'):
+        session.append('t', payload, 1)
+    session.append('t', b'q0', 0)
+    first, second, _ = session.read_pending(100)
+    session.acknowledge(first[4])
+    session.rewind()
+    # 退回前讀出的確認不再生效
+    session.acknowledge(second[4])
+    assert read_all(session) == [('t', b'b', 1, True), ('t', b'q0', 0, True)]
+
+    session.append('t', b'c', 1)
+    assert read_all(session) == [('t', b'c', 1, False)]
+
+
+def test_append_keeps_dup_flag(tmp_path):
+    session = open_session(tmp_path)
+    session.append('t', b'x', 1, dup=True)
+    assert read_all(open_session(tmp_path)) == [('t', b'x', 1, True)]
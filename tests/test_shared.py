@@ -0,0 +1,66 @@
+from collections import Counter
+
+from mqtt_test_client import TestClient
+
+
+def drain(client):
+    payloads = []
+    while True:
+        packet = client.read(0.3)
+        if packet is None:
+            return payloads
+        payloads.append(packet[1][-2:])
+
+
+def test_each_message_goes_to_one_group_member(start_broker):
+    broker = start_broker()
+    members = [TestClient(broker.port, f'worker-{index}') for index in range(3)]
+    for member in members:
+        assert member.subscribe('$share/pool/jobs/+') == 0
+    other_group = TestClient(broker.port, 'audit')
+    other_group.subscribe('$share/audit/jobs/#')
+    plain = TestClient(broker.port, 'plain')
+    plain.subscribe('jobs/#')
+
+    pub = TestClient(broker.port, 'pub')
+    for index in range(30):
+        pub.publish('jobs/build', b'%02d' % index)
+
+    received = [drain(member) for member in members]
+    # 輪詢策略下每個成員分到相同數量的消息，合起來每條消息恰好一次
+    assert [len(payloads) for payloads in received] == [10, 10, 10]
+    assert Counter(payload for payloads in received for payload in payloads) == \
+        Counter(b'%02d' % index for index in range(30))
+    # 其他組和普通訂閱各自收到全部消息
+    assert len(drain(other_group)) == 30
+    assert len(drain(plain)) == 30
+
+
+def test_sticky_strategy_keeps_topic_on_one_member(start_broker):
+    broker = start_broker({'mqtt': {'shared_subscription_strategy': 'sticky'}})
+    members = [TestClient(broker.port, f'worker-{index}') for index in range(3)]
+    for member in members:
+        member.subscribe('$share/pool/jobs/#')
+
+    pub = TestClient(broker.port, 'pub')
+    for index in range(10):
+        pub.publish('jobs/a', b'%02d' % index)
+
+    counts = sorted(len(drain(member)) for member in members)
+    assert counts == [0, 0, 10]
+
+
+def test_unsubscribed_member_stops_receiving(start_broker):
+    broker = start_broker()
+    first = TestClient(broker.port, 'first')
+    second = TestClient(broker.port, 'second')
+    first.subscribe('$share/pool/jobs')
+    second.subscribe('$share/pool/jobs')
+    first.unsubscribe('$share/pool/jobs')
+
+    pub = TestClient(broker.port, 'pub')
+    for index in range(4):
+        pub.publish('jobs', b'%02d' % index)
+    assert len(drain(second)) == 4
+    assert drain(first) == []
+    assert '$share/pool/jobs' in broker.shared_groups
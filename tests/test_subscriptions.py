@@ -0,0 +1,57 @@
+import itertools
+import random
+
+import pytest
+
+from mqtt_broker import MQTTBroker, SubscriptionTrie
+
+FILTERS = ['#', '+', 'a', 'a/#', 'a/+', 'a/b', 'a/b/c', 'a/+/c', '+/b/#', '+/+/+',
+           'a/b/#', '$SYS/#', '$SYS/+/load', 'a//c', '+/+', 'b/#']
+TOPICS = ['a', 'a/b', 'a/b/c', 'a/x/c', 'b', 'b/b/d', 'a//c', '/a', 'x/b',
+          '$SYS/broker/load', '$SYS', 'a/b/c/d']
+
+
+@pytest.fixture(scope='module')
+def broker():
+    return MQTTBroker(host='127.0.0.1', port=0, config={'mqtt': {'allow_anonymous': True}})
+
+
+def test_trie_agrees_with_topic_matches(broker):
+    trie = SubscriptionTrie()
+    for index, topic_filter in enumerate(FILTERS):
+        trie.add(topic_filter, f'c{index}', index % 2)
+    for topic in TOPICS:
+        expected = {f'c{index}': index % 2 for index, topic_filter in enumerate(FILTERS)
+                    if broker.topic_matches(topic_filter, topic)}
+        assert trie.match(topic) == expected, topic
+
+
+def test_trie_agrees_with_topic_matches_random(broker):
+    rng = random.Random(1)
+    words = ['a', 'b', '']
+    levels = words + ['+', '#']
+    filters = set()
+    while len(filters) < 200:
+        parts = [rng.choice(levels) for _ in range(rng.randint(1, 4))]
+        if '#' in parts[:-1]:
+            continue
+        filters.add('/'.join(parts))
+    trie = SubscriptionTrie()
+    for topic_filter in filters:
+        trie.add(topic_filter, topic_filter)
+    for length in range(1, 5):
+        for parts in itertools.product(words, repeat=length):
+            topic = '/'.join(parts)
+            expected = {f: 0 for f in filters if broker.topic_matches(f, topic)}
+            assert trie.match(topic) == expected, topic
+
+
+def test_highest_qos_wins_and_remove_prunes():
+    trie = SubscriptionTrie()
+    trie.add('a/#', 'c1', 0)
+    trie.add('a/b', 'c1', 1)
+    assert trie.match('a/b') == {'c1': 1}
+    assert trie.remove('a/b', 'c1')
+    assert not trie.remove('a/b', 'c1')
+    assert 'b' not in trie.root.children['a'].children
+    assert trie.match('a/b') == {'c1': 0}
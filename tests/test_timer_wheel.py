@@ -0,0 +1,40 @@
+from mqtt_broker import TimerWheel
+
+
+def run(wheel, ticks):
+    """逐個刻度推進，返回 {定時項: 到期刻度}"""
+    fired = {}
+    for tick in range(1, ticks + 1):
+        for item in wheel.advance(wheel.origin + tick * wheel.resolution):
+            assert item not in fired
+            fired[item] = tick
+    return fired
+
+
+def test_items_fire_on_their_tick_at_every_level():
+    # 每層 4 個槽位、共 2 層：超過 16 個刻度的定時項需要重新計算位置
+    wheel = TimerWheel(resolution=1.0, slots=4, levels=2)
+    delays = [0.5, 1.5, 3.5, 4.5, 15.5, 16.5, 17.5, 40.5, 63.5]
+    for delay in delays:
+        wheel.schedule(delay, wheel.origin + delay)
+    fired = run(wheel, 80)
+    assert fired == {delay: int(delay) + 1 for delay in delays}
+    assert len(wheel) == 0
+
+
+def test_cancel_and_reschedule():
+    wheel = TimerWheel(resolution=1.0, slots=4, levels=2)
+    wheel.schedule('a', wheel.origin + 2.5)
+    wheel.schedule('b', wheel.origin + 2.5)
+    wheel.schedule('b', wheel.origin + 9.5)
+    wheel.cancel('a')
+    assert len(wheel) == 1
+    assert run(wheel, 20) == {'b': 10}
+
+
+def test_past_deadline_fires_on_next_tick():
+    wheel = TimerWheel(resolution=1.0, slots=4, levels=2)
+    wheel.advance(wheel.origin + 5)
+    wheel.schedule('late', wheel.origin + 1)
+    assert wheel.advance(wheel.origin + 5) == []
+    assert wheel.advance(wheel.origin + 6) == ['late']
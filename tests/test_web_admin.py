@@ -0,0 +1,85 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('flask_socketio')
+pytest.importorskip('netifaces')
+
+import web_admin  # noqa: E402
+from mqtt_test_client import TestClient  # noqa: E402
+
+EVENT_THREAD = []
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def admin(tmp_path, monkeypatch):
+    """以 in_process 模式在臨時目錄中啟動 Broker，返回其端口"""
+    config_file = tmp_path / 'config.json'
+    config_file.write_text(json.dumps({
+        'broker': {'host': '127.0.0.1', 'port': 0},
+        'logging': {'level': 'INFO'},
+        'mqtt': {'allow_anonymous': True},
+        'web_admin': {'broker_mode': 'in_process'},
+    }))
+    users_file = tmp_path / 'users.json'
+    users_file.write_text('{"users": []}')
+    monkeypatch.setattr(web_admin, 'CONFIG_FILE', str(config_file))
+    monkeypatch.setattr(web_admin, 'USERS_FILE', str(users_file))
+    monkeypatch.setattr(web_admin, 'SESSION_DIR', str(tmp_path / 'sessions'))
+    for state in (web_admin.clients_info, web_admin.topics_info, web_admin.message_buffer):
+        state.clear()
+    if not EVENT_THREAD:
+        thread = threading.Thread(target=web_admin.process_broker_events, daemon=True)
+        thread.start()
+        EVENT_THREAD.append(thread)
+
+    broker_logger = logging.getLogger('mqtt_broker')
+    level = broker_logger.level
+    assert web_admin.start_broker()
+    yield web_admin.BROKER_INSTANCE.port
+    web_admin.stop_broker()
+    for handler in list(broker_logger.handlers):
+        if isinstance(handler, web_admin.WebLogHandler):
+            broker_logger.removeHandler(handler)
+    broker_logger.setLevel(level)
+
+
+def test_dashboard_is_fed_by_broker_events(admin):
+    client = TestClient(admin, 'dash-1')
+    client.subscribe('a/#')
+    client.publish('a/b', '你好')
+
+    assert wait_for(lambda: web_admin.message_buffer.get('a/b'))
+    assert web_admin.message_buffer['a/b'][-1]['message'] == '你好'
+    assert web_admin.clients_info['dash-1']['active']
+    assert web_admin.topics_info['a/#'] == ['dash-1']
+    # Broker 的日誌經 WebLogHandler 進入日誌面板，不含 logging 格式中的時間前綴
+    assert wait_for(lambda: any('dash-1' in entry['message'] for entry in web_admin.log_buffer))
+
+    client.send(0xE0)  # DISCONNECT
+    assert wait_for(lambda: not web_admin.clients_info['dash-1']['active'])
+
+    api = web_admin.app.test_client()
+    assert api.get('/api/topics').get_json() == {'topics': {'a/#': ['dash-1']}}
+    assert api.get('/api/clients').get_json()['dash-1']['active'] is False
+
+
+def test_persistent_sessions_are_kept_in_session_dir(admin):
+    client = TestClient(admin, 'keeper', clean_session=False)
+    client.subscribe('cmd/#', qos=1)
+    client.close()
+    assert wait_for(lambda: os.listdir(web_admin.SESSION_DIR))
+    assert os.listdir(web_admin.SESSION_DIR) == ['keeper'.encode('utf-8').hex()]
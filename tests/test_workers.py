@@ -0,0 +1,99 @@
+import os
+import signal
+import socket
+import time
+
+import pytest
+
+import mqtt_broker
+from mqtt_test_client import TestClient
+
+pytestmark = pytest.mark.skipif(
+    not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'),
+    reason='多進程模式需要 fork 和 SO_REUSEPORT')
+
+WORKERS = 3
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(params=['thread', 'selector'])
+def workers(request, tmp_path):
+    """在子進程中啟動多個工作進程，返回監聽端口，測試結束時終止"""
+    port = free_port()
+    config = {
+        'broker': {'host': '127.0.0.1', 'port': port, 'engine': request.param},
+        'mqtt': {'allow_anonymous': True, 'session_dir': str(tmp_path / 'sessions')},
+    }
+    users_file = tmp_path / 'users.json'
+    users_file.write_text('{"users": []}')
+    pid = os.fork()
+    if pid == 0:
+        try:
+            mqtt_broker.run_workers(WORKERS, config, str(users_file))
+        finally:
+            os._exit(0)
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                TestClient(port, 'probe').close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        time.sleep(1.0)  # 等待工作進程之間互相連接
+        yield port
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+
+def test_persistent_session_survives_reconnect_to_other_workers(workers):
+    sub = TestClient(workers, 'keeper', clean_session=False)
+    assert sub.subscribe('w/q', qos=1) == 1
+    sub.close()
+    time.sleep(0.3)
+
+    pub = TestClient(workers, 'pub')
+    pub.publish('w/q', b'queued', qos=1, packet_id=1)
+    pub.expect(0x40)
+
+    for attempt in range(WORKERS * 2):
+        sub = TestClient(workers, 'keeper', clean_session=False)
+        assert sub.connack == (0, True)
+        if attempt == 0:
+            message = sub.expect_publish()
+            assert message.payload == b'queued'
+            sub.puback(message.packet_id)
+            time.sleep(0.1)
+        sub.close()
+        time.sleep(0.1)
+
+
+def test_shared_subscription_delivers_once_across_workers(workers):
+    members = []
+    for index in range(WORKERS * 2):
+        member = TestClient(workers, f'member-{index}')
+        assert member.subscribe('$share/g/w/shared') == 0
+        members.append(member)
+    time.sleep(0.5)  # 等待訂閱同步到其他工作進程
+
+    pub = TestClient(workers, 'pub')
+    count = 30
+    for index in range(count):
+        pub.publish('w/shared', b'%d' % index)
+
+    received = []
+    for member in members:
+        while True:
+            packet = member.read(0.5)
+            if packet is None:
+                break
+            received.append(member)
+    assert len(received) == count
@@ -4,6 +4,7 @@
 import os
 import json
 import time
+import queue
 import logging
 import threading
 import subprocess
@@ -13,14 +14,27 @@ from collections import defaultdict
 from flask import Flask, render_template, request, jsonify, redirect, url_for
 from flask_socketio import SocketIO
 import sys
+from mqtt_broker import MAIN_SESSION_DIR, MQTTBroker, PASSWORD_SCHEME, event_record, hash_password
 
 # 配置文件路徑（使用絕對路徑）
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CONFIG_FILE = os.path.join(BASE_DIR, 'config.json')
 USERS_FILE = os.path.join(BASE_DIR, 'users.json')
+# 持久會話目錄：與子進程模式一樣默認為 sessions，進程內模式重啟 Broker 後會話仍然保留
+SESSION_DIR = os.path.join(BASE_DIR, MAIN_SESSION_DIR)
 LOG_BUFFER_SIZE = 1000  # 最大日誌條目數
 BROKER_PROCESS = None
 BROKER_SCRIPT = os.path.join(BASE_DIR, 'mqtt_broker.py')
+# 子進程模式下 Broker 經管道以 JSON Lines 傳回事件和日誌（mqtt_broker.py --event-fd）；
+# Windows 不支持向子進程傳遞文件描述符，仍解析 Broker 的輸出
+EVENT_CHANNEL = os.name == 'posix'
+EVENT_READ_SIZE = 65536  # 每次從事件管道讀取的最大字節數
+# 進程內模式（config.json 中 web_admin.broker_mode 為 in_process）：Broker 運行在本進程中，
+# 儀表板直接由 Broker 事件更新，不需要解析日誌
+BROKER_INSTANCE = None
+BROKER_THREAD = None
+BROKER_EVENT_QUEUE_SIZE = 10000  # 等待應用到儀表板的事件數上限，超過時丟棄
+BROKER_EVENT_BATCH = 500  # 每批處理的事件數，每批只推送一次客戶端和主題列表
 
 # 初始化 Flask 應用
 app = Flask(__name__)
@@ -38,24 +52,26 @@ broker_stats = {
     'uptime': 0,
     'messages': 0,
     'connections': 0,
-    'active_topics': 0
+    'active_topics': 0,
+    'events_dropped': 0
 }
+broker_events = queue.Queue(BROKER_EVENT_QUEUE_SIZE)
 
 # 日誌處理
 
 
 class WebLogHandler(logging.Handler):
+    """把 Broker 的日誌記錄放入 broker_events 隊列
+
+    emit 在 Broker 處理報文的線程中同步調用，格式化和推送到前端
+    都留給 process_broker_events 線程。
+    """
+
     def emit(self, record):
-        global log_buffer
-        log_entry = {
-            'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'level': record.levelname,
-            'message': self.format(record)
-        }
-        log_buffer.append(log_entry)
-        if len(log_buffer) > LOG_BUFFER_SIZE:
-            log_buffer = log_buffer[-LOG_BUFFER_SIZE:]
-        socketio.emit('log_update', log_entry)
+        queue_broker_event(record)
+
+
+log_formatter = logging.Formatter('%(message)s')
 
 # 獲取系統信息
 
@@ -123,8 +139,15 @@ def load_users():
 
 def save_users(users):
     try:
-        with open(USERS_FILE, 'w') as f:
+        # 明文密碼在寫入前轉換為哈希
+        for user in users.get("users", []):
+            if not user.get("password", "").startswith(PASSWORD_SCHEME + '$'):
+                user["password"] = hash_password(user.get("password", ""))
+        # 先寫臨時文件再替換，Broker 重新載入時不會讀到寫了一半的文件
+        tmp_file = USERS_FILE + '.tmp'
+        with open(tmp_file, 'w') as f:
             json.dump(users, f, indent=4)
+        os.replace(tmp_file, USERS_FILE)
         return True
     except Exception as e:
         app.logger.error(f"保存用戶失敗: {e}")
@@ -133,8 +156,18 @@ def save_users(users):
 # 啟動 Broker
 
 
+def broker_mode():
+    """Broker 的運行方式：subprocess（默認，子進程）或 in_process（本進程內）"""
+    return load_config().get('web_admin', {}).get('broker_mode', 'subprocess')
+
+
 def start_broker():
     global BROKER_PROCESS, broker_stats
+    if BROKER_INSTANCE is not None and BROKER_INSTANCE.running:
+        app.logger.info("Broker 已經在運行中")
+        return True
+    if broker_mode() == 'in_process':
+        return start_broker_in_process()
     if BROKER_PROCESS is None or BROKER_PROCESS.poll() is not None:
         try:
             # 配置日誌處理器
@@ -167,20 +200,35 @@ def start_broker():
             socketio.emit('log_update', log_entry)
 
             # 啟動 Broker 進程
-            BROKER_PROCESS = subprocess.Popen(
-                [python_exe, BROKER_SCRIPT],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                universal_newlines=True,
-                bufsize=1
-            )
+            event_fd = None
+            if EVENT_CHANNEL:
+                # Broker 的輸出直接顯示在終端，儀表板只讀取事件管道
+                event_fd, broker_fd = os.pipe()
+                BROKER_PROCESS = subprocess.Popen(
+                    [python_exe, BROKER_SCRIPT, '--event-fd', str(broker_fd)],
+                    pass_fds=(broker_fd,)
+                )
+                os.close(broker_fd)
+            else:
+                BROKER_PROCESS = subprocess.Popen(
+                    [python_exe, BROKER_SCRIPT],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    universal_newlines=True,
+                    bufsize=1
+                )
 
             # 檢查進程是否成功啟動
             time.sleep(1)
             if BROKER_PROCESS.poll() is not None:
                 # 進程已退出
                 exit_code = BROKER_PROCESS.returncode
-                error_output = BROKER_PROCESS.stdout.read() if BROKER_PROCESS.stdout else "無法獲取錯誤輸出"
+                if event_fd is not None:
+                    # 管道中已有的日誌（包括錯誤原因）放入日誌面板
+                    read_broker_events(event_fd)
+                    error_output = "詳見日誌"
+                else:
+                    error_output = BROKER_PROCESS.stdout.read() if BROKER_PROCESS.stdout else "無法獲取錯誤輸出"
 
                 error_message = f"[錯誤] Broker 啟動失敗，退出碼: {exit_code}, 錯誤: {error_output}"
                 app.logger.error(error_message)
@@ -199,7 +247,7 @@ def start_broker():
             broker_stats['start_time'] = time.time()
 
             # 啟動日誌讀取線程
-            threading.Thread(target=read_broker_output, daemon=True).start()
+            threading.Thread(target=read_broker_output, args=(event_fd,), daemon=True).start()
 
             success_message = f"[成功] MQTT Broker 已成功啟動，PID: {BROKER_PROCESS.pid}"
             app.logger.info(success_message)
@@ -245,11 +293,58 @@ def start_broker():
         socketio.emit('log_update', log_entry)
         return True
 
+# 在本進程內啟動 Broker
+
+
+def start_broker_in_process():
+    global BROKER_INSTANCE, BROKER_THREAD, broker_stats
+    if BROKER_PROCESS is not None and BROKER_PROCESS.poll() is None:
+        app.logger.info("Broker 已經在運行中")
+        return True
+    config = load_config()
+    try:
+        # Broker 的日誌經 broker_events 隊列進入日誌面板
+        broker_logger = logging.getLogger('mqtt_broker')
+        if not any(isinstance(h, WebLogHandler) for h in broker_logger.handlers):
+            broker_logger.addHandler(WebLogHandler())
+        broker_logger.setLevel(config.get('logging', {}).get('level', 'INFO').upper())
+
+        mqtt_config = config.setdefault('mqtt', {})
+        if mqtt_config.get('session_dir') is None:
+            mqtt_config['session_dir'] = SESSION_DIR
+        broker = MQTTBroker(config=config, users_file=USERS_FILE)
+        broker.add_event_hook(queue_broker_event)
+        BROKER_THREAD = broker.start_in_background()
+        BROKER_INSTANCE = broker
+    except Exception as e:
+        error_message = f"[錯誤] 進程內啟動 Broker 失敗: {e}"
+        app.logger.error(error_message)
+        log_entry = {
+            'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'level': 'ERROR',
+            'message': error_message
+        }
+        log_buffer.append(log_entry)
+        socketio.emit('log_update', log_entry)
+        return False
+
+    broker_stats['running'] = True
+    broker_stats['start_time'] = time.time()
+    app.logger.info(f"[成功] MQTT Broker 已在本進程內啟動，端口: {broker.port}")
+    return True
+
 # 停止 Broker
 
 
 def stop_broker():
-    global BROKER_PROCESS, broker_stats
+    global BROKER_PROCESS, BROKER_INSTANCE, broker_stats
+    if BROKER_INSTANCE is not None:
+        BROKER_INSTANCE.stop()
+        BROKER_THREAD.join(timeout=5)
+        BROKER_INSTANCE = None
+        broker_stats['running'] = False
+        broker_stats['uptime'] = 0
+        return True
     if BROKER_PROCESS is not None and BROKER_PROCESS.poll() is None:
         try:
             BROKER_PROCESS.terminate()
@@ -287,52 +382,65 @@ def update_broker_stats():
 # 從 Broker 讀取輸出
 
 
-def read_broker_output():
+def read_broker_output(event_fd=None):
     global BROKER_PROCESS
 
-    if BROKER_PROCESS is None:
+    process = BROKER_PROCESS
+    if process is None:
         return
 
-    log_line_buffer = ""
-    while BROKER_PROCESS.poll() is None:
-        output = BROKER_PROCESS.stdout.readline()
-        if output:
-            log_line_buffer += output
-            if log_line_buffer.endswith('\n'):
-                process_log_line(log_line_buffer.strip())
-                log_line_buffer = ""
-        else:
-            time.sleep(0.1)
+    if event_fd is not None:
+        read_broker_events(event_fd)
+    else:
+        # 逐行解析 Broker 的輸出，直到進程退出
+        for line in process.stdout:
+            process_log_line(line.strip())
 
     # 進程結束時的處理
-    if log_line_buffer:
-        process_log_line(log_line_buffer.strip())
-
+    process.wait()
     broker_stats['running'] = False
-    BROKER_PROCESS = None
+    if BROKER_PROCESS is process:
+        BROKER_PROCESS = None
+
+# 讀取事件管道
+
+
+def read_broker_events(event_fd):
+    """讀取 Broker 的事件管道直到所有寫入端關閉
+
+    每次阻塞讀取管道中已有的全部數據（最多 EVENT_READ_SIZE 字節），
+    成批應用其中的事件，每批只推送一次客戶端和主題列表。
+    """
+    pending = b''
+    with os.fdopen(event_fd, 'rb', buffering=0) as pipe:
+        while True:
+            chunk = pipe.read(EVENT_READ_SIZE)
+            if not chunk:
+                break
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()  # 不完整的最後一行留到下次
+            updates = set()
+            for line in lines:
+                try:
+                    updates.add(apply_event_record(json.loads(line)))
+                except Exception as e:
+                    app.logger.error(f"處理 Broker 事件錯誤: {e}")
+            push_dashboard_updates(updates)
 
 # 處理日誌行
 
 
 def process_log_line(line):
-    global log_buffer, message_buffer, broker_stats
+    global message_buffer, broker_stats
 
     # 添加到日誌緩衝區
-    log_entry = {
-        'level': 'INFO' if '[錯誤]' not in line else 'ERROR',
-        'message': line
-    }
-    log_buffer.append(log_entry)
-    if len(log_buffer) > LOG_BUFFER_SIZE:
-        log_buffer = log_buffer[-LOG_BUFFER_SIZE:]
-
-    # 發送到前端
-    socketio.emit('log_update', log_entry)
+    record_log('INFO' if '[錯誤]' not in line else 'ERROR', line)
 
     # 從日誌中解析信息
     if '[發布]' in line and '主題' in line:
         try:
-            # 解析主題和消息 - 處理新格式 "[發布] 客戶端 X 發布到主題 'Y': Z"
+            # 解析主題和消息 - 處理新格式 "[發布] 客戶端 X 發布到主題 'Y': Z"，
+            # 未輸出消息內容時為 "[發布] 客戶端 X 發布到主題 'Y'（N 字節）"
             topic_start = line.find("'") if "'" in line else line.find('"')
             if topic_start < 0:
                 return
@@ -345,27 +453,15 @@ def process_log_line(line):
             topic = line[topic_start + 1:topic_end]
 
             # 從日誌中提取消息內容
-            message_start = line.find(':', topic_end) + 1
-            if message_start <= 0:
+            rest = line[topic_end + 1:]
+            if rest.startswith(':'):
+                message = rest[1:].strip()
+            elif rest.startswith('（'):
+                message = f"<{rest.strip().strip('（）')}>"
+            else:
                 return
 
-            message = line[message_start:].strip()
-
-            # 存儲消息
-            message_data = {
-                'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'topic': topic,
-                'message': message
-            }
-            message_buffer[topic].append(message_data)
-            if len(message_buffer[topic]) > 100:  # 每個主題最多保留100條消息
-                message_buffer[topic] = message_buffer[topic][-100:]
-
-            # 更新統計
-            broker_stats['messages'] += 1
-
-            # 發送到前端
-            socketio.emit('message_update', message_data)
+            record_message(topic, message)
         except Exception as e:
             app.logger.error(f"處理消息日誌錯誤: {e}")
 
@@ -376,14 +472,7 @@ def process_log_line(line):
             parts = line.split('客戶端 ')[1].split(' (用戶: ')
             client_id = parts[0]
             username = parts[1].split(')')[0]
-
-            # 更新客戶端信息
-            clients_info[client_id] = {
-                'id': client_id,
-                'username': username,
-                'connected_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'active': True
-            }
+            record_client_connected(client_id, username)
 
             # 發送到前端
             socketio.emit('client_update', clients_info)
@@ -394,10 +483,7 @@ def process_log_line(line):
     elif '[斷開]' in line and '客戶端' in line:
         try:
             parts = line.split('客戶端 ')[1].split(' 正常斷開')
-            client_id = parts[0]
-
-            if client_id in clients_info:
-                clients_info[client_id]['active'] = False
+            record_client_disconnected(parts[0])
 
             # 發送到前端
             socketio.emit('client_update', clients_info)
@@ -408,17 +494,141 @@ def process_log_line(line):
     elif '[訂閱]' in line and '訂閱主題' in line:
         try:
             parts = line.split('客戶端 ')[1].split(' 訂閱主題：')
-            client_id = parts[0]
-            topic = parts[1]
-
-            if client_id not in topics_info[topic]:
-                topics_info[topic].append(client_id)
+            record_subscription(parts[0], parts[1])
 
             # 發送到前端
             socketio.emit('topic_update', {'topics': dict(topics_info)})
         except Exception as e:
             app.logger.error(f"處理訂閱信息錯誤: {e}")
 
+# 更新儀表板狀態，日誌解析和 Broker 事件共用
+
+
+def record_log(level, message):
+    global log_buffer
+    log_entry = {
+        'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'level': level,
+        'message': message
+    }
+    log_buffer.append(log_entry)
+    if len(log_buffer) > LOG_BUFFER_SIZE:
+        log_buffer = log_buffer[-LOG_BUFFER_SIZE:]
+
+    # 發送到前端
+    socketio.emit('log_update', log_entry)
+
+
+def record_message(topic, message):
+    message_data = {
+        'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'topic': topic,
+        'message': message
+    }
+    message_buffer[topic].append(message_data)
+    if len(message_buffer[topic]) > 100:  # 每個主題最多保留100條消息
+        message_buffer[topic] = message_buffer[topic][-100:]
+
+    # 更新統計
+    broker_stats['messages'] += 1
+
+    # 發送到前端
+    socketio.emit('message_update', message_data)
+
+
+def record_client_connected(client_id, username):
+    clients_info[client_id] = {
+        'id': client_id,
+        'username': username,
+        'connected_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'active': True
+    }
+
+
+def record_client_disconnected(client_id):
+    if client_id in clients_info:
+        clients_info[client_id]['active'] = False
+
+
+def record_subscription(client_id, topic):
+    if client_id not in topics_info[topic]:
+        topics_info[topic].append(client_id)
+
+
+def record_unsubscription(client_id, topic):
+    subscribers = topics_info.get(topic)
+    if subscribers and client_id in subscribers:
+        subscribers.remove(client_id)
+        if not subscribers:
+            del topics_info[topic]
+
+# 處理 Broker 事件
+
+
+def queue_broker_event(event):
+    """Broker 事件回調（以及 WebLogHandler 的日誌記錄）：只放入隊列，由 process_broker_events 線程處理"""
+    try:
+        broker_events.put_nowait(event)
+    except queue.Full:
+        broker_stats['events_dropped'] += 1
+
+
+def apply_event_record(record):
+    """把一條事件記錄（mqtt_broker.event_record 的格式）應用到儀表板狀態，
+    返回需要推送的前端事件名"""
+    kind = record['type']
+    if kind == 'published':
+        record_message(record['topic'], record.get('payload', f"<{record['size']} 字節>"))
+    elif kind == 'connected':
+        record_client_connected(record['client_id'], record['username'])
+        return 'client_update'
+    elif kind == 'disconnected':
+        record_client_disconnected(record['client_id'])
+        return 'client_update'
+    elif kind == 'subscribed':
+        record_subscription(record['client_id'], record['topic'])
+        return 'topic_update'
+    elif kind == 'unsubscribed':
+        record_unsubscription(record['client_id'], record['topic'])
+        return 'topic_update'
+    elif kind == 'log':
+        record_log(record['level'], record['message'])
+    elif kind == 'events_dropped':
+        broker_stats['events_dropped'] += record['count']
+    return None
+
+
+def push_dashboard_updates(updates):
+    """推送一批事件改變的客戶端和主題列表"""
+    if 'client_update' in updates:
+        socketio.emit('client_update', clients_info)
+    if 'topic_update' in updates:
+        socketio.emit('topic_update', {'topics': dict(topics_info)})
+
+
+def process_broker_events():
+    """後台線程：成批取出 Broker 事件更新儀表板，每批只推送一次客戶端和主題列表"""
+    while True:
+        events = [broker_events.get()]
+        try:
+            while len(events) < BROKER_EVENT_BATCH:
+                events.append(broker_events.get_nowait())
+        except queue.Empty:
+            pass
+
+        updates = set()
+        for event in events:
+            try:
+                if isinstance(event, logging.LogRecord):
+                    record = {'type': 'log', 'level': event.levelname,
+                              'message': log_formatter.format(event)}
+                else:
+                    record = event_record(event, payloads=True)
+                updates.add(apply_event_record(record))
+            except Exception as e:
+                app.logger.error(f"處理 Broker 事件錯誤: {e}")
+        push_dashboard_updates(updates)
+
 # 定時更新 Broker 統計
 
 
@@ -582,6 +792,8 @@ def handle_clear_dashboard():
 if __name__ == '__main__':
     # 啟動統計更新線程
     threading.Thread(target=update_stats_periodically, daemon=True).start()
+    # 啟動 Broker 事件處理線程（進程內模式）
+    threading.Thread(target=process_broker_events, daemon=True).start()
 
     # 啟動 Web 服務器
     socketio.run(app, host='0.0.0.0', port=8083, debug=True)